@@ -0,0 +1,360 @@
+'''
+Approximate nearest neighbour backends for the search engine.
+
+Brute force is fine while we only have a few cars worth of logs but it's O(corpus) per
+query, so these trade a little recall for not scanning everything. Every backend has
+the same build / save / load / search interface so the engine doesn't care which one
+it's using, and "exact" is always there as the fallback.
+
+    exact - plain matrix-vector scan, what we've always done
+    ivf   - inverted file: k-means the corpus into nlist clusters, only scan the
+            nprobe closest ones (numpy only, no extra deps)
+    hnsw  - graph index from hnswlib, only registered if hnswlib is installed
+    binary / int8 - quantized codes scanned in full then rescored on the floats, see quantIndex
+
+ivf / hnsw only pay off on big corpora, under MIN_ANN_ROWS rows they're skipped and the
+exact scan gets used (a 20k x 1024 matrix-vector product is a couple of ms, and exact).
+
+Run "python -m allthestuff.annIndex" next to the index files for a recall@k report.
+'''
+import os
+import time
+
+import numpy as np
+
+from . import quantIndex
+from . import searchIndex
+
+# under this many rows ivf / hnsw aren't built or loaded, the exact scan is fast enough
+MIN_ANN_ROWS = 20000
+APPROXIMATE = ('ivf', 'hnsw')
+
+
+class ExactIndex:
+    name = 'exact'
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    @classmethod
+    def build(cls, embeddings, **kwargs):
+        return cls(embeddings)
+
+    def save(self, output_prefix):
+        pass  # nothing to save, the .npy is the index
+
+    @classmethod
+    def load(cls, output_prefix, embeddings, **kwargs):
+        return cls(embeddings)
+
+    def search(self, query_embedding, top_k, **kwargs):
+        """Returns (rows, scores), best first"""
+        similarities = self.embeddings @ query_embedding
+        top = searchIndex.top_k_indices(similarities, top_k)
+        return top, similarities[top]
+
+    def search_many(self, query_embeddings, top_k, **kwargs):
+        """Every query scored in one matrix-matrix product, returns a list of (rows, scores)"""
+        similarities = query_embeddings @ self.embeddings.T
+        hits = []
+        for row in similarities:
+            top = searchIndex.top_k_indices(row, top_k)
+            hits.append((top, row[top]))
+        return hits
+
+
+class IVFIndex:
+    """
+    Inverted file index. Centroids come from spherical k-means on a sample of the corpus,
+    every row is assigned to its closest centroid, and the rows are stored grouped by
+    list (CSR style: list_offsets into list_rows) so probing a list is one slice.
+
+    nprobe defaults to 1/16th of the lists, a fixed count would scan less and less of the
+    corpus as it grows (nlist is 4 * sqrt(n)). A query always probes enough lists to get
+    top_k rows back, so hybrid's 200 candidates don't come up short on small lists.
+    """
+    name = 'ivf'
+
+    def __init__(self, embeddings, centroids, list_offsets, list_rows, nprobe=None):
+        self.embeddings = embeddings
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.list_sizes = np.diff(list_offsets)
+        self.nprobe = nprobe or self.default_nprobe(len(centroids))
+
+    @staticmethod
+    def default_nlist(n):
+        return max(1, min(n, int(4 * np.sqrt(n))))
+
+    @staticmethod
+    def default_nprobe(nlist):
+        return min(nlist, max(8, nlist // 16))
+
+    @classmethod
+    def build(cls, embeddings, nlist=None, n_iter=10, sample_size=None, seed=0, **kwargs):
+        n = embeddings.shape[0]
+        nlist = nlist or cls.default_nlist(n)
+        rng = np.random.default_rng(seed)
+
+        # ~256 points per centroid is plenty to train on, no need to k-means the whole corpus
+        sample_size = sample_size or min(n, 256 * nlist)
+        sample = np.asarray(embeddings[np.sort(rng.choice(n, sample_size, replace=False))], dtype=np.float32)
+
+        print(f"Training IVF with {nlist} lists on {sample_size} vectors...")
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(n_iter):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = sample[assignment == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+                else:
+                    # dead centroid, restart it on a random point
+                    centroids[c] = sample[rng.integers(sample_size)]
+            centroids = searchIndex.normalize_embeddings(centroids)
+
+        # assign the full corpus in blocks so we never make an n x nlist matrix
+        assignment = np.empty(n, dtype=np.int64)
+        for start in range(0, n, 65536):
+            block = np.asarray(embeddings[start:start + 65536], dtype=np.float32)
+            assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+
+        list_rows = np.argsort(assignment, kind='stable').astype(np.int64)
+        list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=nlist), out=list_offsets[1:])
+
+        return cls(embeddings, centroids, list_offsets, list_rows)
+
+    def save(self, output_prefix):
+        # temp file + replace, a server opening the index right now never sees half a file
+        np.savez(f'{output_prefix}_ivf.tmp.npz', centroids=self.centroids,
+                 list_offsets=self.list_offsets, list_rows=self.list_rows)
+        os.replace(f'{output_prefix}_ivf.tmp.npz', f'{output_prefix}_ivf.npz')
+        print(f"Saved IVF index to {output_prefix}_ivf.npz")
+
+    @classmethod
+    def load(cls, output_prefix, embeddings, nprobe=None, **kwargs):
+        data = np.load(f'{output_prefix}_ivf.npz')
+        if data['list_rows'].shape[0] != embeddings.shape[0]:
+            raise ValueError("IVF index doesn't match the embeddings (stale index?)")
+        return cls(embeddings, data['centroids'], data['list_offsets'], data['list_rows'], nprobe=nprobe)
+
+    def search(self, query_embedding, top_k, nprobe=None, **kwargs):
+        probe = self._probe(self.centroids @ query_embedding, top_k, nprobe or self.nprobe)
+        return self._scan(probe, query_embedding, top_k)
+
+    def search_many(self, query_embeddings, top_k, nprobe=None, **kwargs):
+        """Centroids for every query in one product, then each query scans its own lists"""
+        centroid_scores = query_embeddings @ self.centroids.T
+        return [
+            self._scan(self._probe(scores, top_k, nprobe or self.nprobe), query, top_k)
+            for query, scores in zip(query_embeddings, centroid_scores)
+        ]
+
+    def _probe(self, centroid_scores, top_k, nprobe):
+        """The nprobe closest lists, plus the next closest ones until they hold at least top_k rows"""
+        order = np.argsort(-centroid_scores, kind='stable')
+        enough = np.searchsorted(np.cumsum(self.list_sizes[order]), min(top_k, len(self.list_rows))) + 1
+        return order[:max(nprobe, enough)]
+
+    def _scan(self, probe, query_embedding, top_k):
+        candidates = np.concatenate([
+            self.list_rows[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probe
+        ])
+        similarities = self.embeddings[candidates] @ query_embedding
+        top = searchIndex.top_k_indices(similarities, top_k)
+        return candidates[top], similarities[top]
+
+
+BACKENDS = {
+    'exact': ExactIndex,
+    'ivf': IVFIndex,
+    'binary': quantIndex.BinaryIndex,
+    'int8': quantIndex.Int8Index,
+}
+
+try:
+    import hnswlib
+
+    class HNSWIndex:
+        """
+        ef is set once when it's loaded and never per query: it's state on the shared
+        hnswlib index, so one thread changing it would change it under every other one.
+        max_k is the biggest top_k it'll be asked for (hybrid's candidates), ef never goes
+        under that.
+        """
+        name = 'hnsw'
+
+        def __init__(self, embeddings, index, ef_search=64, max_k=None):
+            self.embeddings = embeddings
+            self.index = index
+            self.ef_search = max(ef_search, max_k or 0)
+            self.index.set_ef(self.ef_search)
+
+        @classmethod
+        def build(cls, embeddings, M=16, ef_construction=200, **kwargs):
+            index = hnswlib.Index(space='ip', dim=embeddings.shape[1])
+            index.init_index(max_elements=embeddings.shape[0], M=M, ef_construction=ef_construction)
+            index.add_items(np.asarray(embeddings, dtype=np.float32), np.arange(embeddings.shape[0]))
+            return cls(embeddings, index)
+
+        def save(self, output_prefix):
+            self.index.save_index(f'{output_prefix}_hnsw.tmp.bin')
+            os.replace(f'{output_prefix}_hnsw.tmp.bin', f'{output_prefix}_hnsw.bin')
+            print(f"Saved HNSW index to {output_prefix}_hnsw.bin")
+
+        @classmethod
+        def load(cls, output_prefix, embeddings, ef_search=64, max_k=None, **kwargs):
+            index = hnswlib.Index(space='ip', dim=embeddings.shape[1])
+            index.load_index(f'{output_prefix}_hnsw.bin', max_elements=embeddings.shape[0])
+            if index.get_current_count() != embeddings.shape[0]:
+                raise ValueError("HNSW index doesn't match the embeddings (stale index?)")
+            return cls(embeddings, index, ef_search=ef_search, max_k=max_k)
+
+        def search(self, query_embedding, top_k, **kwargs):
+            labels, distances = self.index.knn_query(query_embedding, k=min(top_k, self.embeddings.shape[0]))
+            # 'ip' distance is 1 - dot product
+            return labels[0].astype(np.int64), 1.0 - distances[0]
+
+        def search_many(self, query_embeddings, top_k, **kwargs):
+            labels, distances = self.index.knn_query(query_embeddings, k=min(top_k, self.embeddings.shape[0]))
+            return [(l.astype(np.int64), 1.0 - d) for l, d in zip(labels, distances)]
+
+    BACKENDS['hnsw'] = HNSWIndex
+except ImportError:
+    pass
+
+
+def index_file(backend, output_prefix):
+    return {
+        'ivf': f'{output_prefix}_ivf.npz',
+        'hnsw': f'{output_prefix}_hnsw.bin',
+        'binary': f'{output_prefix}_binary.npz',
+        'int8': f'{output_prefix}_int8.npz',
+    }.get(backend)
+
+
+def build(embeddings, backend='ivf', output_prefix='search_index', min_rows=MIN_ANN_ROWS, **kwargs):
+    """Build a backend over (already normalized) embeddings and save it next to the .npy"""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown ANN backend '{backend}', pick one of {sorted(BACKENDS)}")
+    if backend in APPROXIMATE and embeddings.shape[0] < min_rows:
+        print(f"Only {embeddings.shape[0]} rows, not building a '{backend}' index (exact search is fast enough)")
+        return ExactIndex(embeddings)
+    index = BACKENDS[backend].build(embeddings, **kwargs)
+    index.save(output_prefix)
+    return index
+
+
+def load(embeddings, backend='ivf', output_prefix='search_index', min_rows=MIN_ANN_ROWS, **kwargs):
+    """Load a saved backend, falling back to exact if it's missing or unavailable (or ivf / hnsw on under min_rows rows)"""
+    if backend in APPROXIMATE and embeddings.shape[0] < min_rows:
+        return ExactIndex(embeddings)
+    path = index_file(backend, output_prefix)
+    if backend == 'exact' or backend not in BACKENDS or path is None or not os.path.exists(path):
+        if backend != 'exact':
+            print(f"No usable '{backend}' index found, falling back to exact search")
+        return ExactIndex(embeddings)
+    try:
+        return BACKENDS[backend].load(output_prefix, embeddings, **kwargs)
+    except ValueError as e:
+        print(f"{e}, falling back to exact search")
+        return ExactIndex(embeddings)
+
+
+def recall_report(embeddings, index, top_k=10, n_queries=200, noise=0.05, seed=0, **search_kwargs):
+    """
+    Compare an ANN index against the exact scan
+
+    Queries are random corpus rows plus a bit of noise (so they're not trivially their own
+    nearest neighbour). Returns a dict with recall@k and per-query latency for both.
+    """
+    rng = np.random.default_rng(seed)
+    n = embeddings.shape[0]
+    rows = rng.choice(n, min(n_queries, n), replace=False)
+    queries = np.asarray(embeddings[rows], dtype=np.float32)
+    queries = searchIndex.normalize_embeddings(queries + noise * rng.standard_normal(queries.shape).astype(np.float32))
+
+    exact = ExactIndex(embeddings)
+    hits = 0
+    exact_time = 0.0
+    ann_time = 0.0
+    for query in queries:
+        start = time.perf_counter()
+        truth, _ = exact.search(query, top_k)
+        exact_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        found, _ = index.search(query, top_k, **search_kwargs)
+        ann_time += time.perf_counter() - start
+
+        hits += len(np.intersect1d(truth, found))
+
+    report = {
+        'backend': index.name,
+        'top_k': top_k,
+        'queries': len(queries),
+        'recall': hits / (len(queries) * min(top_k, n)),
+        'exact_ms': 1000 * exact_time / len(queries),
+        'ann_ms': 1000 * ann_time / len(queries),
+        **search_kwargs,
+    }
+    if hasattr(index, 'memory_bytes'):
+        # quantized backends: what they keep in memory vs the float matrix the exact scan reads
+        report['memory_mb'] = index.memory_bytes() / 1024 / 1024
+        report['float_mb'] = embeddings.shape[0] * embeddings.shape[1] * 4 / 1024 / 1024
+    return report
+
+
+def main(output_prefix='search_index', top_k=10):
+    """
+    Print recall@k vs latency for every saved backend over a few knob settings, for each
+    index shard if ingest wrote shards (same ones the server would use)
+    """
+    from . import indexShards
+
+    shards = indexShards.load_manifest()
+    if shards:
+        for name in sorted(shards):
+            print(f"\nIndex shard {name}")
+            report_prefix(indexShards.shard_prefix(name, entry=shards[name]), top_k)
+    else:
+        report_prefix(output_prefix, top_k)
+
+
+def report_prefix(output_prefix='search_index', top_k=10):
+    """main() for one set of index files"""
+    embeddings = searchIndex.normalize_embeddings(np.load(f'{output_prefix}_embeddings.npy', mmap_mode='r'))
+    print(f"{embeddings.shape[0]} vectors, top_k={top_k}")
+
+    sweeps = {
+        'ivf': [{'nprobe': p} for p in (1, 4, 8, 16, 32, 64)],
+        'hnsw': [{'ef_search': ef} for ef in (16, 32, 64, 128)],
+        'binary': [{'rescore': r} for r in (2, 5, 10, 20)],
+        'int8': [{'rescore': r} for r in (1, 2, 4, 8)],
+    }
+    for backend, settings in sweeps.items():
+        path = index_file(backend, output_prefix)
+        if backend not in BACKENDS or not os.path.exists(path):
+            continue
+        # min_rows=0, whatever's on disk gets reported even if the server wouldn't use it
+        index = load(embeddings, backend, output_prefix, min_rows=0)
+        for knobs in settings:
+            if backend == 'hnsw':
+                # ef only gets set at load, so every setting is its own index
+                index = load(embeddings, backend, output_prefix, min_rows=0, **knobs)
+                report = {**recall_report(embeddings, index, top_k=top_k), **knobs}
+            else:
+                report = recall_report(embeddings, index, top_k=top_k, **knobs)
+            knob_text = ", ".join(f"{k}={v}" for k, v in knobs.items())
+            memory_text = ""
+            if 'memory_mb' in report:
+                memory_text = (f" memory={report['memory_mb']:.1f}MB vs {report['float_mb']:.1f}MB float "
+                               f"({report['float_mb'] / report['memory_mb']:.0f}x smaller)")
+            print(f"{backend:6s} {knob_text:14s} recall@{top_k}={report['recall']:.3f} "
+                  f"ann={report['ann_ms']:.2f}ms exact={report['exact_ms']:.2f}ms{memory_text}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, send_from_directory, Response
+from flask import Flask, request, jsonify, send_from_directory, Response, g
 from flask_cors import CORS
 import json
 import numpy as np
@@ -6,146 +6,684 @@ from sentence_transformers import SentenceTransformer
 from typing import List, Dict, Any
 import re
 import os
-from ollama import chat
 import random
+import time
 import _pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from . import searchIndex
+from . import annIndex
+from . import indexFile
+from . import queryCache
+from . import encodeBatcher
+from . import lexicalIndex
+from . import summaryContext
+from . import summaryCache
+from . import llmScheduler
+from . import metrics
+from . import indexShards
+from . import indexReload
 
-def main():
-    app = Flask(__name__, static_folder='static')
-    CORS(app)
+class IndexShard:
+    """
+    One complete index: embeddings, chunks, filters, ANN and BM25 off one output prefix.
+    The engine has just the one, or one per car when ingest wrote index shards.
+    """
+
+    def __init__(self, embeddings_file='search_index_embeddings.npy', chunks_file='search_index_chunks.json',
+                 index_file='search_index.idx', ann_backend='ivf', nprobe=None, ef_search=64, rescore=None, name=None,
+                 max_k=None):
+        self.name = name
+        output_prefix = embeddings_file[:-len('_embeddings.npy')] if embeddings_file.endswith('_embeddings.npy') else embeddings_file
+
+        if index_file and os.path.exists(index_file):
+            # mmap'd single file index: constant time startup, pages shared between workers,
+            # and chunk text only gets decoded for the hits we return
+            print(f"Opening {index_file}...")
+            self.index = indexFile.IndexFile(index_file)
+            self.embeddings = self.index.embeddings
+            if not self.index.normalized:
+                # written before ingest normalized the .idx, the whole matrix ends up in RAM
+                print(f"Warning: {index_file} isn't normalized, copying all {self.index.n_rows} rows into memory "
+                      f"to normalize them. Rebuild the index (\"uv run ingest --full\") to search it straight off the mmap")
+                self.embeddings = searchIndex.normalize_embeddings(self.embeddings)
+            self.chunks = self.index.chunks
+            self.filter_index = searchIndex.FilterIndex.from_file_ids(self.index.files, self.index.file_ids)
+            self.index_version = self.index.version_tag
+            output_prefix = index_file[:-len('.idx')] if index_file.endswith('.idx') else index_file
+        else:
+            print(f"No {index_file}, falling back to the .npy + .json index")
+            self.index = None
+            self._load_legacy(embeddings_file, chunks_file)
+            self.index_version = f"{len(self.chunks)}-{int(os.path.getmtime(embeddings_file))}"
+
+        # approximate index for unfiltered queries, falls back to exact if it isn't built
+        self.ann = annIndex.load(self.embeddings, ann_backend, output_prefix, nprobe=nprobe, ef_search=ef_search,
+                                 rescore=rescore, max_k=max_k)
+        if self.ann.name == 'exact' and ann_backend in annIndex.APPROXIMATE and self.n_rows < annIndex.MIN_ANN_ROWS:
+            # per car shards are almost always this small
+            print(f"Using 'exact' index for unfiltered queries (only {self.n_rows} rows, "
+                  f"'{ann_backend}' starts at {annIndex.MIN_ANN_ROWS})")
+        else:
+            print(f"Using '{self.ann.name}' index for unfiltered queries")
+
+        # BM25 index for hybrid search, None if it hasn't been built (hybrid then goes dense)
+        self.lexical = lexicalIndex.load(output_prefix, self.embeddings.shape[0])
+
+        print(f"Loaded {len(self.chunks)} chunks with {self.embeddings.shape[1]}-dimensional embeddings")
+
+    def _load_legacy(self, embeddings_file, chunks_file):
+        """Old .npy + .json index, only used if there's no .idx file yet"""
+        print("Loading embeddings...")
+        try:
+            # Try loading as regular numpy array first
+            self.embeddings = np.load(embeddings_file)
+        except (ValueError, _pickle.UnpicklingError) as e:
+            print(f"Standard load failed: {e}")
+            print("Attempting to fix corrupted file...")
+            # File might have corrupt bytes at the start - try to fix it
+            with open(embeddings_file, 'rb') as f:
+                data = f.read()
+
+            # Check if it starts with UTF-8 BOM or replacement character
+            if data[:3] == b'\xef\xbf\xbd':
+                print("Found corrupt bytes at start, removing them...")
+                # Skip the corrupt bytes and save to a temp file
+                fixed_file = embeddings_file + '.fixed'
+                with open(fixed_file, 'wb') as f:
+                    f.write(data[3:])  # Skip first 3 bytes
+
+                # Try loading the fixed file with allow_pickle
+                self.embeddings = np.load(fixed_file, allow_pickle=True)
+                print("Successfully loaded fixed embeddings!")
+            else:
+                # Try with allow_pickle on original file
+                self.embeddings = np.load(embeddings_file, allow_pickle=True)
 
-    class SemanticSearchEngine:
-        def __init__(self, embeddings_file='search_index_embeddings.npy', 
-                     chunks_file='search_index_chunks.json',
-                     model_name='Qwen/Qwen3-Embedding-0.6B'):
-            """Initialize the search engine"""
+        print("Loading chunks...")
+        with open(chunks_file, 'r', encoding='utf-8') as f:
+            self.chunks = json.load(f)
+
+        # normalize once here so search is a single matrix-vector product
+        self.embeddings = searchIndex.normalize_embeddings(self.embeddings)
+
+        # KS number / folder -> row indices, for pre-filtering
+        self.filter_index = searchIndex.FilterIndex(self.chunks)
+
+    @property
+    def n_rows(self):
+        return self.embeddings.shape[0]
+
+    def close(self):
+        # the embeddings (and the ANN index's copy of them) are views into the mmap, it can
+        # only be unmapped once they're gone
+        self.embeddings = self.ann = None
+        if self.index is not None:
+            self.index.close()
+
+    def rows(self, ks_filter=None, subfolder_filter=None):
+        """
+        filter_index.rows, except that a filter matching the whole shard ("ks9" in the ks9
+        shard) comes back as None so the scan doesn't copy every row out first
+        """
+        rows = self.filter_index.rows(ks_filter, subfolder_filter)
+        if rows is not None and len(rows) == self.n_rows:
+            return None
+        return rows
+
+
+class SemanticSearchEngine:
+    def __init__(self, embeddings_file='search_index_embeddings.npy',
+                 chunks_file='search_index_chunks.json',
+                 model_name='Qwen/Qwen3-Embedding-0.6B',
+                 ann_backend='ivf', nprobe=None, ef_search=64, rescore=None,
+                 index_file='search_index.idx', caches=None,
+                 batch_window_ms=5.0, max_batch=32,
+                 mode='hybrid', fusion='rrf', candidates=200, lexical_pass=3, model=None, metrics_registry=None,
+                 shard_dir=indexShards.shard_dir, shard_workers=None):
+        """
+        Initialize the search engine
+
+        ann_backend picks the approximate index used for unfiltered queries ('exact' to
+        always brute force), nprobe / ef_search are its recall vs latency knobs (nprobe=None
+        scales with the number of IVF lists). Indexes under annIndex.MIN_ANN_ROWS rows always
+        use the exact scan.
+        'binary' / 'int8' scan quantized codes and rescore rescore * top_k rows on the floats
+        (None = the backend's default), see quantIndex.
+        mode is the default retrieval mode (searches can pick their own):
+            'hybrid' - BM25 candidates + dense candidates, dense scored and fused
+            'dense'  - cosine only, through the ANN index when unfiltered
+            'exact'  - cosine only, full scan of every (filtered) row
+        fusion is 'rrf' or 'weighted' (see lexicalIndex.fuse), candidates is how many
+        rows each side of hybrid search contributes. Hybrid results in the BM25 top
+        lexical_pass of their query get in even under the threshold.
+        caches is a queryCache.QueryCaches to share between engines, None makes a new one.
+        batch_window_ms / max_batch control how concurrent searches get batched together,
+        batch_window_ms=None turns batching off
+        model is an already loaded SentenceTransformer (or anything with the same encode),
+        None loads model_name
+        metrics_registry is where stage timings go, None uses the shared metrics.registry
+        If shard_dir has index shards in it (see indexShards) those get used instead of the
+        single index files, each one opened the first time a query needs it. Queries that
+        span several shards search them on shard_workers threads (None = up to 8).
+        """
+        if model is None:
             print("Loading model...")
-            self.model = SentenceTransformer(model_name)
-            
-            print("Loading embeddings...")
-            try:
-                # Try loading as regular numpy array first
-                self.embeddings = np.load(embeddings_file)
-            except (ValueError, _pickle.UnpicklingError) as e:
-                print(f"Standard load failed: {e}")
-                print("Attempting to fix corrupted file...")
-                # File might have corrupt bytes at the start - try to fix it
-                with open(embeddings_file, 'rb') as f:
-                    data = f.read()
-                
-                # Check if it starts with UTF-8 BOM or replacement character
-                if data[:3] == b'\xef\xbf\xbd':
-                    print("Found corrupt bytes at start, removing them...")
-                    # Skip the corrupt bytes and save to a temp file
-                    fixed_file = embeddings_file + '.fixed'
-                    with open(fixed_file, 'wb') as f:
-                        f.write(data[3:])  # Skip first 3 bytes
-                    
-                    # Try loading the fixed file with allow_pickle
-                    self.embeddings = np.load(fixed_file, allow_pickle=True)
-                    print("Successfully loaded fixed embeddings!")
-                else:
-                    # Try with allow_pickle on original file
-                    self.embeddings = np.load(embeddings_file, allow_pickle=True)
-            
-            print("Loading chunks...")
-            with open(chunks_file, 'r', encoding='utf-8') as f:
-                self.chunks = json.load(f)
-            
-            print(f"Loaded {len(self.chunks)} chunks with {self.embeddings.shape[1]}-dimensional embeddings")
-            print(f"Model produces {self.model.get_sentence_embedding_dimension()}-dimensional embeddings")
-            
-            # Verify dimensions match
-            if self.embeddings.shape[1] != self.model.get_sentence_embedding_dimension():
+            model = SentenceTransformer(model_name)
+        self.model = model
+        self.metrics = metrics_registry if metrics_registry is not None else metrics.registry
+        # everything reopen() needs to open the same kind of engine again
+        self.settings = {
+            'embeddings_file': embeddings_file, 'chunks_file': chunks_file, 'model_name': model_name,
+            'ann_backend': ann_backend, 'nprobe': nprobe, 'ef_search': ef_search, 'rescore': rescore,
+            'index_file': index_file, 'batch_window_ms': batch_window_ms, 'max_batch': max_batch,
+            'mode': mode, 'fusion': fusion, 'candidates': candidates, 'lexical_pass': lexical_pass,
+            'shard_dir': shard_dir, 'shard_workers': shard_workers,
+        }
+        self.ann_backend = ann_backend
+        # max_k: hybrid asks the ANN index for candidates rows, HNSW's ef gets set to cover that
+        self.shard_settings = {'ann_backend': ann_backend, 'nprobe': nprobe, 'ef_search': ef_search, 'rescore': rescore,
+                               'max_k': candidates}
+        self.shard_dir = shard_dir
+
+        # name -> IndexShard, filled in as shards get opened (the one unsharded index is None)
+        self._shards = {}
+        self._shard_lock = threading.Lock()
+        self._pool = None
+
+        if shard_dir and indexShards.exists(shard_dir):
+            self.shard_manifest = indexShards.load_manifest(shard_dir)
+            self.index_version = indexShards.version(self.shard_manifest)
+            dims = {entry['dim'] for entry in self.shard_manifest.values()}
+            print(f"Found {len(self.shard_manifest)} index shards in {shard_dir} "
+                  f"({', '.join(sorted(self.shard_manifest))}), opening them as queries need them")
+            self._pool = ThreadPoolExecutor(shard_workers or min(8, max(1, len(self.shard_manifest))),
+                                            thread_name_prefix='shard')
+        else:
+            self.shard_manifest = None
+            shard = IndexShard(embeddings_file, chunks_file, index_file, **self.shard_settings)
+            self._shards[None] = shard
+            self.index_version = shard.index_version
+            dims = {shard.embeddings.shape[1]}
+
+        # query embedding + result caches, cleared whenever the index version changes
+        self.caches = caches if caches is not None else queryCache.QueryCaches()
+        self.caches.sync_version(self.index_version)
+
+        # coalesces concurrent searches into one encode + one matrix product
+        self.batcher = None
+        if batch_window_ms is not None:
+            self.batcher = encodeBatcher.EncodeBatcher(self._process_batch, batch_window_ms, max_batch)
+
+        self.mode = mode
+        self.fusion = fusion
+        self.candidates = candidates
+        self.lexical_pass = lexical_pass
+
+        print(f"Model produces {self.model.get_sentence_embedding_dimension()}-dimensional embeddings")
+
+        # Verify dimensions match
+        for dim in dims:
+            if dim != self.model.get_sentence_embedding_dimension():
                 raise ValueError(
                     f"Embedding dimension mismatch! "
-                    f"Loaded embeddings have {self.embeddings.shape[1]} dimensions, "
+                    f"Loaded embeddings have {dim} dimensions, "
                     f"but model '{model_name}' produces {self.model.get_sentence_embedding_dimension()} dimensions. "
                     f"Please use the same model that created the embeddings."
                 )
-        
-        def extract_filters(self, query: str) -> tuple[str, str, str]:
-            """
-            Extract KS and subfolder filters from query if present
-            
-            Args:
-                query: Search query string
-            
-            Returns:
-                Tuple of (cleaned_query, ks_filter, subfolder_filter)
-            """
-            cleaned_query = query
-            ks_filter = None
-            subfolder_filter = None
-            
-            # Match "ks" followed by optional space and digits (case insensitive)
-            ks_pattern = r'\bks\s*(\d+)\b'
-            ks_match = re.search(ks_pattern, query, re.IGNORECASE)
-            
-            if ks_match:
-                ks_number = ks_match.group(1)
-                ks_filter = f"ks{ks_number}"
-                cleaned_query = re.sub(ks_pattern, '', cleaned_query, flags=re.IGNORECASE).strip()
-            
-            # Match "folder:" or "subfolder:" followed by text (case insensitive)
-            folder_pattern = r'\b(?:folder|subfolder):\s*([^\s]+)'
-            folder_match = re.search(folder_pattern, query, re.IGNORECASE)
-            
-            if folder_match:
-                subfolder_filter = folder_match.group(1)
-                cleaned_query = re.sub(folder_pattern, '', cleaned_query, flags=re.IGNORECASE).strip()
-            
-            return cleaned_query, ks_filter, subfolder_filter
-        
-        def search(self, query: str, top_k: int = 5, threshold: float = 0.0) -> List[Dict[str, Any]]:
-            """Search for most relevant chunks"""
-            cleaned_query, ks_filter, subfolder_filter = self.extract_filters(query)
-            
-            if ks_filter:
-                print(f"Filtering results for: {ks_filter}")
-            if subfolder_filter:
-                print(f"Filtering results for subfolder: {subfolder_filter}")
-            
-            query_embedding = self.model.encode([cleaned_query])[0]
-            
-            similarities = np.dot(self.embeddings, query_embedding) / (
-                np.linalg.norm(self.embeddings, axis=1) * np.linalg.norm(query_embedding)
-            )
-            
-            top_indices = np.argsort(similarities)[-top_k:][::-1]
-            
-            results = []
-            for idx in top_indices:
-                score = float(similarities[idx])
-                if score >= threshold:
-                    chunk = self.chunks[idx]
-                    
-                    # Apply filters if present
-                    if isinstance(chunk, dict):
-                        file_field = chunk.get('file', '')
-                        
-                        # Apply KS filter
-                        if ks_filter and ks_filter.lower() not in file_field.lower():
-                            continue
-                        
-                        # Apply subfolder filter
-                        if subfolder_filter and subfolder_filter.lower() not in file_field.lower():
-                            continue
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def reopen(self):
+        """
+        A new engine on whatever index is on disk now, with the same settings and the same
+        (already loaded) model. It gets its own empty caches, nothing in the old ones came
+        from the new index.
+        """
+        caches = queryCache.QueryCaches(self.caches.embeddings.maxsize, self.caches.results.maxsize)
+        return SemanticSearchEngine(model=self.model, caches=caches, metrics_registry=self.metrics, **self.settings)
+
+    def close(self):
+        """Stop the batcher and shard threads and let go of the index files, nothing can search after this"""
+        if self.batcher is not None:
+            self.batcher.stop()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+        with self._shard_lock:
+            for shard in self._shards.values():
+                shard.close()
+
+    def shard(self, name):
+        """The IndexShard called name, opened the first time it's asked for"""
+        shard = self._shards.get(name)
+        if shard is not None:
+            return shard
+        with self._shard_lock:
+            if name not in self._shards:
+                print(f"Opening index shard {name}...")
+                prefix = indexShards.shard_prefix(name, self.shard_dir, self.shard_manifest[name])
+                self._shards[name] = IndexShard(f'{prefix}_embeddings.npy', f'{prefix}_chunks.json', f'{prefix}.idx',
+                                                name=name, **self.shard_settings)
+            return self._shards[name]
+
+    def _shards_for(self, ks_filter):
+        """Every shard a query with this ks filter could have hits in"""
+        if self.shard_manifest is None:
+            return [self._shards[None]]
+        ks_filter = ks_filter and ks_filter.lower()
+        return [self.shard(name) for name, entry in sorted(self.shard_manifest.items())
+                if ks_filter is None or ks_filter in entry['ks']]
+
+    @property
+    def n_chunks(self):
+        if self.shard_manifest is None:
+            return self._shards[None].n_rows
+        return sum(entry['rows'] for entry in self.shard_manifest.values())
+
+    @property
+    def has_lexical(self):
+        if self.shard_manifest is None:
+            return self._shards[None].lexical is not None
+        return any(entry.get('lexical') for entry in self.shard_manifest.values())
+
+    def folders(self):
+        """Every folder name in any chunk's path, without opening any shards"""
+        if self.shard_manifest is None:
+            return self._shards[None].filter_index.folders()
+        return sorted({folder for entry in self.shard_manifest.values() for folder in entry['folders']})
+
+    def index_stats(self):
+        """What's on disk and what's actually been opened, for /api/health and /api/metrics"""
+        loaded = list(self._shards.values())
+        return {
+            'chunks': self.n_chunks,
+            'dim': self.dim,
+            'shards': None if self.shard_manifest is None else {
+                name: {'rows': entry['rows'], 'loaded': name in self._shards}
+                for name, entry in sorted(self.shard_manifest.items())
+            },
+            'embedding_bytes': sum(shard.embeddings.nbytes for shard in loaded),
+            'file_bytes': sum(os.path.getsize(shard.index.path) for shard in loaded if shard.index is not None),
+            'lexical_terms': sum(len(shard.lexical.vocab) for shard in loaded if shard.lexical is not None),
+            'ann': sorted({shard.ann.name for shard in loaded}) or [self.ann_backend],
+            'ann_memory_bytes': sum(shard.ann.memory_bytes() for shard in loaded if hasattr(shard.ann, 'memory_bytes')),
+        }
+
+    def extract_filters(self, query: str) -> tuple[str, str, str]:
+        """
+        Extract KS and subfolder filters from query if present
+
+        Args:
+            query: Search query string
+
+        Returns:
+            Tuple of (cleaned_query, ks_filter, subfolder_filter)
+        """
+        cleaned_query = query
+        ks_filter = None
+        subfolder_filter = None
+
+        # Match "ks" followed by optional space and digits (case insensitive)
+        ks_pattern = r'\bks\s*(\d+)\b'
+        ks_match = re.search(ks_pattern, query, re.IGNORECASE)
+
+        if ks_match:
+            ks_number = ks_match.group(1)
+            ks_filter = f"ks{ks_number}"
+            cleaned_query = re.sub(ks_pattern, '', cleaned_query, flags=re.IGNORECASE).strip()
+
+        # Match "folder:" or "subfolder:" followed by text (case insensitive)
+        folder_pattern = r'\b(?:folder|subfolder):\s*([^\s]+)'
+        folder_match = re.search(folder_pattern, query, re.IGNORECASE)
+
+        if folder_match:
+            subfolder_filter = folder_match.group(1)
+            cleaned_query = re.sub(folder_pattern, '', cleaned_query, flags=re.IGNORECASE).strip()
+
+        return cleaned_query, ks_filter, subfolder_filter
+
+    def encode_queries(self, cleaned_queries: List[str]) -> np.ndarray:
+        """
+        Unit length embeddings for a list of queries. Anything not already in the cache
+        gets encoded in a single model.encode call.
+        """
+        keys = [queryCache.normalize_query(q) for q in cleaned_queries]
+        found = {key: self.caches.embeddings.get(key) for key in set(keys)}
+        missing = [key for key, embedding in found.items() if embedding is None]
+
+        if missing:
+            with self.metrics.timer('search_stage_seconds', stage='encode'):
+                encoded = searchIndex.normalize_embeddings(self.model.encode(missing))
+            for key, embedding in zip(missing, encoded):
+                found[key] = embedding
+                self.caches.embeddings.put(key, embedding)
+
+        return np.stack([found[key] for key in keys])
+
+    def encode_query(self, cleaned_query: str) -> np.ndarray:
+        """Unit length query embedding, from the cache if we've seen this query before"""
+        return self.encode_queries([cleaned_query])[0]
+
+    def score_many(self, query_embeddings: np.ndarray, filters, top_ks, thresholds,
+                   query_texts=None, modes=None) -> List[List[Dict[str, Any]]]:
+        """
+        Rank the index against a batch of already encoded queries
+
+        Args:
+            query_embeddings: (m, dim) unit length query vectors
+            filters: m (ks_filter, subfolder_filter) tuples
+            top_ks / thresholds: per-query top_k and minimum score
+            query_texts: m cleaned query strings, needed for hybrid mode
+            modes: m retrieval modes, None means 'dense' for everything
+
+        Returns:
+            m result lists, same order as the queries
+        """
+        # queries with the same filters share one slice of the matrix, so each group
+        # is a single matrix-matrix product (per shard)
+        groups = {}
+        for i, (ks_filter, subfolder_filter) in enumerate(filters):
+            mode = modes[i] if modes else 'dense'
+            if mode == 'hybrid' and (not self.has_lexical or query_texts is None):
+                mode = 'dense'
+            key = (ks_filter, subfolder_filter and subfolder_filter.lower(), mode)
+            groups.setdefault(key, []).append(i)
+
+        results = [None] * len(top_ks)
+        for (ks_filter, subfolder_filter, mode), positions in groups.items():
+            group = query_embeddings[positions]
+            texts = [query_texts[i] for i in positions] if mode == 'hybrid' else None
+            k = max(top_ks[i] for i in positions)
+
+            # a ks filter only goes to the shards that car is in, anything else goes to all of them
+            shards = self._shards_for(ks_filter)
+
+            def search_shard(shard):
+                return self._shard_hits(shard, group, texts, ks_filter, subfolder_filter, k, mode)
+
+            if len(shards) == 1:
+                per_shard = [search_shard(shards[0])]
+            else:
+                per_shard = list(self._pool.map(search_shard, shards))
+
+            with self.metrics.timer('search_stage_seconds', stage='build'):
+                for j, i in enumerate(positions):
+                    query_hits = [shard_hits[j] for shard_hits in per_shard]
+                    if mode == 'hybrid':
+                        hits = self._fuse_hits(shards, query_hits, top_ks[i])
                     else:
-                        if ks_filter or subfolder_filter:
-                            continue
-                    
-                    result = {
-                        'score': score,
-                        'chunk': chunk
-                    }
-                    results.append(result)
-            
-            return results
+                        hits = self._merge_hits(shards, query_hits, top_ks[i])
+                    results[i] = self._build_results(hits, thresholds[i])
+
+        return results
+
+    def _shard_hits(self, shard, group, texts, ks_filter, subfolder_filter, k, mode):
+        """
+        One shard's hits for each query in group: (rows, cosine) top k, or for hybrid the
+        unfused candidates from _hybrid_hits
+        """
+        # only score the rows the filters allow, so a filtered query still gets a full top_k
+        rows = shard.rows(ks_filter, subfolder_filter)
+        if rows is not None and len(rows) == 0:
+            empty_rows, empty_scores = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+            if mode == 'hybrid':
+                return [(empty_rows, empty_scores, empty_rows, empty_rows, empty_scores)] * len(group)
+            return [(empty_rows, empty_scores)] * len(group)
+        # filtered queries were always an exact scan, keep it that way when the filter is the whole shard
+        exact = mode == 'exact' or bool(ks_filter or subfolder_filter)
+        if mode == 'hybrid':
+            return self._hybrid_hits(shard, group, texts, rows, k, exact)
+        return self._dense_hits(shard, group, rows, k, exact)
+
+    def _merge_hits(self, shards, hits, top_k):
+        """
+        One query's (rows, cosine) from each shard -> its best top_k overall by cosine, as
+        (shard, row, cosine, fused, bm25, lexical_match) tuples like _fuse_hits
+        """
+        merged = []
+        for shard, (rows, cosine) in zip(shards, hits):
+            for j in range(min(top_k, len(rows))):
+                merged.append((shard, int(rows[j]), float(cosine[j]), None, None, False))
+        if len(hits) > 1:
+            merged.sort(key=lambda hit: hit[2], reverse=True)
+        return merged[:top_k]
+
+    def _fuse_hits(self, shards, hits, top_k):
+        """
+        One query's hybrid candidates from each shard -> its best top_k overall, fused once
+        over all of them. RRF scores only mean something within one ranking, fusing per shard
+        would make every shard's #1 tie. Rows get an offset per shard so they're unique.
+
+        Returns:
+            (shard, row, cosine, fused, bm25, lexical_match) tuples, lexical_match being
+            whether the row is in the BM25 top lexical_pass overall
+        """
+        if not hits:
+            return []
+        offsets = np.cumsum([0] + [shard.n_rows for shard in shards])
+        # each shard's candidates are sorted and offsets only go up, so this stays sorted
+        candidates = np.concatenate([hit[0] + offset for hit, offset in zip(hits, offsets)])
+        cosine = np.concatenate([hit[1] for hit in hits])
+        dense_rows = np.concatenate([hit[2] + offset for hit, offset in zip(hits, offsets)])
+        lexical_rows = np.concatenate([hit[3] + offset for hit, offset in zip(hits, offsets)])
+        lexical_scores = np.concatenate([hit[4] for hit in hits])
+
+        with self.metrics.timer('search_stage_seconds', stage='topk'):
+            # every shard brought its own best n_candidates, keep the best n_candidates overall
+            # of each side like a single index would have
+            n_candidates = max(self.candidates, top_k)
+            dense_rows = dense_rows[searchIndex.top_k_indices(cosine[np.searchsorted(candidates, dense_rows)], n_candidates)]
+            order = np.argsort(-lexical_scores, kind='stable')[:n_candidates]
+            lexical_rows, lexical_scores = lexical_rows[order], lexical_scores[order]
+
+            kept = np.union1d(dense_rows, lexical_rows)
+            kept_cosine = cosine[np.searchsorted(candidates, kept)]
+            fused_rows, fused_scores = lexicalIndex.fuse(
+                (kept, kept_cosine), (lexical_rows, lexical_scores), self.fusion
+            )
+            fused_rows, fused_scores = fused_rows[:top_k], fused_scores[:top_k]
+
+        bm25 = dict(zip(lexical_rows.tolist(), lexical_scores.tolist()))
+        strong = set(lexical_rows[:self.lexical_pass].tolist())
+        which = np.searchsorted(offsets, fused_rows, side='right') - 1
+        merged = []
+        for row, score, shard_i in zip(fused_rows.tolist(), fused_scores.tolist(), which.tolist()):
+            merged.append((shards[shard_i], row - int(offsets[shard_i]),
+                           float(kept_cosine[np.searchsorted(kept, row)]), score, bm25.get(row, 0.0), row in strong))
+        return merged
+
+    def _dense_hits(self, shard, group, rows, k, exact=False):
+        """Cosine top k for each query in group, over rows (None = everything, via the ANN index unless exact)"""
+        if rows is None and not exact:
+            # the ANN index does its own top k, so this all counts as scoring
+            with self.metrics.timer('search_stage_seconds', stage='score'):
+                return shard.ann.search_many(group, k)
+
+        with self.metrics.timer('search_stage_seconds', stage='score'):
+            candidates = shard.embeddings if rows is None else shard.embeddings[rows]
+            similarities = group @ candidates.T
+        hits = []
+        with self.metrics.timer('search_stage_seconds', stage='topk'):
+            for row_scores in similarities:
+                top = searchIndex.top_k_indices(row_scores, k)
+                hits.append((top if rows is None else rows[top], row_scores[top]))
+        return hits
+
+    def _hybrid_hits(self, shard, group, texts, rows, k, exact=False):
+        """
+        BM25 candidates + dense candidates from one shard, only those get (exact) cosine
+        scores. They get fused in _fuse_hits once every shard's candidates are in.
+
+        Returns:
+            (candidates, cosine, dense_rows, lexical_rows, lexical_scores) per query,
+            candidates sorted, lexical best first (empty if the shard has no BM25 index)
+        """
+        n_candidates = max(self.candidates, k)
+        dense = self._dense_hits(shard, group, rows, n_candidates, exact)
+
+        hits = []
+        for query_embedding, text, (dense_rows, _) in zip(group, texts, dense):
+            with self.metrics.timer('search_stage_seconds', stage='score'):
+                if shard.lexical is not None:
+                    lexical_rows, lexical_scores = shard.lexical.search(text, n_candidates, rows)
+                else:
+                    lexical_rows, lexical_scores = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+                candidates = np.union1d(dense_rows, lexical_rows).astype(np.int64)
+                cosine = shard.embeddings[candidates] @ query_embedding
+            hits.append((candidates, cosine, np.asarray(dense_rows, dtype=np.int64), lexical_rows, lexical_scores))
+        return hits
+
+    def score(self, query_embedding: np.ndarray, ks_filter=None, subfolder_filter=None,
+              top_k: int = 5, threshold: float = 0.0, query_text=None, mode=None) -> List[Dict[str, Any]]:
+        """Rank the index against an already encoded query"""
+        return self.score_many(query_embedding[None, :], [(ks_filter, subfolder_filter)], [top_k], [threshold],
+                               [query_text] if query_text is not None else None, [mode or 'dense'])[0]
+
+    def _build_results(self, hits, threshold):
+        """hits from _merge_hits. score is always the cosine similarity, hybrid results also get fused_score + bm25"""
+        results = []
+        for shard, row, score, fused, bm25, lexical_match in hits:
+            # a strong term match is the whole point of hybrid, so it gets in even with a low cosine.
+            # only the BM25 top few though, any chunk with a "the" in it has bm25 > 0
+            if score >= threshold or lexical_match:
+                result = {
+                    'score': score,
+                    'chunk': shard.chunks[row]
+                }
+                if fused is not None:
+                    result['fused_score'] = fused
+                    result['bm25'] = bm25
+                results.append(result)
+        return results
+
+    def _process_batch(self, items):
+        """items are (cleaned_query, ks_filter, subfolder_filter, top_k, threshold, mode) tuples"""
+        query_embeddings = self.encode_queries([item[0] for item in items])
+        return self.score_many(
+            query_embeddings,
+            [(item[1], item[2]) for item in items],
+            [item[3] for item in items],
+            [item[4] for item in items],
+            [item[0] for item in items],
+            [item[5] for item in items],
+        )
+
+    def search(self, query: str, top_k: int = 5, threshold: float = 0.0, mode=None) -> List[Dict[str, Any]]:
+        """Search for most relevant chunks, mode is 'hybrid', 'dense' or 'exact' (None = engine default)"""
+        mode = mode or self.mode
+        with self.metrics.timer('search_seconds', mode=mode):
+            return self._search(query, top_k, threshold, mode)
+
+    def _search(self, query, top_k, threshold, mode):
+        """search() minus the timer around the whole thing"""
+        with self.metrics.timer('search_stage_seconds', stage='parse'):
+            cleaned_query, ks_filter, subfolder_filter = self.extract_filters(query)
+
+        if ks_filter:
+            print(f"Filtering results for: {ks_filter}")
+        if subfolder_filter:
+            print(f"Filtering results for subfolder: {subfolder_filter}")
+
+        self.caches.sync_version(self.index_version)
+        result_key = (queryCache.normalize_query(cleaned_query), ks_filter,
+                      subfolder_filter and subfolder_filter.lower(), top_k, threshold, mode)
+        results = self.caches.results.get(result_key)
+        if results is not None:
+            return list(results)
+
+        item = (cleaned_query, ks_filter, subfolder_filter, top_k, threshold, mode)
+        if self.batcher is not None:
+            # wait for whatever else shows up in the next few ms and go together
+            results = self.batcher.run(item)
+        else:
+            results = self._process_batch([item])[0]
+
+        self.caches.results.put(result_key, results)
+        return list(results)
+
+    def search_many(self, queries: List[str], top_k: int = 5, threshold: float = 0.0, mode=None) -> List[List[Dict[str, Any]]]:
+        """
+        Search a list of queries at once
+
+        Each query keeps its own ks/folder filters, but every uncached query is encoded in
+        one batched call and scored together. Results come back in the same order as queries.
+        """
+        mode = mode or self.mode
+        self.caches.sync_version(self.index_version)
+
+        results = [None] * len(queries)
+        pending = []
+        for i, query in enumerate(queries):
+            with self.metrics.timer('search_stage_seconds', stage='parse'):
+                cleaned_query, ks_filter, subfolder_filter = self.extract_filters(query)
+            result_key = (queryCache.normalize_query(cleaned_query), ks_filter,
+                          subfolder_filter and subfolder_filter.lower(), top_k, threshold, mode)
+            cached = self.caches.results.get(result_key)
+            if cached is not None:
+                results[i] = list(cached)
+            else:
+                pending.append((i, result_key, (cleaned_query, ks_filter, subfolder_filter, top_k, threshold, mode)))
+
+        if pending:
+            batch_results = self._process_batch([item for _, _, item in pending])
+            for (i, result_key, _), query_results in zip(pending, batch_results):
+                self.caches.results.put(result_key, query_results)
+                results[i] = list(query_results)
+
+        return results
+
+
+def create_app(search_engine=None, watch_seconds=10.0):
+    """
+    Flask app with every route wired to search_engine (a new SemanticSearchEngine if None),
+    split out of main so the app can be built without starting a server (benchmarks).
+    Every watch_seconds it checks for a newer index and swaps it in (see indexReload),
+    None to only do that on /api/reload or SIGHUP.
+    """
+    app = Flask(__name__, static_folder='static')
+    CORS(app)
 
     # Initialize search engine
-    print("Initializing search engine...")
-    search_engine = SemanticSearchEngine()
+    if search_engine is None:
+        print("Initializing search engine...")
+        search_engine = SemanticSearchEngine()
+    
+    # finished summaries, wiped whenever the index version changes
+    summary_cache = summaryCache.SummaryCache()
+    summary_cache.sync_version(search_engine.index_version)
+    summary_cache.prune()
+    
+    # stage timings from the engine + scheduler end up here, served at /api/metrics
+    registry = search_engine.metrics
+    
+    # every ollama call goes through here: one shared client, per-model caps, bounded queues
+    scheduler = llmScheduler.LLMScheduler(metrics_registry=registry)
+
+    # the engine sits behind this so a new index can be swapped in while we're running.
+    # each request gets the active one as g.search_engine and keeps it until it's done,
+    # so a reload part way through a request doesn't change the index under it
+    reloader = indexReload.IndexReloader(search_engine, watch_seconds)
+    reloader.reload_on_signal()
+    app.extensions['index_reloader'] = reloader
+
+    @app.before_request
+    def start_timer():
+        if registry.enabled:
+            g.request_start = time.perf_counter()
+        g.search_engine = reloader.acquire()
+
+    @app.teardown_request
+    def release_engine(exc):
+        engine = g.pop('search_engine', None)
+        if engine is not None:
+            reloader.release(engine)
+
+    @app.after_request
+    def stop_timer(response):
+        start = g.pop('request_start', None)
+        # url_rule is None for 404s, which would otherwise make up a label per bad url
+        if start is not None and request.url_rule is not None:
+            registry.observe('request_seconds', time.perf_counter() - start, endpoint=request.url_rule.rule)
+        return response
 
     @app.route('/')
     def index():
@@ -160,22 +698,153 @@ def main():
             query = data.get('query', '')
             top_k = data.get('top_k', 6)
             threshold = data.get('threshold', 0.3)
+            mode = data.get('mode')  # 'hybrid', 'dense' or 'exact', None = server default
             
             if not query:
                 return jsonify({'error': 'Query is required'}), 400
             
-            results = search_engine.search(query, top_k=top_k, threshold=threshold)
+            results = g.search_engine.search(query, top_k=top_k, threshold=threshold, mode=mode)
             
-            return jsonify({
-                'success': True,
-                'results': results,
-                'count': len(results)
-            })
+            with registry.timer('search_stage_seconds', stage='serialize'):
+                response = jsonify({
+                    'success': True,
+                    'results': results,
+                    'count': len(results)
+                })
+            return response
         
         except Exception as e:
             print(f"Error during search: {e}")
             return jsonify({'error': str(e)}), 500
 
+    @app.route('/api/search_batch', methods=['POST'])
+    def search_batch_route():
+        """Batch search endpoint, one round trip and one encode for a list of queries"""
+        try:
+            data = request.json
+            queries = data.get('queries', [])
+            top_k = data.get('top_k', 6)
+            threshold = data.get('threshold', 0.3)
+            mode = data.get('mode')
+            
+            if not queries or not isinstance(queries, list) or not all(isinstance(q, str) and q for q in queries):
+                return jsonify({'error': 'queries must be a non-empty list of non-empty strings'}), 400
+            
+            results = g.search_engine.search_many(queries, top_k=top_k, threshold=threshold, mode=mode)
+            
+            with registry.timer('search_stage_seconds', stage='serialize'):
+                response = jsonify({
+                    'success': True,
+                    'results': [
+                        {'query': query, 'results': query_results, 'count': len(query_results)}
+                        for query, query_results in zip(queries, results)
+                    ],
+                    'count': len(results)
+                })
+            return response
+        
+        except Exception as e:
+            print(f"Error during batch search: {e}")
+            return jsonify({'error': str(e)}), 500
+
+    # Random fun messages
+    fun_messages = [
+        "Consulting the orb...",
+        "Asking the gods...",
+        "Contacting John for an answer...",
+        "Fucking around and finding out...",
+        "Counting gizmos...",
+        "Dropping the ACC...",
+        "Freezing the stapler...",
+        "Welding AIRs together...",
+        "Puncturing LiPos...",
+        "Playing jenga with stock aluminum..."
+    ]
+
+    def sse(event):
+        return f"data: {json.dumps(event)}\n\n"
+
+    def start_summary(query, results, model, bypass_cache=False, allow_downgrade=True):
+        """
+        Set up a summary of results: cache lookup, a place in the model's queue and the prompt
+
+        Returns:
+            (generator of SSE strings, ticket). ticket is None for cache hits, otherwise the
+            caller has to make sure it gets released (the generator does it when it finishes)
+        Raises:
+            llmScheduler.QueueFull if there's no room for it
+        """
+        summary_cache.sync_version(reloader.engine.index_version)
+        cached = None if bypass_cache else summary_cache.get(summaryCache.summary_key(model, query, results))
+        
+        # cache hits don't need ollama, so they skip the line entirely
+        ticket = None
+        if cached is None:
+            ticket = scheduler.admit(model, allow_downgrade)
+            model = ticket.model
+        cache_key = summaryCache.summary_key(model, query, results)
+        
+        fun_message = random.choice(fun_messages)
+        
+        # merged, de-overlapped, cited passages trimmed to what this model gets
+        try:
+            prompt, sources = summaryContext.build_prompt(query, results, model)
+        except Exception:
+            if ticket is not None:
+                ticket.release()
+            raise
+        
+        def generate():
+            # Send the fun message first
+            yield sse({'type': 'status', 'message': fun_message})
+            if ticket is not None and ticket.downgraded:
+                yield sse({'type': 'status', 'message': f'Busy right now, using {model} instead...', 'model': model})
+            # what each [n] in the summary refers to
+            yield sse({'type': 'sources', 'sources': sources})
+            
+            if cached is not None:
+                # same events as a live summary, the page can't tell the difference
+                for piece in summaryCache.replay(cached['text']):
+                    yield sse({'type': 'content', 'text': piece})
+                yield sse({'type': 'done', 'cached': True})
+                return
+            
+            # Stream the AI response (waits in line for a slot on the model first)
+            try:
+                stream = scheduler.stream(
+                    ticket,
+                    [{'role': 'user', 'content': prompt}],
+                    options={'num_ctx': summaryContext.context_window(model)},
+                )
+                
+                text = []
+                for kind, value in stream:
+                    if kind == 'queue':
+                        message = f"Waiting in line, {value - 1} ahead of you..." if value > 1 else "Next in line..."
+                        yield sse({'type': 'status', 'message': message, 'queue_position': value})
+                        continue
+                    text.append(value)
+                    yield sse({'type': 'content', 'text': value})
+                
+                # only complete summaries get cached, an error or a closed tab never gets here
+                summary_cache.put(cache_key, {'model': model, 'query': query, 'text': "".join(text)})
+                yield sse({'type': 'done'})
+                
+            except Exception as e:
+                yield sse({'type': 'error', 'message': str(e)})
+        
+        return generate(), ticket
+
+    def event_stream(events, ticket=None):
+        response = Response(events, mimetype='text/event-stream')
+        # don't let proxies sit on the events
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        if ticket is not None:
+            # gives the slot back even if the stream never got started
+            response.call_on_close(ticket.release)
+        return response
+
     @app.route('/api/generate_summary', methods=['POST'])
     def generate_summary():
         """Generate AI summary from search results using streaming"""
@@ -184,84 +853,179 @@ def main():
             query = data.get('query', '')
             results = data.get('results', [])
             model = data.get('model', 'summaryModelMedium:latest')
+            # regenerate instead of replaying a cached summary (the new one replaces it)
+            bypass_cache = bool(data.get('bypass_cache', False))
+            # if the model's queue is full, use a smaller model instead of getting a 429
+            allow_downgrade = bool(data.get('allow_downgrade', True))
             
             if not query or not results:
                 return jsonify({'error': 'Query and results are required'}), 400
             
-            # Random fun messages
-            messages = [
-                "Consulting the orb...",
-                "Asking the gods...",
-                "Contacting John for an answer...",
-                "Fucking around and finding out...",
-                "Counting gizmos...",
-                "Dropping the ACC...",
-                "Freezing the stapler...",
-                "Welding AIRs together...",
-                "Puncturing LiPos...",
-                "Playing jenga with stock aluminum..."
-            ]
+            try:
+                events, ticket = start_summary(query, results, model, bypass_cache, allow_downgrade)
+            except llmScheduler.QueueFull as e:
+                response = jsonify({'error': str(e), 'queue_full': True})
+                response.headers['Retry-After'] = '5'
+                return response, 429
             
-            fun_message = random.choice(messages)
+            return event_stream(events, ticket)
+        
+        except Exception as e:
+            print(f"Error during summary generation: {e}")
+            return jsonify({'error': str(e)}), 500
+
+    @app.route('/api/search_summarize', methods=['POST'])
+    def search_summarize():
+        """
+        Search + summary in one round trip. Streams a 'results' event with the result cards as
+        soon as the search is done, then the summary events (same as /api/generate_summary)
+        generated from the server's own copy of the results.
+        """
+        try:
+            data = request.json
+            query = data.get('query', '')
+            top_k = data.get('top_k', 6)
+            threshold = data.get('threshold', 0.3)
+            mode = data.get('mode')
+            model = data.get('model', 'summaryModelMedium:latest')
+            summarize = bool(data.get('summarize', True))
+            bypass_cache = bool(data.get('bypass_cache', False))
+            allow_downgrade = bool(data.get('allow_downgrade', True))
             
-            def generate():
-                # Send the fun message first
-                yield f"data: {json.dumps({'type': 'status', 'message': fun_message})}\n\n"
-                
-                # Stream the AI response
+            if not query:
+                return jsonify({'error': 'Query is required'}), 400
+            
+            results = g.search_engine.search(query, top_k=top_k, threshold=threshold, mode=mode)
+            
+            ticket = None
+            summary = None
+            queue_full = None
+            if summarize and results:
                 try:
-                    stream = chat(
-                        model=model,
-                        messages=[{'role': 'user', 'content': f"Query: {query}, Document: {results}"}],
-                        stream=True,
-                    )
-                    
-                    for chunk in stream:
-                        content = chunk['message']['content']
-                        yield f"data: {json.dumps({'type': 'content', 'text': content})}\n\n"
-                    
-                    yield f"data: {json.dumps({'type': 'done'})}\n\n"
-                    
-                except Exception as e:
-                    yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
+                    summary, ticket = start_summary(query, results, model, bypass_cache, allow_downgrade)
+                except llmScheduler.QueueFull as e:
+                    queue_full = str(e)
+            
+            def generate():
+                with registry.timer('search_stage_seconds', stage='serialize'):
+                    event = sse({'type': 'results', 'results': results, 'count': len(results)})
+                yield event
+                if queue_full is not None:
+                    yield sse({'type': 'error', 'message': queue_full, 'queue_full': True})
+                elif summary is not None:
+                    yield from summary
+                else:
+                    yield sse({'type': 'done'})
             
-            return Response(generate(), mimetype='text/event-stream')
+            return event_stream(generate(), ticket)
         
         except Exception as e:
-            print(f"Error during summary generation: {e}")
+            print(f"Error during search + summary: {e}")
             return jsonify({'error': str(e)}), 500
 
     @app.route('/api/health', methods=['GET'])
     def health():
         """Health check endpoint"""
+        search_engine = g.search_engine
         return jsonify({
             'status': 'ok',
-            'chunks_loaded': len(search_engine.chunks),
-            'embedding_dim': search_engine.embeddings.shape[1]
+            'chunks_loaded': search_engine.n_chunks,
+            'embedding_dim': search_engine.dim,
+            'index_version': search_engine.index_version,
+            'mode': search_engine.mode if search_engine.has_lexical else 'dense',
+            'shards': search_engine.index_stats()['shards'],
+            'caches': search_engine.caches.stats(),
+            'summary_cache': summary_cache.stats(),
+            'llm': scheduler.stats(),
+            'batcher': search_engine.batcher.stats() if search_engine.batcher else None,
+            'reload': reloader.stats()
         })
 
+    @app.route('/api/reload', methods=['POST'])
+    def reload_route():
+        """
+        Swap in a new index now instead of waiting for the watcher. {"force": true} reopens
+        it even if the version on disk is the same one that's loaded.
+        """
+        data = request.get_json(silent=True) or {}
+        previous = reloader.engine.index_version
+        try:
+            reloaded = reloader.reload(force=bool(data.get('force', False)))
+        except Exception as e:
+            print(f"Error reloading index: {e}")
+            return jsonify({'error': str(e), 'index_version': previous}), 500
+        
+        return jsonify({
+            'success': True,
+            'reloaded': reloaded,
+            'previous_version': previous,
+            'index_version': reloader.engine.index_version
+        })
+
+    def gauges():
+        """Index size, cache stats, scheduler state and memory as they are right now, for render()"""
+        search_engine = g.search_engine
+        caches = search_engine.caches.stats()
+        summaries = summary_cache.stats()
+        llm = scheduler.stats()
+        reloads = reloader.stats()
+        batcher = search_engine.batcher.stats() if search_engine.batcher else None
+        rss, peak = metrics.memory()
+        stats = search_engine.index_stats()
+        shards = stats['shards'] or {}
+        cache_names = {'query_embeddings': caches['query_embeddings'], 'results': caches['results'], 'summaries': summaries}
+        
+        return {
+            'metrics_enabled': ("1 if stage timings are being recorded (SEARCH_METRICS=0 turns them off)", registry.enabled),
+            'index_info': ("Always 1, the labels say which index is loaded", {
+                (('version', search_engine.index_version), ('ann', ','.join(stats['ann'])),
+                 ('mode', search_engine.mode if search_engine.has_lexical else 'dense')): 1,
+            }),
+            'index_chunks': ("Chunks in the index (every shard, opened or not)", stats['chunks']),
+            'index_embedding_dim': ("Embedding dimensions", stats['dim']),
+            'index_embedding_bytes': ("Size of the embedding matrices of the opened shards", stats['embedding_bytes']),
+            'index_file_bytes': ("Size of the mmap'd index files of the opened shards on disk", stats['file_bytes'] or None),
+            'lexical_terms': ("Terms in the BM25 indexes of the opened shards", stats['lexical_terms'] or None),
+            'ann_memory_bytes': ("In-memory size of quantized codes, when the ANN backend is binary / int8",
+                                 stats['ann_memory_bytes'] or None),
+            'index_shard_chunks': ("Chunks in each index shard", {
+                (('shard', name),): shard['rows'] for name, shard in shards.items()
+            }),
+            'index_shard_loaded': ("1 once a shard has been opened by a query", {
+                (('shard', name),): int(shard['loaded']) for name, shard in shards.items()
+            }),
+            'cache_entries': ("Entries in each query cache", {
+                (('cache', name),): stats['size'] for name, stats in cache_names.items() if 'size' in stats
+            }),
+            'cache_hits_total': ("Cache hits", {(('cache', name),): stats['hits'] for name, stats in cache_names.items()}, 'counter'),
+            'cache_misses_total': ("Cache misses", {(('cache', name),): stats['misses'] for name, stats in cache_names.items()}, 'counter'),
+            'batcher_batches_total': ("Encode batches run", batcher and batcher['batches'], 'counter'),
+            'batcher_queries_total': ("Queries that went through the batcher", batcher and batcher['queries'], 'counter'),
+            'llm_active': ("Generations running per model", {(('model', m),): v['active'] for m, v in llm['models'].items()}),
+            'llm_waiting': ("Summaries waiting for a slot per model", {(('model', m),): v['waiting'] for m, v in llm['models'].items()}),
+            'llm_cap': ("Concurrent generations allowed per model", {(('model', m),): v['cap'] for m, v in llm['models'].items()}),
+            'llm_completed_total': ("Generations finished", llm['completed'], 'counter'),
+            'llm_rejected_total': ("Summaries turned away with a full queue", llm['rejected'], 'counter'),
+            'llm_downgraded_total': ("Summaries moved to a smaller model", llm['downgraded'], 'counter'),
+            'index_reloads_total': ("New index versions swapped in without a restart", reloads['reloads'], 'counter'),
+            'index_reload_failures_total': ("New indexes that failed to open (the old one kept serving)",
+                                            reloads['failures'], 'counter'),
+            'index_retiring': ("Swapped out indexes still finishing requests", reloads['retiring']),
+            'process_resident_memory_bytes': ("Resident memory of the server process", rss),
+            'process_peak_resident_memory_bytes': ("Peak resident memory of the server process", peak),
+        }
+
+    @app.route('/api/metrics', methods=['GET'])
+    def metrics_route():
+        """Prometheus scrape endpoint"""
+        return Response(registry.render(gauges()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
     @app.route('/api/subfolders', methods=['GET'])
     def get_subfolders():
         """Get list of unique subfolders from chunks"""
         try:
-            subfolders = set()
-            
-            for chunk in search_engine.chunks:
-                if isinstance(chunk, dict):
-                    file_path = chunk.get('file', '')
-                    if file_path:
-                        # Extract folder names from path
-                        # Handle both forward and backslashes
-                        parts = file_path.replace('\\', '/').split('/')
-                        
-                        # Add each folder part (excluding the filename)
-                        for i in range(len(parts) - 1):
-                            folder = parts[i]
-                            if folder:  # Skip empty strings
-                                subfolders.add(folder)
-            
-            # Sort subfolders alphabetically
-            sorted_subfolders = sorted(list(subfolders))
+            # the filter index already has every folder from every chunk's path
+            sorted_subfolders = g.search_engine.folders()
             
             return jsonify({
                 'success': True,
@@ -273,6 +1037,12 @@ def main():
             print(f"Error getting subfolders: {e}")
             return jsonify({'error': str(e)}), 500
 
+    return app
+
+
+def main():
+    app = create_app()
+
     # Create static directory if it doesn't exist
     os.makedirs('static', exist_ok=True)
     
@@ -0,0 +1,18 @@
+'''
+End to end benchmarks.
+
+Generates synthetic corpora in the same Data/KSn/<subsystem>/ layout as the real thing
+(a few dozen synthetic pdfs for ingest, and 10k / 100k / 1M chunk stores for everything
+after it), runs every stage with a stand-in embedding model and a fake ollama so no GPU
+or model download is needed, and writes a json report that can be diffed against a saved
+baseline:
+
+    uv run bench --sizes 10k,100k --baseline bench_baseline.json
+    uv run bench --sizes 10k --save-baseline bench_baseline.json
+
+Stages: ingest (pages/s), embed (chunks/s, tokens/s), index (.idx / ANN / quantized /
+lexical build times), quantized (binary / int8 recall@k vs the exact scan, latency, memory),
+startup (engine load time), search (/api/search latency p50/p90/p99, qps, recall),
+summary (/api/search_summarize time to first token against the fake ollama). Every size
+runs in its own process so peak RSS means something.
+'''
@@ -0,0 +1,188 @@
+'''
+Synthetic corpora for the benchmarks, everything seeded so runs are comparable.
+
+    make_store - a documents.jsonl of n chunks straight away (no pdfs), in the same shape the
+                 word chunker writes, for the 10k / 100k / 1M sizes
+    make_pdfs  - a handful of real pdfs for the ingest stage, some with a text layer and
+                 some as page images so the OCR path gets exercised too
+    make_queries - queries cut out of random chunks (so we know which chunk should come
+                 back), some with a ks filter, some acronym / part number lookups
+'''
+import json
+import os
+
+import numpy as np
+
+from .. import chunkStore
+
+SIZES = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000}
+
+CORPUS_VERSION = 1
+
+ks_numbers = [5, 6, 7, 8, 9, 10]
+subsystems = ['Aero', 'Chassis', 'Suspension', 'Powertrain', 'Electrical', 'Accumulator',
+              'Brakes', 'Cooling', 'Composites', 'Business']
+
+base_words = """
+the a of and to in for on with is be by at as this that from it are was or an not will
+car team design rear front wing chassis frame tube weld bolt nut torque spec rule inspection
+test data sensor wire harness connector pin voltage current cell module pack fuse relay
+contactor precharge discharge coolant pump radiator fan motor inverter controller gear chain
+sprocket brake caliper rotor pedal master cylinder line pressure tire wheel hub upright
+bearing spring damper rocker pushrod pullrod arm camber toe caster ride height downforce drag
+carbon fiber layup mold resin cure ply core honeycomb aluminum steel titanium machined printed
+drawing revision approved load case fea stress safety factor mass budget cost report event
+endurance autocross skidpad acceleration efficiency points judges failure analysis root cause
+""".split()
+
+acronyms = ['AIR', 'BSPD', 'ACC', 'IMD', 'TSMS', 'HVD', 'TSAL', 'BMS', 'ECU', 'CAN', 'LV', 'HV',
+            'SES', 'IMP', 'APPS', 'RTDS', 'GLV', 'FEA', 'CFD', 'DFMEA']
+
+part_numbers = ['M4x0.7', 'M5x0.8', 'M6x1.0', 'M8x1.25', 'M10x1.5', 'AN3', 'AN4', '1/4-28', '5/16-24',
+                '6061-T6', '7075-T6', '4130', 'NAS1149', 'MS21042']
+
+
+def vocabulary(seed=0, n_words=5000):
+    """Real-ish words up front (common), then made up syllable words for the long tail"""
+    rng = np.random.default_rng(seed)
+    syllables = ['ka', 'to', 'ri', 'sen', 'mo', 'lar', 'ven', 'dis', 'tor', 'pel', 'qua', 'zin', 'bro', 'chu']
+    made_up = set()
+    while len(made_up) < n_words:
+        made_up.add("".join(rng.choice(syllables, size=rng.integers(2, 5))))
+    words = base_words + acronyms + part_numbers + sorted(made_up)
+    # zipf-ish word frequencies, like real text
+    weights = 1.0 / np.arange(1, len(words) + 1) ** 1.05
+    return np.array(words), weights / weights.sum()
+
+
+def file_path(data_dir, rng, i):
+    ks = rng.choice(ks_numbers)
+    subsystem = rng.choice(subsystems)
+    return os.path.join(data_dir, f"KS{ks}", subsystem, f"doc_{i:06d}.pdf")
+
+
+def make_store(out_dir, n_chunks, seed=0, chunk_words=80, overlap=10, chunks_per_file=200):
+    """
+    Write out_dir/documents.jsonl with n_chunks chunks spread over files in out_dir/Data/KSn/...
+    Skipped if it's already there from the same settings.
+
+    Returns:
+        (store file, whether it had to be generated)
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    store_file = os.path.join(out_dir, chunkStore.chunk_store)
+    meta_file = os.path.join(out_dir, 'corpus.json')
+    meta = {'version': CORPUS_VERSION, 'n_chunks': n_chunks, 'seed': seed, 'chunk_words': chunk_words,
+            'overlap': overlap, 'chunks_per_file': chunks_per_file}
+    try:
+        with open(meta_file, 'r', encoding='utf-8') as f:
+            if json.load(f) == meta and os.path.exists(store_file):
+                return store_file, False
+    except (OSError, ValueError):
+        pass
+
+    words, weights = vocabulary(seed)
+    rng = np.random.default_rng(seed)
+    data_dir = os.path.join(out_dir, 'Data')
+    step = chunk_words - overlap
+
+    open(store_file, 'w').close()
+    written = 0
+    file_number = 0
+    while written < n_chunks:
+        n = min(chunks_per_file, n_chunks - written)
+        file = file_path(data_dir, rng, file_number)
+        # one word stream per file, chunks are overlapping windows of it like split.make_chunks
+        stream = words[rng.choice(len(words), size=(n - 1) * step + chunk_words, p=weights)]
+        chunks = []
+        for chunk_id in range(n):
+            start = chunk_id * step
+            chunks.append({
+                'chunk_id': chunk_id,
+                'start_word': start,
+                'end_word': start + chunk_words - 1,
+                'text': " ".join(stream[start:start + chunk_words]),
+                'file': file,
+                'tokens': chunk_words,
+            })
+        chunkStore.append_chunks(store_file, chunks)
+        written += n
+        file_number += 1
+
+    with open(meta_file, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    return store_file, True
+
+
+def make_queries(store_file, n_queries, seed=0, query_words=6, filter_fraction=0.2, lookup_fraction=0.1):
+    """
+    Returns a list of {'query', 'file', 'chunk_id'}, file/chunk_id being the chunk the query
+    came out of (None for acronym lookups, which don't have one right answer)
+    """
+    rng = np.random.default_rng(seed + 1)
+    total = chunkStore.count_chunks(store_file)
+    picks = set(rng.choice(total, size=min(n_queries, total), replace=False).tolist())
+
+    queries = []
+    row = 0
+    for batch in chunkStore.iter_chunks(store_file, batch_size=4096):
+        for chunk in batch:
+            if row in picks:
+                words = chunk['text'].split()
+                start = int(rng.integers(0, max(1, len(words) - query_words)))
+                query = " ".join(words[start:start + query_words])
+                if rng.random() < filter_fraction:
+                    ks = os.path.normpath(chunk['file']).split(os.sep)[-3].lower()
+                    query = f"{query} {ks}"
+                queries.append({'query': query, 'file': chunk['file'], 'chunk_id': chunk['chunk_id']})
+            row += 1
+
+    rng.shuffle(queries)
+    for i in range(int(len(queries) * lookup_fraction)):
+        lookup = f"{rng.choice(acronyms)} {rng.choice(part_numbers)}"
+        queries[i] = {'query': lookup, 'file': None, 'chunk_id': None}
+    return queries
+
+
+def make_pdfs(out_dir, n_files=12, pages=6, scanned_fraction=0.25, seed=0, words_per_page=350):
+    """
+    Real pdfs under out_dir/Data/KSn/<subsystem>/ for the ingest stage. scanned_fraction of
+    the files get their pages as images only, so they go down the OCR path.
+
+    Returns:
+        List of pdf paths
+    """
+    import pymupdf
+
+    words, weights = vocabulary(seed)
+    data_dir = os.path.join(out_dir, 'Data')
+    files = []
+
+    for i in range(n_files):
+        # an rng per file, so skipping the ones already on disk doesn't change the rest
+        rng = np.random.default_rng([seed + 2, i])
+        path = file_path(data_dir, rng, i)
+        files.append(path)
+        if os.path.exists(path):
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        scanned = rng.random() < scanned_fraction
+
+        doc = pymupdf.open()
+        for page_number in range(pages):
+            title = f"{rng.choice(subsystems)} {rng.choice(acronyms)} section {page_number + 1}"
+            body = " ".join(words[rng.choice(len(words), size=words_per_page, p=weights)])
+
+            source = pymupdf.open() if scanned else doc
+            page = source.new_page()
+            page.insert_text((72, 72), title, fontsize=18)
+            page.insert_textbox(pymupdf.Rect(72, 100, page.rect.width - 72, page.rect.height - 72), body, fontsize=11)
+            if scanned:
+                # flatten to a picture, no text layer left
+                pixmap = page.get_pixmap(dpi=150)
+                doc.new_page().insert_image(doc[-1].rect, pixmap=pixmap)
+                source.close()
+        doc.save(path)
+        doc.close()
+
+    return files
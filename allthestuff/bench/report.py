@@ -0,0 +1,107 @@
+'''
+Benchmark report: saving it, and diffing it against a baseline.
+
+A report is {'meta': {...}, 'results': {job: {stage: {metric: value}}}}. Metrics are
+compared by name: *_per_s / qps / *recall* are better higher, *_ms / seconds / *_mb are
+better lower, anything else (counts, settings) is just shown.
+'''
+import json
+import os
+import platform
+import subprocess
+import time
+
+import numpy as np
+
+
+def meta(settings):
+    """Where and how this report was made, so two reports can be sanity checked before comparing"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'settings': settings,
+    }
+
+
+def save(report, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(f"Saved benchmark report to {path}")
+
+
+def load(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def flatten(report):
+    """{'10k.search.p50_ms': 1.2, ...} for every numeric metric"""
+    flat = {}
+    for job, stages in report.get('results', {}).items():
+        for stage, metrics in stages.items():
+            for name, value in metrics.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    flat[f"{job}.{stage}.{name}"] = value
+    return flat
+
+
+def direction(name):
+    """+1 if bigger is better, -1 if smaller is better, 0 if it's not a performance number"""
+    name = name.rsplit('.', 1)[-1]
+    if 'per_s' in name or name == 'qps' or 'recall' in name:
+        return 1
+    if name.endswith('_ms') or name.endswith('seconds') or name.endswith('_mb'):
+        return -1
+    return 0
+
+
+def compare(current, baseline, tolerance=0.10):
+    """
+    Rows of (metric, baseline, current, relative change, verdict). verdict is 'better' /
+    'worse' when it moved more than tolerance in that direction, else 'same', plus 'new'
+    and 'gone' for metrics only in one of the two.
+    """
+    current = flatten(current)
+    baseline = flatten(baseline)
+    rows = []
+    for name in sorted(set(current) | set(baseline)):
+        if name not in baseline:
+            rows.append((name, None, current[name], None, 'new'))
+            continue
+        if name not in current:
+            rows.append((name, baseline[name], None, None, 'gone'))
+            continue
+        old, new = baseline[name], current[name]
+        change = (new - old) / abs(old) if old else (0.0 if new == old else float('inf'))
+        sign = direction(name)
+        if sign == 0 or abs(change) <= tolerance:
+            verdict = 'same'
+        else:
+            verdict = 'better' if change * sign > 0 else 'worse'
+        rows.append((name, old, new, change, verdict))
+    return rows
+
+
+def print_comparison(rows, only_changes=False):
+    print(f"\n{'metric':50s} {'baseline':>12s} {'current':>12s} {'change':>9s}")
+    for name, old, new, change, verdict in rows:
+        if only_changes and verdict == 'same':
+            continue
+        old_text = f"{old:12.4g}" if old is not None else f"{'-':>12s}"
+        new_text = f"{new:12.4g}" if new is not None else f"{'-':>12s}"
+        change_text = f"{change * 100:+8.1f}%" if change is not None and change != float('inf') else f"{'':>9s}"
+        flag = {'better': '  better', 'worse': '  WORSE', 'new': '  new', 'gone': '  gone'}.get(verdict, '')
+        print(f"{name[-50:]:50s} {old_text} {new_text} {change_text}{flag}")
+    worse = sum(1 for row in rows if row[4] == 'worse')
+    better = sum(1 for row in rows if row[4] == 'better')
+    print(f"\n{better} better, {worse} worse\n")
+    return worse
@@ -0,0 +1,476 @@
+'''
+Runs the benchmark stages. Each job (the ingest run, and each corpus size) runs in its own
+python process so its peak RSS is its own, the parent just collects their results into
+one report and compares it against the baseline.
+'''
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+from . import corpus
+from . import report
+from . import standins
+from .. import chunkStore
+from .. import searchIndex
+
+STAGES = ('ingest', 'embed', 'index', 'quantized', 'startup', 'search', 'summary')
+
+
+def rss_mb():
+    """Current resident set size, None if this OS can't tell us"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    """None on windows, the report just leaves it out"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports KB, macOS bytes
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def latency_stats(seconds, prefix=''):
+    ms = np.asarray(seconds) * 1000.0
+    if len(ms) == 0:
+        return {}
+    return {
+        f'{prefix}p50_ms': float(np.percentile(ms, 50)),
+        f'{prefix}p90_ms': float(np.percentile(ms, 90)),
+        f'{prefix}p99_ms': float(np.percentile(ms, 99)),
+        f'{prefix}mean_ms': float(ms.mean()),
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# -----------------------------
+# Stages
+# -----------------------------
+def stage_ingest(config, model):
+    """Synthetic pdfs through the real streaming pipeline (extraction + chunking + embedding)"""
+    from .. import pipeline
+
+    work = os.path.join(config['dir'], 'ingest')
+    files = corpus.make_pdfs(work, config['pdfs'], config['pages'], config['scanned_fraction'], config['seed'])
+    store_file = os.path.join(work, chunkStore.chunk_store)
+    open(store_file, 'w').close()
+
+    start = time.perf_counter()
+    chunks, _ = pipeline.run(files, store_file=store_file, workers=config['workers'], model=model,
+                             report_file=os.path.join(work, 'ingest_report.json'), use_cache=False)
+    elapsed = time.perf_counter() - start
+
+    pages = len(files) * config['pages']
+    return {
+        'seconds': elapsed,
+        'files': len(files),
+        'pages': pages,
+        'pages_per_s': pages / elapsed,
+        'chunks': len(chunks),
+        'chunks_per_s': len(chunks) / elapsed,
+    }
+
+
+def stage_embed(store_file, output_prefix, model, config):
+    """Every chunk in the store through generate_Embeddings, into the index .npy"""
+    from .. import generateEmbeddings
+
+    total = chunkStore.count_chunks(store_file)
+    tmp_file = f'{output_prefix}_embeddings.tmp.npy'
+    embeddings = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32,
+                                           shape=(total, model.get_sentence_embedding_dimension()))
+    row = 0
+    tokens = 0
+    start = time.perf_counter()
+    for batch in chunkStore.iter_chunks(store_file, batch_size=config['embed_batch']):
+        batch_embeddings = generateEmbeddings.generate_Embeddings(batch, model=model, show_progress_bar=False)
+        embeddings[row:row + len(batch)] = searchIndex.normalize_embeddings(batch_embeddings)
+        row += len(batch)
+        tokens += sum(chunk.get('tokens', 0) for chunk in batch)
+    elapsed = time.perf_counter() - start
+
+    embeddings.flush()
+    del embeddings
+    os.replace(tmp_file, f'{output_prefix}_embeddings.npy')
+    return {
+        'seconds': elapsed,
+        'chunks': total,
+        'chunks_per_s': total / elapsed,
+        'tokens_per_s': tokens / elapsed,
+    }
+
+
+def stage_index(store_file, output_prefix):
+    """Everything ingest builds on top of the embeddings: chunks json, .idx, ANN, lexical"""
+    from .. import generateEmbeddings
+
+    def stream():
+        return (chunk for batch in chunkStore.iter_chunks(store_file, batch_size=4096) for chunk in batch)
+
+    timings = {}
+    start = time.perf_counter()
+    chunkStore.export_json(store_file, f'{output_prefix}_chunks.json')
+    timings['chunks_json_seconds'] = time.perf_counter() - start
+
+    step = time.perf_counter()
+    generateEmbeddings.build_Index_File(stream(), output_prefix)
+    timings['idx_seconds'] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    generateEmbeddings.build_Ann(output_prefix)
+    timings['ann_seconds'] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    generateEmbeddings.build_Quantized(output_prefix)
+    timings['quantized_seconds'] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    generateEmbeddings.build_Lexical(stream(), output_prefix)
+    timings['lexical_seconds'] = time.perf_counter() - step
+
+    timings['seconds'] = time.perf_counter() - start
+    timings['idx_megabytes'] = os.path.getsize(f'{output_prefix}.idx') / 1024 / 1024
+    return timings
+
+
+def stage_quantized(output_prefix, model, queries, config):
+    """
+    binary / int8 first pass + rescore against the exact scan, on the real query set: recall@k,
+    latency and how much memory the codes take compared to the floats
+    """
+    from .. import annIndex
+
+    top_k = config['top_k']
+    embeddings = np.load(f'{output_prefix}_embeddings.npy', mmap_mode='r')
+    query_embeddings = searchIndex.normalize_embeddings(model.encode([query['query'] for query in queries]))
+    exact = annIndex.ExactIndex(np.asarray(embeddings))
+    truth = exact.search_many(query_embeddings, top_k)
+
+    metrics = {'float_mb': embeddings.nbytes / 1024 / 1024}
+    for backend in ('binary', 'int8'):
+        index = annIndex.load(embeddings, backend, output_prefix)
+        if index.name != backend:
+            continue
+        start = time.perf_counter()
+        hits = [index.search(query, top_k) for query in query_embeddings]
+        elapsed = time.perf_counter() - start
+        found = sum(len(np.intersect1d(rows, expected)) for (rows, _), (expected, _) in zip(hits, truth))
+        metrics[f'{backend}_recall_at_{top_k}'] = found / max(1, sum(len(expected) for expected, _ in truth))
+        metrics[f'{backend}_mean_ms'] = 1000 * elapsed / len(query_embeddings)
+        metrics[f'{backend}_mb'] = index.memory_bytes() / 1024 / 1024
+
+    start = time.perf_counter()
+    for query in query_embeddings:
+        exact.search(query, top_k)
+    metrics['exact_mean_ms'] = 1000 * (time.perf_counter() - start) / len(query_embeddings)
+    return metrics
+
+
+def stage_startup(model):
+    from .. import app as server
+
+    before = rss_mb()
+    start = time.perf_counter()
+    engine = server.SemanticSearchEngine(model=model)
+    elapsed = time.perf_counter() - start
+    after = rss_mb()
+    return {'seconds': elapsed, 'rss_mb': after,
+            'engine_rss_mb': after - before if after is not None and before is not None else None}, engine
+
+
+def stage_search(flask_app, queries, config):
+    """/api/search one at a time (latency), the same again (result cache), then concurrently (throughput)"""
+    top_k = config['top_k']
+
+    def one(query):
+        client = flask_app.test_client()
+        start = time.perf_counter()
+        response = client.post('/api/search', json={'query': query['query'], 'top_k': top_k, 'threshold': 0.0})
+        elapsed = time.perf_counter() - start
+        results = response.get_json().get('results', [])
+        hit = None
+        if query['file'] is not None:
+            hit = any(result['chunk'].get('file') == query['file'] and result['chunk'].get('chunk_id') == query['chunk_id']
+                      for result in results)
+        return elapsed, hit
+
+    half = len(queries) // 2
+    sequential, concurrent = queries[:half], queries[half:]
+
+    for query in sequential[:10]:  # warm up, these get cached so they're skipped below
+        one(query)
+    sequential = sequential[10:]
+
+    timings = [one(query) for query in sequential]
+    latencies = [t for t, _ in timings]
+    hits = [hit for _, hit in timings if hit is not None]
+    metrics = {'queries': len(sequential), **latency_stats(latencies)}
+    metrics[f'recall_at_{top_k}'] = float(np.mean(hits)) if hits else 0.0
+
+    cached = [one(query)[0] for query in sequential[:100]]
+    metrics.update(latency_stats(cached, 'cached_'))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(config['concurrency']) as pool:
+        concurrent_timings = list(pool.map(one, concurrent))
+    elapsed = time.perf_counter() - start
+    metrics.update(latency_stats([t for t, _ in concurrent_timings], 'concurrent_'))
+    metrics['concurrency'] = config['concurrency']
+    metrics['qps'] = len(concurrent) / elapsed if elapsed else 0.0
+    return metrics
+
+
+def stage_summary(flask_app, queries, config):
+    """/api/search_summarize against the fake ollama, all at once so the scheduler has to queue them"""
+    def one(query):
+        client = flask_app.test_client()
+        start = time.perf_counter()
+        response = client.post('/api/search_summarize', buffered=False, json={
+            'query': query['query'], 'top_k': config['top_k'], 'threshold': 0.0,
+            'model': 'summaryModelMedium:latest', 'bypass_cache': True,
+        })
+        first_result = first_token = None
+        for piece in response.iter_encoded():
+            now = time.perf_counter() - start
+            if first_result is None and b'"type": "results"' in piece:
+                first_result = now
+            if first_token is None and b'"type": "content"' in piece:
+                first_token = now
+        return first_result, first_token, time.perf_counter() - start
+
+    requests = queries[:config['summary_requests']]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(len(requests) or 1) as pool:
+        timings = list(pool.map(one, requests))
+    elapsed = time.perf_counter() - start
+
+    llm = flask_app.test_client().get('/api/health').get_json().get('llm', {})
+    return {
+        'requests': len(requests),
+        **latency_stats([t[0] for t in timings if t[0] is not None], 'results_'),
+        **latency_stats([t[1] for t in timings if t[1] is not None], 'first_token_'),
+        **latency_stats([t[2] for t in timings], 'total_'),
+        'summaries_per_s': len(requests) / elapsed if elapsed else 0.0,
+        'completed': sum(1 for t in timings if t[1] is not None),
+        'downgraded': llm.get('downgraded', 0),
+        'rejected': llm.get('rejected', 0),
+    }
+
+
+# -----------------------------
+# Jobs
+# -----------------------------
+def run_stage(results, name, fn, *args):
+    print(f"\n=== {name} ===")
+    try:
+        out = fn(*args)
+    except Exception as e:
+        traceback.print_exc()
+        results[name] = {'error': repr(e)}
+        return None
+    metrics = out[0] if isinstance(out, tuple) else out
+    results[name] = metrics
+    print(json.dumps(metrics, indent=2))
+    return out
+
+
+def run_job(job, config):
+    """One job in this process: 'ingest' or a corpus size name. Returns {stage: metrics}"""
+    model = standins.StandInModel(dim=config['dim'], seed=config['seed'])
+    stages = config['stages']
+    results = {}
+
+    if job == 'ingest':
+        run_stage(results, 'ingest', stage_ingest, config, model)
+        results['process'] = {'peak_rss_mb': peak_rss_mb()}
+        return results
+
+    n_chunks = corpus.SIZES.get(job) or int(job)
+    size_dir = os.path.join(config['dir'], job)
+    print(f"Preparing {n_chunks} chunk corpus in {size_dir}...")
+    store_file, generated = corpus.make_store(size_dir, n_chunks, seed=config['seed'])
+    results['corpus'] = {
+        'chunks': n_chunks,
+        'generated': generated,
+        'store_megabytes': os.path.getsize(store_file) / 1024 / 1024,
+    }
+
+    # everything from here on uses the default relative paths, same as running the server
+    os.chdir(size_dir)
+    store_file = chunkStore.chunk_store
+    output_prefix = 'search_index'
+    serving = any(stage in stages for stage in ('startup', 'search', 'summary'))
+    needs_index = serving or 'quantized' in stages
+    have_index = os.path.exists(f'{output_prefix}.idx')
+
+    # the server stages need an index even when embed/index themselves aren't being measured
+    scratch = {}
+    if 'embed' in stages or (needs_index and not have_index):
+        run_stage(results if 'embed' in stages else scratch, 'embed', stage_embed, store_file, output_prefix, model, config)
+    if 'index' in stages or (needs_index and not have_index):
+        run_stage(results if 'index' in stages else scratch, 'index', stage_index, store_file, output_prefix)
+
+    queries = None
+    if 'quantized' in stages or serving:
+        queries = corpus.make_queries(store_file, config['queries'], seed=config['seed'])
+    if 'quantized' in stages:
+        run_stage(results, 'quantized', stage_quantized, output_prefix, model, queries, config)
+
+    if serving:
+        from .. import app as server
+        from .. import fakeOllama
+
+        # the scheduler picks OLLAMA_HOST up when the app is created
+        os.environ['OLLAMA_HOST'] = fakeOllama.serve(free_port(), delay=config['ollama_delay'],
+                                                     first_token_delay=config['ollama_first_token_delay'])
+
+        out = run_stage(results, 'startup', stage_startup, model)
+        if out is not None:
+            # nothing rebuilds the index mid-run, no need for the reload watcher
+            flask_app = server.create_app(out[1], watch_seconds=None)
+            if 'search' in stages:
+                run_stage(results, 'search', stage_search, flask_app, queries, config)
+            if 'summary' in stages:
+                run_stage(results, 'summary', stage_summary, flask_app, queries, config)
+        if 'startup' not in stages:
+            results.pop('startup', None)
+
+    results['process'] = {'peak_rss_mb': peak_rss_mb()}
+    return results
+
+
+def run_child(job, config):
+    """Run job in a fresh interpreter, returns its results"""
+    package_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = package_root + os.pathsep + env.get('PYTHONPATH', '')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config_file = os.path.join(tmp, 'config.json')
+        out_file = os.path.join(tmp, 'out.json')
+        with open(config_file, 'w', encoding='utf-8') as f:
+            json.dump(config, f)
+        completed = subprocess.run([sys.executable, '-m', 'allthestuff.bench', '--job', job,
+                                    '--job-config', config_file, '--job-out', out_file], env=env)
+        if completed.returncode != 0 or not os.path.exists(out_file):
+            return {'error': {'returncode': completed.returncode}}
+        with open(out_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end benchmarks on synthetic data")
+    parser.add_argument('--sizes', default='10k', help="comma separated corpus sizes: 10k, 100k, 1m or a chunk count")
+    parser.add_argument('--stages', default=','.join(STAGES), help=f"comma separated, any of {','.join(STAGES)}")
+    parser.add_argument('--dir', default='bench_data', help="where generated corpora and indexes live (reused between runs)")
+    parser.add_argument('--out', default='bench_report.json')
+    parser.add_argument('--baseline', help="report to compare against")
+    parser.add_argument('--save-baseline', help="also save this run as the baseline at this path")
+    parser.add_argument('--tolerance', type=float, default=0.10, help="relative change that counts as better/worse")
+    parser.add_argument('--fail-on-regression', action='store_true', help="exit 1 if anything got worse")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dim', type=int, default=256, help="stand-in model embedding size")
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--top-k', type=int, default=6)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--summary-requests', type=int, default=16)
+    parser.add_argument('--ollama-delay', type=float, default=0.01, help="fake ollama seconds per word")
+    parser.add_argument('--ollama-first-token-delay', type=float, default=0.2)
+    parser.add_argument('--embed-batch', type=int, default=8192)
+    parser.add_argument('--pdfs', type=int, default=12)
+    parser.add_argument('--pages', type=int, default=6)
+    parser.add_argument('--scanned-fraction', type=float, default=0.25)
+    parser.add_argument('--workers', type=int, default=None, help="ingest extraction workers")
+    parser.add_argument('--in-process', action='store_true', help="don't spawn a process per job (peak RSS gets shared)")
+    # used by run_child
+    parser.add_argument('--job', help=argparse.SUPPRESS)
+    parser.add_argument('--job-config', help=argparse.SUPPRESS)
+    parser.add_argument('--job-out', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.job:
+        with open(args.job_config, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        results = run_job(args.job, config)
+        with open(args.job_out, 'w', encoding='utf-8') as f:
+            json.dump(results, f)
+        return
+
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stage(s) {sorted(unknown)}")
+
+    config = {
+        'dir': os.path.abspath(args.dir),
+        'stages': stages,
+        'seed': args.seed,
+        'dim': args.dim,
+        'queries': args.queries,
+        'top_k': args.top_k,
+        'concurrency': args.concurrency,
+        'summary_requests': args.summary_requests,
+        'ollama_delay': args.ollama_delay,
+        'ollama_first_token_delay': args.ollama_first_token_delay,
+        'embed_batch': args.embed_batch,
+        'pdfs': args.pdfs,
+        'pages': args.pages,
+        'scanned_fraction': args.scanned_fraction,
+        'workers': args.workers,
+    }
+    jobs = (['ingest'] if 'ingest' in stages else []) + [size.strip().lower() for size in args.sizes.split(',') if size.strip()]
+
+    results = {}
+    cwd = os.getcwd()
+    for job in jobs:
+        print(f"\n##### {job} #####")
+        if args.in_process:
+            results[job] = run_job(job, config)
+            os.chdir(cwd)
+        else:
+            results[job] = run_child(job, config)
+
+    full = {'meta': report.meta(config), 'results': results}
+    report.save(full, args.out)
+
+    worse = 0
+    if args.baseline:
+        if os.path.exists(args.baseline):
+            baseline = report.load(args.baseline)
+            print(f"Comparing against {args.baseline} (commit {baseline.get('meta', {}).get('commit')})")
+            worse = report.print_comparison(report.compare(full, baseline, args.tolerance))
+        else:
+            print(f"No baseline at {args.baseline} yet")
+
+    if args.save_baseline:
+        report.save(full, args.save_baseline)
+
+    if args.fail_on_regression and worse:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
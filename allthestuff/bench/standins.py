@@ -0,0 +1,56 @@
+'''
+Stand-in embedding model for benchmarks.
+
+Looks like a SentenceTransformer to everything that uses one (encode, tokenizer,
+max_seq_length, get_sentence_embedding_dimension) but is just hashed bag-of-words through
+a fixed random projection, so it's deterministic, needs no download and runs anywhere.
+Texts that share words end up close together, which is enough for recall numbers to mean
+something.
+'''
+import zlib
+
+import numpy as np
+
+
+class StandInTokenizer:
+    """Whitespace "tokenizer", one token per word, ids are crc32 hashes"""
+
+    def __init__(self, vocab_size=1 << 15):
+        self.vocab_size = vocab_size
+
+    def ids(self, text):
+        return [zlib.crc32(word.encode('utf-8')) % self.vocab_size for word in text.lower().split()]
+
+    def __call__(self, texts, add_special_tokens=False, **kwargs):
+        if isinstance(texts, str):
+            return {'input_ids': self.ids(texts)}
+        return {'input_ids': [self.ids(text) for text in texts]}
+
+
+class StandInModel:
+    def __init__(self, dim=256, vocab_size=1 << 15, max_seq_length=512, seed=0):
+        self.dim = dim
+        self.max_seq_length = max_seq_length
+        self.tokenizer = StandInTokenizer(vocab_size)
+        rng = np.random.default_rng(seed)
+        self.projection = rng.standard_normal((vocab_size, dim)).astype(np.float32)
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, convert_to_numpy=True, **kwargs):
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+
+        ids = [self.tokenizer.ids(text)[:self.max_seq_length] for text in sentences]
+        lengths = np.array([len(row) for row in ids], dtype=np.int64)
+        embeddings = np.zeros((len(sentences), self.dim), dtype=np.float32)
+
+        nonempty = lengths > 0
+        if nonempty.any():
+            flat = np.fromiter((i for row in ids for i in row), dtype=np.int64, count=int(lengths.sum()))
+            offsets = np.concatenate([[0], np.cumsum(lengths[nonempty])[:-1]])
+            embeddings[nonempty] = np.add.reduceat(self.projection[flat], offsets, axis=0)
+
+        return embeddings[0] if single else embeddings
@@ -0,0 +1,110 @@
+'''
+Append-only chunk store. One JSON object per line (JSONL) so adding a file's chunks
+is just an append instead of loading and rewriting the whole thing every time, and
+readers can stream it in batches without holding the whole corpus in memory.
+'''
+import json
+import os
+
+chunk_store = "documents.jsonl"
+legacy_JSON = "documents.json"
+
+
+def append_chunks(store_file, chunks):
+    """Append chunks to the end of the store, O(chunks) no matter how big the store is"""
+    with open(store_file, "a", encoding="utf-8") as f:
+        for chunk in chunks:
+            f.write(json.dumps(chunk, ensure_ascii=False))
+            f.write("\n")
+
+
+def iter_chunks(store_file, batch_size=1024, files=None):
+    """
+    Lazily read the store
+
+    Args:
+        store_file: path to the .jsonl store
+        batch_size: chunks per yielded list
+        files: only yield chunks from these files, None for everything
+
+    Yields:
+        Lists of up to batch_size chunk dicts, in store order
+    """
+    if not os.path.exists(store_file):
+        return
+
+    if files is not None:
+        files = set(files)
+
+    batch = []
+    with open(store_file, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if files is not None and chunk.get("file") not in files:
+                continue
+            batch.append(chunk)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def count_chunks(store_file, files=None):
+    return sum(len(batch) for batch in iter_chunks(store_file, files=files))
+
+
+def compact(store_file, drop_files=()):
+    """
+    Rewrite the store without any chunks from drop_files (changed or deleted since
+    the last ingest). Streams through a temp file so it never loads the whole store.
+    """
+    if not os.path.exists(store_file):
+        return
+
+    drop_files = set(drop_files)
+    tmp_file = store_file + ".tmp"
+    dropped = 0
+    with open(store_file, "r", encoding="utf-8") as src, open(tmp_file, "w", encoding="utf-8") as dst:
+        for line in src:
+            if not line.strip():
+                continue
+            if drop_files and json.loads(line).get("file") in drop_files:
+                dropped += 1
+                continue
+            dst.write(line)
+    os.replace(tmp_file, store_file)
+
+    if dropped:
+        print(f"Compacted {store_file}: dropped {dropped} chunks")
+
+
+def export_json(store_file, json_file, files=None):
+    """Stream the store out as a plain JSON array (what search_index_chunks.json expects)"""
+    tmp_file = json_file + ".tmp"
+    count = 0
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        f.write("[\n")
+        for batch in iter_chunks(store_file, files=files):
+            for chunk in batch:
+                if count:
+                    f.write(",\n")
+                f.write(json.dumps(chunk, ensure_ascii=False))
+                count += 1
+        f.write("\n]\n")
+    os.replace(tmp_file, json_file)
+    return count
+
+
+def migrate_json(json_file=legacy_JSON, store_file=chunk_store):
+    """One time conversion of an old documents.json into the jsonl store"""
+    if os.path.exists(store_file) or not os.path.exists(json_file) or os.path.getsize(json_file) == 0:
+        return
+
+    print(f"Migrating {json_file} -> {store_file}...")
+    with open(json_file, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    append_chunks(store_file, data)
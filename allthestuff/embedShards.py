@@ -0,0 +1,183 @@
+'''
+Multi-process, resumable embedding of the whole chunk store.
+
+Embedding everything in one process kept every vector in memory until the single .npy got
+written at the very end, so a crash at 90% threw away hours of CPU time. This cuts the
+store into fixed-size shards (shard_size chunks each, in store order) and hands them out
+to N worker processes, each with its own model and its share of the cores. Every finished
+shard is written to shard_dir as a .npy plus a small .json completion marker, and the
+marker is only written once the .npy is safely on disk.
+
+Each shard's marker records a key made from the model name and the text of its chunks, so
+a rerun skips every shard whose marker still matches and only redoes the missing/stale
+ones. Once every shard is done, merge() stitches them into search_index_embeddings.npy
+and the rest of the index gets built from that like before.
+'''
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+from . import chunkStore
+from . import searchIndex
+
+shard_dir = "embed_shards"
+shard_size = 4096
+
+_model = None
+
+
+def shard_key(chunks, model_name):
+    """Changes whenever anything about what this shard would embed changes"""
+    digest = hashlib.sha256(model_name.encode('utf-8'))
+    for chunk in chunks:
+        digest.update(b'\0')
+        digest.update(chunk['text'].encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _paths(shard, shard_dir):
+    name = os.path.join(shard_dir, f'shard_{shard:05d}')
+    return name + '.npy', name + '.json'
+
+
+def shard_done(shard, key, shard_dir=shard_dir):
+    """Does this shard already have a finished .npy for exactly these chunks?"""
+    npy_path, marker_path = _paths(shard, shard_dir)
+    try:
+        with open(marker_path, 'r', encoding='utf-8') as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return marker.get('key') == key and os.path.exists(npy_path)
+
+
+def _init_worker(model_name, threads):
+    # one model per worker process, and split the cores so they don't fight over them
+    global _model
+    import torch
+    from sentence_transformers import SentenceTransformer
+    torch.set_num_threads(threads)
+    _model = SentenceTransformer(model_name)
+
+
+def embed_shard(args):
+    """
+    Worker function for the shard pool.
+    args: (shard number, chunks, key, shard_dir)
+    Returns: (shard number, rows, seconds)
+    """
+    from . import generateEmbeddings
+
+    shard, chunks, key, shard_dir = args
+    start = time.perf_counter()
+    embeddings = generateEmbeddings.generate_Embeddings(chunks, model=_model, show_progress_bar=False)
+    embeddings = searchIndex.normalize_embeddings(embeddings)
+
+    npy_path, marker_path = _paths(shard, shard_dir)
+    tmp_path = npy_path[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_path, embeddings)
+    os.replace(tmp_path, npy_path)
+
+    elapsed = time.perf_counter() - start
+    # marker goes last, if we die before this the shard just gets redone
+    with open(marker_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'key': key, 'rows': len(chunks), 'dim': int(embeddings.shape[1]), 'seconds': elapsed}, f)
+    os.replace(marker_path + '.tmp', marker_path)
+    return shard, len(chunks), elapsed
+
+
+def embed_store(store_file=chunkStore.chunk_store, shard_dir=shard_dir, workers=None, shard_size=shard_size,
+                model_name='Qwen/Qwen3-Embedding-0.6B', max_inflight=None):
+    """
+    Embed every chunk in the store into shard files, skipping shards that are already done
+
+    Args:
+        workers: embedding processes (defaults to 1 per 4 cores, each model wants a few threads)
+        shard_size: chunks per shard, changing it invalidates every existing shard
+        max_inflight: shards read out of the store but not written yet (defaults to 2 per worker)
+
+    Returns:
+        Number of shards the store was cut into
+    """
+    workers = workers or max(1, cpu_count() // 4)
+    max_inflight = max_inflight or 2 * workers
+    threads = max(1, cpu_count() // workers)
+    os.makedirs(shard_dir, exist_ok=True)
+
+    total = chunkStore.count_chunks(store_file)
+    n_shards = -(-total // shard_size)
+    print(f"{total} chunks -> {n_shards} shard(s) of {shard_size}, {workers} worker(s) x {threads} thread(s)")
+
+    inflight = threading.BoundedSemaphore(max_inflight)
+    lock = threading.Lock()
+    stats = {'done': 0, 'skipped': 0, 'rows': 0, 'failed': []}
+    start = time.perf_counter()
+
+    def finished(result):
+        shard, rows, seconds = result
+        with lock:
+            stats['done'] += 1
+            stats['rows'] += rows
+            elapsed = time.perf_counter() - start
+            print(f"Shard {shard} done in {seconds:.1f}s ({stats['done'] + stats['skipped']}/{n_shards}, "
+                  f"{stats['rows'] / elapsed:.1f} chunks/s)")
+        inflight.release()
+
+    def failed(e):
+        with lock:
+            stats['failed'].append(e)
+        print(f"Shard failed: {repr(e)}")
+        inflight.release()
+
+    with Pool(workers, initializer=_init_worker, initargs=(model_name, threads)) as pool:
+        for shard, chunks in enumerate(chunkStore.iter_chunks(store_file, batch_size=shard_size)):
+            key = shard_key(chunks, model_name)
+            if shard_done(shard, key, shard_dir):
+                stats['skipped'] += 1
+                continue
+            # don't read the whole store into the pool's task queue
+            inflight.acquire()
+            pool.apply_async(embed_shard, ((shard, chunks, key, shard_dir),),
+                             callback=finished, error_callback=failed)
+        pool.close()
+        pool.join()
+
+    print(f"{stats['done']} shard(s) embedded, {stats['skipped']} already done")
+    if stats['failed']:
+        raise RuntimeError(f"{len(stats['failed'])} shard(s) failed, rerun to retry just those") from stats['failed'][0]
+    return n_shards
+
+
+def merge(n_shards, output_file, shard_dir=shard_dir):
+    """Stitch shard_00000..shard_{n_shards-1} into one .npy, written to a tmp file then swapped in"""
+    markers = []
+    for shard in range(n_shards):
+        npy_path, marker_path = _paths(shard, shard_dir)
+        if not os.path.exists(npy_path) or not os.path.exists(marker_path):
+            raise FileNotFoundError(f"Shard {shard} isn't finished, run embed_store again")
+        with open(marker_path, 'r', encoding='utf-8') as f:
+            markers.append(json.load(f))
+
+    total = sum(marker['rows'] for marker in markers)
+    dim = markers[0]['dim'] if markers else 0
+    tmp_file = output_file[:-len('.npy')] + '.tmp.npy'
+    merged = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=(total, dim))
+    row = 0
+    for shard, marker in enumerate(markers):
+        shard_embeddings = np.load(_paths(shard, shard_dir)[0], mmap_mode='r')
+        merged[row:row + len(shard_embeddings)] = shard_embeddings
+        row += len(shard_embeddings)
+    merged.flush()
+    del merged
+    os.replace(tmp_file, output_file)
+    print(f"Merged {n_shards} shard(s), {total} rows -> {output_file}")
+
+
+def clear(shard_dir=shard_dir):
+    shutil.rmtree(shard_dir, ignore_errors=True)
@@ -0,0 +1,111 @@
+'''
+Coalesces searches from concurrent requests into one batch.
+
+Flask handles each request on its own thread, and when a bunch of people search at once
+their SentenceTransformer forward passes just queue up behind each other. Instead, each
+request drops its query in here and waits; a single worker thread collects whatever
+arrives within window_ms (or until max_batch queries are waiting) and hands the whole
+batch to process_fn (the engine encodes them in one model.encode call and scores them
+with one matrix-matrix product), then gives each request its own result back.
+'''
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class EncodeBatcher:
+    def __init__(self, process_fn, window_ms=5.0, max_batch=32):
+        """
+        Args:
+            process_fn: takes a list of queued items, returns a list of results in the same order
+            window_ms: how long to wait for more queries after the first one shows up
+            max_batch: process as soon as this many queries are waiting
+        """
+        self.process_fn = process_fn
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self.batches = 0
+        self.encoded = 0
+        self._queue = queue.Queue()
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name='encode-batcher', daemon=True)
+        self._worker.start()
+
+    def submit(self, item):
+        """Queue one item, returns a Future that resolves to its result"""
+        future = Future()
+        # checked under the lock so nothing can slip in after stop() has emptied the queue
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("Encode batcher has been stopped")
+            self._queue.put((item, future))
+        return future
+
+    def run(self, item):
+        """Blocking version of submit, batched with anyone else searching right now"""
+        return self.submit(item).result()
+
+    def stop(self):
+        """Stop the worker. Anything still waiting in the queue fails instead of waiting forever"""
+        with self._lock:
+            self._stopped = True
+        self._fail_queued()
+        self._queue.put(None)
+
+    def _fail_queued(self):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                item[1].set_exception(RuntimeError("Encode batcher was stopped before this got run"))
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'queries': self.encoded,
+            'avg_batch': self.encoded / self.batches if self.batches else 0.0,
+            'window_ms': self.window * 1000.0,
+            'max_batch': self.max_batch,
+        }
+
+    def _run(self):
+        while not self._stopped:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+
+            # keep collecting until the window closes or the batch is full
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._stopped = True
+                    break
+                batch.append(item)
+
+            items = [item for item, _ in batch]
+            try:
+                results = self.process_fn(items)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.encoded += len(batch)
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+        # anything that got queued while the last batch was running
+        self._fail_queued()
@@ -0,0 +1,108 @@
+'''
+On-disk cache of extracted text.
+
+OCR is by far the slowest part of ingest and the extracted text only depends on the pdf
+itself and the extraction settings, not on chunk_size/overlap or the embedding model.
+So every file's text gets saved here (gzipped json), keyed by the file's content hash
+plus the extraction mode and dpi settings, and re-chunking / re-embedding experiments
+("uv run ingest --full") start from cached text in seconds instead of hours.
+
+Prune it with "python -m allthestuff.extractCache --max-age-days 30 --max-mb 2000".
+'''
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import time
+
+cache_dir = "extract_cache"
+
+# old entries older than this or past this total size get pruned at the end of ingest
+default_max_age_days = 90
+default_max_mb = 5000
+
+
+def cache_key(content_hash, mode, **settings):
+    """Key for one file's extraction: its content hash + everything that changes the output"""
+    payload = json.dumps({'hash': content_hash, 'mode': mode, **settings}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _path(key, cache_dir):
+    # two level fan-out so one folder doesn't end up with thousands of files
+    return os.path.join(cache_dir, key[:2], key + '.json.gz')
+
+
+def get(key, cache_dir=cache_dir):
+    path = _path(key, cache_dir)
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            value = json.load(f)
+    except (OSError, EOFError, ValueError):
+        return None
+    # bump mtime so pruning by age throws out the stuff nobody's using
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return value
+
+
+def put(key, value, cache_dir=cache_dir):
+    path = _path(key, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=6) as f:
+        json.dump(value, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def prune(cache_dir=cache_dir, max_age_days=None, max_mb=None):
+    """
+    Delete entries older than max_age_days, then the least recently used ones until the
+    cache is under max_mb. Returns (files removed, bytes freed).
+    """
+    if not os.path.isdir(cache_dir):
+        return 0, 0
+
+    entries = []
+    for root, _, names in os.walk(cache_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()  # oldest first
+
+    removed = 0
+    freed = 0
+    total = sum(size for _, size, _ in entries)
+    cutoff = time.time() - max_age_days * 86400 if max_age_days is not None else None
+    max_bytes = max_mb * 1024 * 1024 if max_mb is not None else None
+
+    for mtime, size, path in entries:
+        too_old = cutoff is not None and mtime < cutoff
+        too_big = max_bytes is not None and total > max_bytes
+        if not too_old and not too_big:
+            break
+        os.remove(path)
+        removed += 1
+        freed += size
+        total -= size
+
+    if removed:
+        print(f"Pruned {removed} extraction cache entries ({freed / 1024 / 1024:.1f} MB)")
+    return removed, freed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prune the extraction cache")
+    parser.add_argument('--dir', default=cache_dir)
+    parser.add_argument('--max-age-days', type=float, default=default_max_age_days)
+    parser.add_argument('--max-mb', type=float, default=default_max_mb)
+    args = parser.parse_args()
+    prune(args.dir, args.max_age_days, args.max_mb)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,15 @@ import filetype
 from pdf2image.pdf2image import pdfinfo_from_path
 from multiprocessing import Pool, cpu_count
 from tqdm import tqdm
+import pymupdf
 import pymupdf4llm
 import pymupdf4llm.helpers.document_layout as dl
 import os
+from . import extractCache
+from . import manifest
+
+# bump this whenever extraction logic changes so old cache entries stop matching
+EXTRACTOR_VERSION = 3
 
 # -----------------------------
 # Safety Patch for pymupdf4llm
@@ -52,17 +58,143 @@ def ocr_page(args):
         return page_number, f"[ERROR page {page_number}: {repr(e)}]"
 
 
+# -----------------------------
+# Per-page hybrid extraction (text layer first, OCR only when needed)
+# -----------------------------
+def page_count(file):
+    info = pdfinfo_from_path(file)
+    return info.get("Pages", 0)
+
+
+def text_layer_ok(text, min_chars=20, min_clean_ratio=0.85):
+    """
+    Is this page's embedded text actually usable?
+    Empty/near empty means it's a scan, and a lot of junk characters (unicode replacement
+    chars, private use glyphs from broken font encodings) means it's garbled.
+    """
+    chars = "".join(text.split())
+    if len(chars) < min_chars:
+        return False
+    clean = sum(1 for ch in chars if ch.isprintable() and ch != "\ufffd" and not 0xE000 <= ord(ch) <= 0xF8FF)
+    return clean / len(chars) >= min_clean_ratio
+
+
+def read_text_layer(file, page_number):
+    with pymupdf.open(file) as doc:
+        return doc[page_number - 1].get_text()
+
+
+def ocr_page_with_confidence(file, page_number, dpi):
+    """
+    OCR one page and also return tesseract's mean word confidence (0-100)
+    Returns: (text, confidence)
+    """
+    imgs = convert_from_path(file, dpi=dpi, first_page=page_number, last_page=page_number, fmt='ppm')
+    if not imgs:
+        raise RuntimeError("no image produced")
+
+    data = pytesseract.image_to_data(imgs[0], output_type=pytesseract.Output.DICT)
+
+    # put the words back into lines/paragraphs the same way image_to_string would
+    lines = {}
+    confidences = []
+    for i, word in enumerate(data['text']):
+        conf = float(data['conf'][i])
+        if conf < 0 or not word.strip():
+            continue
+        confidences.append(conf)
+        key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+        lines.setdefault(key, []).append(word)
+
+    text = []
+    last_par = None
+    for (block, par, line), words in lines.items():
+        if last_par is not None and (block, par) != last_par:
+            text.append("")
+        text.append(" ".join(words))
+        last_par = (block, par)
+
+    confidence = sum(confidences) / len(confidences) if confidences else 0.0
+    return "\n".join(text), confidence
+
+
+def extract_page(args):
+    """
+    Worker function for the ingest pipeline's shared pool.
+    args: (filepath, page_number, dpi, dpi_retry, min_confidence)
+    Returns: (filepath, page_number, text, route, error)
+
+    route is how the page got extracted, for the ingest report:
+        "text"      - had a usable text layer, no rasterizing at all
+        "ocr"       - OCR'd at dpi
+        "ocr_retry" - OCR confidence was under min_confidence so it got redone at dpi_retry
+        "error"     - everything failed, text is empty and error is what went wrong
+                      (so it ends up in the report and not in the index)
+    Every page gets the same "# Page N ... ---" wrapping whichever route it took.
+    """
+    file, page_number, dpi, dpi_retry, min_confidence = args
+
+    try:
+        if text_layer_ok(read_text_layer(file, page_number)):
+            try:
+                text = pymupdf4llm.to_markdown(file, pages=[page_number - 1])
+            except Exception:
+                # layout analysis choked but the text itself is fine
+                text = read_text_layer(file, page_number)
+            return file, page_number, _page_text(page_number, text), "text", None
+
+        text, confidence = ocr_page_with_confidence(file, page_number, dpi)
+        route = "ocr"
+        if confidence < min_confidence and dpi_retry and dpi_retry > dpi:
+            retry_text, retry_confidence = ocr_page_with_confidence(file, page_number, dpi_retry)
+            if retry_confidence >= confidence:
+                text = retry_text
+            route = "ocr_retry"
+
+        return file, page_number, _page_text(page_number, text), route, None
+
+    except Exception as e:
+        return file, page_number, "", "error", repr(e)
+
+
+def _page_text(page_number, text):
+    # same page separators the whole-file OCR fallback always used
+    return f"# Page {page_number}\n\n{text}\n\n---\n"
+
+
 # -----------------------------
 # Main Extract Function
 # -----------------------------
-def main(file, format="text", workers=None, dpi_text=800, dpi_md=800):
+def main(file, format="text", workers=None, dpi_text=800, dpi_md=300, dpi_md_retry=600, min_confidence=60,
+         use_cache=True):
     """
     file: path to PDF
     format: "text" or "markdown"
     workers: number of parallel workers (defaults to cpu_count())
     dpi_text: dpi for text extraction (higher dpi -> better OCR, more CPU/RAM)
-    dpi_md: dpi for fallback markdown OCR
+    dpi_md: starting dpi for fallback markdown OCR
+    dpi_md_retry: dpi a fallback page gets redone at if OCR confidence is under min_confidence
+    use_cache: reuse/save the output in the on-disk extraction cache
     """
+    if not use_cache:
+        return _extract(file, format, workers, dpi_text, dpi_md, dpi_md_retry, min_confidence)
+
+    key = extractCache.cache_key(
+        manifest.hash_file(file), format, version=EXTRACTOR_VERSION, dpi_text=dpi_text,
+        dpi_md=dpi_md, dpi_md_retry=dpi_md_retry, min_confidence=min_confidence,
+    )
+    cached = extractCache.get(key)
+    if cached is not None:
+        print(f"Using cached extraction for '{file}'")
+        return cached['text']
+
+    text = _extract(file, format, workers, dpi_text, dpi_md, dpi_md_retry, min_confidence)
+    if not text.startswith("--"):  # don't cache "--unsupported file--" and friends
+        extractCache.put(key, {'file': file, 'text': text})
+    return text
+
+
+def _extract(file, format, workers, dpi_text, dpi_md, dpi_md_retry, min_confidence):
     if workers is None:
         workers = max(1, cpu_count() - 0)  # allow tuning here
 
@@ -112,7 +244,7 @@ def main(file, format="text", workers=None, dpi_text=800, dpi_md=800):
 
         except Exception as e:
             print(f"High-quality markdown extraction failed: {repr(e)}")
-            print("Falling back to multiprocess page-by-page OCR -> markdown...")
+            print("Falling back to page-by-page extraction (text layer where it's usable, OCR where it isn't)...")
 
             info = pdfinfo_from_path(file)
             total_pages = info.get("Pages", 0)
@@ -120,24 +252,24 @@ def main(file, format="text", workers=None, dpi_text=800, dpi_md=800):
                 print("PDF has zero pages or couldn't read page count.")
                 return ""
 
-            print(f"Using {workers} worker(s) for fallback OCR; DPI={dpi_md}")
-            args = [(file, page, dpi_md) for page in range(1, total_pages + 1)]
+            print(f"Using {workers} worker(s) for fallback; OCR DPI={dpi_md} (retry at {dpi_md_retry})")
+            args = [(file, page, dpi_md, dpi_md_retry, min_confidence) for page in range(1, total_pages + 1)]
 
             results = [None] * total_pages
+            routes = {}
             with Pool(workers) as pool:
-                for page_num, text in tqdm(pool.imap_unordered(ocr_page, args),
-                                            total=total_pages,
-                                            desc="OCR Markdown Fallback",
-                                            unit="page"):
+                for _, page_num, text, route, error in tqdm(pool.imap_unordered(extract_page, args),
+                                                            total=total_pages,
+                                                            desc="Markdown Fallback",
+                                                            unit="page"):
                     # keep order by placing into results at index page_num-1
                     results[page_num - 1] = text
+                    routes[route] = routes.get(route, 0) + 1
+                    if error:
+                        print(f"Page {page_num} failed: {error}")
 
-            # assemble markdown with simple page separators
-            md_blocks = []
-            for i, page_text in enumerate(results, start=1):
-                md_blocks.append(f"# Page {i}\n\n{page_text}\n\n---\n")
-
-            return "\n".join(md_blocks)
+            print(f"Pages by path: {routes}")
+            return "\n".join(results)
 
     else:
         print(f"Unknown format '{format}'")
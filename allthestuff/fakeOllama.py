@@ -0,0 +1,112 @@
+'''
+Stand-in for the ollama server, for testing the summary path without a GPU.
+
+Answers POST /api/chat the way ollama does (newline delimited json when streaming), with
+a canned reply sent a word at a time with a fixed delay, and counts how many chats are
+running at once so you can check the scheduler's caps actually hold.
+
+    python -m allthestuff.fakeOllama --port 11435 --delay 0.05
+    OLLAMA_HOST=http://localhost:11435 uv run ai-guy
+'''
+import argparse
+import json
+import threading
+import time
+from datetime import datetime, timezone
+
+from flask import Flask, Response, jsonify, request
+
+default_reply = ("The documents say the thing you asked about is documented in the attached "
+                 "passages [1], with more detail on the later revision [2].")
+
+
+def create_app(delay=0.05, reply=default_reply, first_token_delay=0.0):
+    """
+    delay: seconds between streamed words
+    first_token_delay: extra seconds before the first word (fake prompt processing)
+    """
+    app = Flask(__name__)
+    lock = threading.Lock()
+    stats = {'requests': 0, 'active': 0, 'max_active': 0}
+
+    def now():
+        return datetime.now(timezone.utc).isoformat()
+
+    def message(model, content, done):
+        body = {
+            'model': model,
+            'created_at': now(),
+            'message': {'role': 'assistant', 'content': content},
+            'done': done,
+        }
+        if done:
+            body['done_reason'] = 'stop'
+        return body
+
+    @app.route('/api/chat', methods=['POST'])
+    def chat():
+        data = request.json or {}
+        model = data.get('model', 'fake')
+        stream = data.get('stream', True)
+        with lock:
+            stats['requests'] += 1
+            stats['active'] += 1
+            stats['max_active'] = max(stats['max_active'], stats['active'])
+
+        def finish():
+            with lock:
+                stats['active'] -= 1
+
+        words = reply.split(' ')
+        if not stream:
+            time.sleep(first_token_delay + delay * len(words))
+            finish()
+            return jsonify(message(model, reply, True))
+
+        def generate():
+            try:
+                time.sleep(first_token_delay)
+                for i, word in enumerate(words):
+                    time.sleep(delay)
+                    yield json.dumps(message(model, word if i == 0 else ' ' + word, False)) + '\n'
+                yield json.dumps(message(model, '', True)) + '\n'
+            finally:
+                finish()
+
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    @app.route('/api/stats', methods=['GET'])
+    def get_stats():
+        with lock:
+            return jsonify(dict(stats))
+
+    @app.route('/', methods=['GET'])
+    def root():
+        return 'Ollama is running'
+
+    return app
+
+
+def serve(port=11435, delay=0.05, first_token_delay=0.0):
+    """Runs the fake server on a background thread, returns its url"""
+    app = create_app(delay=delay, first_token_delay=first_token_delay)
+    thread = threading.Thread(
+        target=lambda: app.run(host='127.0.0.1', port=port, threaded=True, use_reloader=False),
+        name='fake-ollama',
+        daemon=True,
+    )
+    thread.start()
+    return f'http://127.0.0.1:{port}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake ollama server for testing")
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--delay', type=float, default=0.05, help="seconds between streamed words")
+    parser.add_argument('--first-token-delay', type=float, default=0.0)
+    args = parser.parse_args()
+    create_app(args.delay, first_token_delay=args.first_token_delay).run(host='127.0.0.1', port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
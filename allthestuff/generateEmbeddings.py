@@ -1,40 +1,148 @@
 from sentence_transformers import SentenceTransformer
+from . import chunkStore
+from . import searchIndex
+from . import annIndex
+from . import indexFile
+from . import lexicalIndex
+from . import indexShards
 import json
+import os
+import time
 import numpy as np
-document_JSON = "documents.json"
+from tqdm import tqdm
+document_JSON = chunkStore.chunk_store
+# ANN index built next to the .npy every time it's saved ('exact' to skip it)
+ann_Backend = 'ivf'
+# quantized codes saved next to it too, so the server can use ann_backend='binary' / 'int8' ([] to skip)
+quantize_Backends = ['binary', 'int8']
+# one index per top level KS folder in index_shards/ instead of one big one (see indexShards)
+shard_By_KS = True
 
 def load_Chunks (document_JSON):
-    with open(document_JSON, 'r', encoding='utf-8') as docs:
-        data = json.load(docs)
-    return data
+    # reads the whole store, only use this for small stuff. build_Index streams it instead
+    return [chunk for batch in chunkStore.iter_chunks(document_JSON) for chunk in batch]
 
-def generate_Embeddings(chunks, model_name='Qwen/Qwen3-Embedding-0.6B', batch_size=4):
+def available_Memory():
+    """Bytes of RAM we could use right now (MemAvailable on linux, a guess everywhere else)"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024 ** 3
+
+
+def memory_Batch_Size(model, seq_len, memory_fraction=0.25, max_batch=256):
+    """
+    Biggest batch of seq_len-token texts whose activations fit in memory_fraction of free RAM
+
+    Inference only keeps about one layer's activations around at a time, so per sequence
+    that's roughly the hidden states + MLP intermediates (~16 x hidden floats per token)
+    plus one layer's attention scores (heads x seq_len^2 floats).
+    """
+    try:
+        config = model[0].auto_model.config
+        hidden, heads = config.hidden_size, config.num_attention_heads
+    except (AttributeError, IndexError, TypeError):
+        hidden, heads = 1024, 16
+    per_sequence = 4 * (16 * hidden * seq_len + heads * seq_len * seq_len)
+    return int(max(1, min(max_batch, available_Memory() * memory_fraction // per_sequence)))
+
+
+def generate_Embeddings(chunks, model_name='Qwen/Qwen3-Embedding-0.6B', batch_size=None, model=None,
+                        time_budget=2.0, memory_fraction=0.25, show_progress_bar=True):
     """
-    Generate embeddings for all chunks in 'documents.json'
+    Generate embeddings for all chunks in 'documents.jsonl'
     
     Arguments:
         chunks: List of dicts with 'text' field, or list of strings
         model_name: Sentence transformer model to use
-        batch_size: Number of chunks to process at once (this is set to run on my laptop rn, but
-        eventually we'll have better hardware)
+        batch_size: Number of chunks to process at once. None (default) picks it automatically:
+        texts get sorted by token length so each batch pads to about the same length, and
+        each batch is as big as fits in memory_fraction of free RAM and still finishes in
+        about time_budget seconds (measured as it goes)
+        model: already loaded SentenceTransformer, so batched callers don't reload it every time
+    
+    Returns:
+        Embeddings in the same order as chunks
     """
-    print(f"Loading model: {model_name}")
-    model = SentenceTransformer(model_name)
+    if model is None:
+        print(f"Loading model: {model_name}")
+        model = SentenceTransformer(model_name)
     
     # Extract text from chunks
-    if isinstance(chunks[0], dict):
+    if len(chunks) and isinstance(chunks[0], dict):
         texts = [chunk['text'] for chunk in chunks]
+        lengths = [chunk.get('tokens') for chunk in chunks]
     else:
-        texts = chunks
+        texts = list(chunks)
+        lengths = [None] * len(texts)
+    
+    # token lengths (the token chunker already saved them, count the rest)
+    missing = [i for i, n in enumerate(lengths) if n is None]
+    if missing:
+        counted = model.tokenizer([texts[i] for i in missing], add_special_tokens=False)['input_ids']
+        for i, ids in zip(missing, counted):
+            lengths[i] = len(ids)
+    max_len = model.max_seq_length or max(lengths, default=1)
+    lengths = np.minimum(np.asarray(lengths, dtype=np.int64), max_len) + 2  # + special tokens
+    
+    # longest first, so the first (slowest) batch sizes the rest and any OOM happens immediately
+    order = np.argsort(-lengths, kind='stable')
     
-    print(f"Generating embeddings for {len(texts)} chunks...")
-    # encode with progress bar
-    embeddings = model.encode(
-        texts, 
-        batch_size=batch_size,
-        show_progress_bar=True,
-        convert_to_numpy=True
-    )
+    print(f"Generating embeddings for {len(texts)} chunks ({int(lengths.sum())} tokens)...")
+    progress = tqdm(total=len(texts), desc="Embedding", unit="chunk", disable=not show_progress_bar)
+    embeddings = None
+    tokens_per_second = None
+    done_tokens = 0
+    start_time = time.perf_counter()
+    position = 0
+    while position < len(order):
+        seq_len = int(lengths[order[position]])
+        if batch_size:
+            size = batch_size
+        else:
+            size = memory_Batch_Size(model, seq_len, memory_fraction)
+            if tokens_per_second:
+                size = max(1, min(size, int(time_budget * tokens_per_second / seq_len)))
+            elif position == 0:
+                size = min(size, 8)  # small first batch to measure throughput
+        batch = order[position:position + size]
+        
+        batch_start = time.perf_counter()
+        batch_embeddings = model.encode(
+            [texts[i] for i in batch],
+            batch_size=len(batch),
+            show_progress_bar=False,
+            convert_to_numpy=True
+        )
+        elapsed = time.perf_counter() - batch_start
+        
+        if embeddings is None:
+            embeddings = np.empty((len(texts), batch_embeddings.shape[1]), dtype=batch_embeddings.dtype)
+        # scatter back to the original chunk order
+        embeddings[batch] = batch_embeddings
+        
+        padded_tokens = seq_len * len(batch)
+        if elapsed > 0:
+            rate = padded_tokens / elapsed
+            tokens_per_second = rate if tokens_per_second is None else 0.7 * tokens_per_second + 0.3 * rate
+        
+        position += len(batch)
+        done_tokens += int(lengths[batch].sum())
+        total_elapsed = time.perf_counter() - start_time
+        progress.update(len(batch))
+        progress.set_postfix(batch=len(batch), chunks_s=f"{position / total_elapsed:.1f}",
+                             tokens_s=f"{done_tokens / total_elapsed:.0f}")
+    progress.close()
+    
+    if embeddings is None:
+        embeddings = np.zeros((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
     
     return embeddings
 
@@ -58,23 +166,170 @@ def generate_Embeddings(chunks, model_name='Qwen/Qwen3-Embedding-0.6B', batch_si
 #     return embeddings
 
 def save_Embeddings(chunks, embeddings, output_prefix='search_index'):
-    np.save(f'{output_prefix}_embeddings.npy', embeddings)
+    # stored pre-normalized float32 so the server doesn't redo norms on every query
+    # temp files + replace like every other index file, the server could be opening them
+    np.save(f'{output_prefix}_embeddings.tmp.npy', searchIndex.normalize_embeddings(embeddings))
+    os.replace(f'{output_prefix}_embeddings.tmp.npy', f'{output_prefix}_embeddings.npy')
 
-    with open(f'{output_prefix}_chunks.json', 'w', encoding='utf-8') as f:
+    with open(f'{output_prefix}_chunks.json.tmp', 'w', encoding='utf-8') as f:
         json.dump(chunks, f, ensure_ascii=False, indent=2)
+    os.replace(f'{output_prefix}_chunks.json.tmp', f'{output_prefix}_chunks.json')
     
     print(f"Saved embeddings to {output_prefix}_embeddings.npy")
     print(f"Saved chunks to {output_prefix}_chunks.json")
 
+    build_Index_File(chunks, output_prefix)
+    build_Ann(output_prefix)
+    build_Quantized(output_prefix)
+    build_Lexical(chunks, output_prefix)
+
+
+def build_Index_File(chunks, output_prefix='search_index'):
+    """Write the mmap-able .idx the server loads, chunks can be any iterable (e.g. streamed from the store)"""
+    embeddings = np.load(f'{output_prefix}_embeddings.npy', mmap_mode='r')
+    indexFile.write_index(f'{output_prefix}.idx', embeddings, chunks)
+
+
+def build_Ann(output_prefix='search_index', backend=None):
+    backend = backend or ann_Backend
+    if backend == 'exact':
+        return
+    embeddings = np.load(f'{output_prefix}_embeddings.npy', mmap_mode='r')
+    if embeddings.shape[0] == 0:
+        return
+    annIndex.build(embeddings, backend, output_prefix)
+
+
+def build_Quantized(output_prefix='search_index', backends=None):
+    """Binary / int8 codes of the embeddings (see quantIndex), scales are saved with the int8 ones"""
+    backends = quantize_Backends if backends is None else backends
+    embeddings = np.load(f'{output_prefix}_embeddings.npy', mmap_mode='r')
+    if embeddings.shape[0] == 0:
+        return
+    for backend in backends:
+        annIndex.build(embeddings, backend, output_prefix)
+
+
+def build_Lexical(chunks, output_prefix='search_index'):
+    """BM25 index for hybrid search, same rows as the embeddings (chunks can be streamed)"""
+    lexicalIndex.build(chunks, output_prefix)
+
+
+def index_Exists(output_prefix='search_index'):
+    if shard_By_KS:
+        return indexShards.exists()
+    return (os.path.exists(f'{output_prefix}_embeddings.npy')
+            and os.path.exists(f'{output_prefix}_chunks.json'))
+
+
+def update_Index(new_chunks, new_embeddings, drop_files, output_prefix='search_index', input_prefix=None):
+    """
+    Patch the saved index instead of rebuilding it
+
+    Arguments:
+        new_chunks: chunks from new/changed files
+        new_embeddings: embeddings for new_chunks, same order
+        drop_files: files whose old rows should be removed (changed + deleted files)
+        input_prefix: read the old index from here instead of output_prefix
+    """
+    input_prefix = input_prefix or output_prefix
+    embeddings = np.load(f'{input_prefix}_embeddings.npy')
+    with open(f'{input_prefix}_chunks.json', 'r', encoding='utf-8') as f:
+        chunks = json.load(f)
+
+    drop_files = set(drop_files)
+    keep = [i for i, chunk in enumerate(chunks) if chunk.get('file') not in drop_files]
+    print(f"Dropping {len(chunks) - len(keep)} old rows, adding {len(new_chunks)} new rows")
+
+    chunks = [chunks[i] for i in keep] + list(new_chunks)
+    if len(new_chunks):
+        embeddings = np.concatenate([embeddings[keep], new_embeddings.astype(embeddings.dtype)])
+    else:
+        embeddings = embeddings[keep]
+
+    save_Embeddings(chunks, embeddings, output_prefix)
+
+
+def patch_Index(new_chunks, new_embeddings, drop_files, output_prefix='search_index'):
+    """update_Index, or only the index shards those files belong to when shard_By_KS is on"""
+    if shard_By_KS:
+        indexShards.update(new_chunks, new_embeddings, drop_files)
+    else:
+        update_Index(new_chunks, new_embeddings, drop_files, output_prefix)
+
+
+def finish_Index(store_file, output_prefix='search_index', read_batch=1024):
+    """Everything that goes next to an already saved embeddings .npy: chunks json, .idx, ANN, quantized, BM25"""
+    chunkStore.export_json(store_file, f'{output_prefix}_chunks.json')
+    print(f"Saved chunks to {output_prefix}_chunks.json")
+
+    stream = (chunk for batch in chunkStore.iter_chunks(store_file, batch_size=read_batch) for chunk in batch)
+    build_Index_File(stream, output_prefix)
+    build_Ann(output_prefix)
+    build_Quantized(output_prefix)
+    stream = (chunk for batch in chunkStore.iter_chunks(store_file, batch_size=read_batch) for chunk in batch)
+    build_Lexical(stream, output_prefix)
+
+
+def build_Index(store_file=document_JSON, output_prefix='search_index', read_batch=1024,
+                model_name='Qwen/Qwen3-Embedding-0.6B', workers=None, shard_size=None, keep_shards=False):
+    """
+    Rebuild the whole index straight from the chunk store
+
+    Embedding is split into shards across worker processes (see embedShards), each finished
+    shard is saved as it's done, so if this dies part way a rerun picks up where it left off.
+    The chunks json is exported from the store at the end, so the corpus text is never all
+    in memory at once. With shard_By_KS the merged embeddings get split into one index per
+    car (indexShards.build) instead.
+    """
+    from . import embedShards
+
+    total = chunkStore.count_chunks(store_file)
+    print(f"{total} chunks in {store_file}")
+    if total == 0:
+        print("Nothing to embed")
+        return
+
+    n_shards = embedShards.embed_store(store_file, workers=workers, model_name=model_name,
+                                       shard_size=shard_size or embedShards.shard_size)
+    embedShards.merge(n_shards, f'{output_prefix}_embeddings.npy')
+
+    if shard_By_KS:
+        indexShards.build(store_file, f'{output_prefix}_embeddings.npy', read_batch=read_batch)
+        # every row is in a shard now, the merged copy was just the input
+        os.remove(f'{output_prefix}_embeddings.npy')
+    else:
+        print(f"Saved embeddings to {output_prefix}_embeddings.npy")
+        finish_Index(store_file, output_prefix, read_batch)
+
+    # index is complete, the shards were only there in case we crashed
+    if not keep_shards:
+        embedShards.clear()
+
+
+def main(files=None, drop_files=None, workers=None):
+    """
+    files: only embed chunks from these files and patch them into the existing index,
+    None rebuilds the whole index from documents.jsonl
+    drop_files: files whose rows get removed from the existing index first
+    workers: embedding processes for a full rebuild
+    """
+    chunkStore.migrate_json()
 
-def main():
-    chunks = load_Chunks(document_JSON)
+    if files is not None and index_Exists():
+        chunks = [chunk for batch in chunkStore.iter_chunks(document_JSON, files=files) for chunk in batch]
+        print(f"{len(chunks)} new chunks loaded")
 
-    print(f"{len(chunks)} chunks loaded")
+        if chunks:
+            embeddings = generate_Embeddings(chunks)
+        else:
+            embeddings = None
 
-    embeddings = generate_Embeddings(chunks)
+        patch_Index(chunks, embeddings, drop_files or [])
+        print("Done! :)")
+        return
 
-    save_Embeddings(chunks, embeddings)
+    build_Index(document_JSON, workers=workers)
 
     print("Done! :)")
 
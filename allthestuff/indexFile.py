@@ -0,0 +1,234 @@
+'''
+Single file binary index ("search_index.idx") that the server opens with mmap.
+
+Loading the .npy and a pretty printed chunks json means startup time and RAM both grow
+with the corpus, and every worker process gets its own copy. This file is laid out so
+nothing has to be parsed up front: the embeddings are a raw float32 block numpy can
+point straight at, and chunk text only gets decoded for the rows we actually return.
+Since it's a read-only shared mapping, multiple processes share the same pages.
+
+Layout (little endian, every section 64 byte aligned):
+
+    header     magic, version, flags, row count, dim, section offsets/lengths, crc32
+    embeddings n_rows x dim float32, L2 normalized as they get written
+    blob       every chunk as utf-8 json, back to back
+    offsets    n_rows + 1 uint64, chunk i is blob[offsets[i]:offsets[i + 1]]
+    file_ids   n_rows uint32, index into the files table (for the filter index)
+    files      json list of every source file path
+
+crc32 covers everything after the header. Checking it reads the whole file so it's
+off by default at startup, "python -m allthestuff.indexFile search_index.idx" checks it.
+'''
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+from . import searchIndex
+
+MAGIC = b'KSMSIDX\0'
+VERSION = 1
+FLAG_NORMALIZED = 1
+
+_HEADER = struct.Struct('<8sIIQQQQQQQQQI')
+HEADER_SIZE = 256
+ALIGN = 64
+
+
+def _pad(f, crc):
+    extra = (-f.tell()) % ALIGN
+    if extra:
+        f.write(b'\0' * extra)
+        crc = zlib.crc32(b'\0' * extra, crc)
+    return crc
+
+
+def write_index(path, embeddings, chunks, normalize=True, block_rows=65536):
+    """
+    Write a .idx file
+
+    Args:
+        path: output file, written to path + '.tmp' first and swapped in at the end
+        embeddings: (n, dim) array (a memmap is fine, it's copied over in blocks)
+        chunks: iterable of n chunk dicts in the same order as embeddings
+        normalize: scale every row to unit length as it's written. With False the rows go in
+            as they are, and the header only says normalized if every one of them already was
+    """
+    n_rows, dim = embeddings.shape
+    tmp_path = path + '.tmp'
+    crc = 0
+    normalized = True
+
+    offsets = np.zeros(n_rows + 1, dtype=np.uint64)
+    file_ids = np.zeros(n_rows, dtype=np.uint32)
+    files = {}
+
+    with open(tmp_path, 'wb') as f:
+        f.write(b'\0' * HEADER_SIZE)
+
+        emb_off = f.tell()
+        for start in range(0, n_rows, block_rows):
+            block = np.asarray(embeddings[start:start + block_rows], dtype=np.float32)
+            if normalize:
+                # the server skips normalizing when the header says it's done, so it has to be true
+                block = searchIndex.normalize_embeddings(block)
+            elif normalized:
+                norms = np.linalg.norm(block, axis=1)
+                # all-zero rows (empty chunks) stay zero after normalizing too
+                normalized = bool(np.all((np.abs(norms - 1.0) < 1e-3) | (norms == 0)))
+            block = np.ascontiguousarray(block, dtype='<f4').tobytes()
+            f.write(block)
+            crc = zlib.crc32(block, crc)
+        crc = _pad(f, crc)
+
+        blob_off = f.tell()
+        row = 0
+        for chunk in chunks:
+            if row >= n_rows:
+                raise ValueError(f"More chunks than embedding rows ({n_rows})")
+            data = json.dumps(chunk, ensure_ascii=False).encode('utf-8')
+            f.write(data)
+            crc = zlib.crc32(data, crc)
+            offsets[row + 1] = offsets[row] + len(data)
+            file = chunk.get('file', '') if isinstance(chunk, dict) else ''
+            file_ids[row] = files.setdefault(file, len(files))
+            row += 1
+        if row != n_rows:
+            raise ValueError(f"Got {row} chunks for {n_rows} embedding rows")
+        blob_len = f.tell() - blob_off
+        crc = _pad(f, crc)
+
+        offsets_off = f.tell()
+        data = offsets.astype('<u8').tobytes()
+        f.write(data)
+        crc = zlib.crc32(data, crc)
+        crc = _pad(f, crc)
+
+        file_ids_off = f.tell()
+        data = file_ids.astype('<u4').tobytes()
+        f.write(data)
+        crc = zlib.crc32(data, crc)
+        crc = _pad(f, crc)
+
+        files_off = f.tell()
+        data = json.dumps(list(files), ensure_ascii=False).encode('utf-8')
+        f.write(data)
+        crc = zlib.crc32(data, crc)
+        files_len = len(data)
+
+        header = _HEADER.pack(
+            MAGIC, VERSION, FLAG_NORMALIZED if normalize or normalized else 0,
+            n_rows, dim, emb_off, blob_off, blob_len, offsets_off,
+            file_ids_off, files_off, files_len, crc,
+        )
+        f.seek(0)
+        f.write(header.ljust(HEADER_SIZE, b'\0'))
+
+    os.replace(tmp_path, path)
+    print(f"Saved {n_rows} rows to {path}")
+
+
+class LazyChunks:
+    """List-like view over the chunk blob, only json-decodes the rows you index"""
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+
+    def __len__(self):
+        return self.index_file.n_rows
+
+    def __getitem__(self, row):
+        return self.index_file.chunk(int(row))
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self.index_file.chunk(row)
+
+
+class IndexFile:
+    def __init__(self, path, verify=False):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, self.flags, self.n_rows, self.dim, emb_off, self._blob_off,
+         blob_len, offsets_off, file_ids_off, files_off, files_len,
+         self.checksum) = _HEADER.unpack_from(self._mm, 0)
+
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a search index file")
+        if version != VERSION:
+            raise ValueError(f"{path} is index version {version}, this code reads version {VERSION}")
+
+        if verify:
+            self.verify()
+
+        # all of these are views straight into the mapping, nothing is copied
+        self.embeddings = np.frombuffer(self._mm, dtype='<f4', count=self.n_rows * self.dim,
+                                        offset=emb_off).reshape(self.n_rows, self.dim)
+        self.offsets = np.frombuffer(self._mm, dtype='<u8', count=self.n_rows + 1, offset=offsets_off)
+        self.file_ids = np.frombuffer(self._mm, dtype='<u4', count=self.n_rows, offset=file_ids_off)
+        self.files = json.loads(self._mm[files_off:files_off + files_len].decode('utf-8'))
+        self.chunks = LazyChunks(self)
+
+    @property
+    def normalized(self):
+        return bool(self.flags & FLAG_NORMALIZED)
+
+    @property
+    def version_tag(self):
+        """Identifies this exact build of the index (row count + checksum)"""
+        return f"{self.n_rows}-{self.checksum:08x}"
+
+    def chunk(self, row):
+        start = self._blob_off + int(self.offsets[row])
+        end = self._blob_off + int(self.offsets[row + 1])
+        return json.loads(self._mm[start:end].decode('utf-8'))
+
+    def verify(self, block_size=1 << 24):
+        crc = 0
+        size = len(self._mm)
+        for start in range(HEADER_SIZE, size, block_size):
+            crc = zlib.crc32(self._mm[start:min(start + block_size, size)], crc)
+        if crc != self.checksum:
+            raise ValueError(f"{self.path} failed its checksum (corrupt or partially written?)")
+
+    def close(self):
+        """Unmap the file, everything holding on to embeddings / offsets / file_ids should drop them first"""
+        self.embeddings = self.offsets = self.file_ids = None
+        try:
+            self._mm.close()
+        except BufferError:
+            # a view into it is still alive somewhere. Let go of ours and the mapping gets
+            # unmapped when the last view is garbage collected
+            print(f"{self.path} is still in use, it gets unmapped once the last array using it is gone")
+        self._mm = None
+        self._file.close()
+
+
+def main():
+    if len(sys.argv) > 1:
+        paths = sys.argv[1:]
+    else:
+        # the server uses the shards when there are any, so check those
+        from . import indexShards
+        shards = indexShards.load_manifest()
+        if shards:
+            paths = [f'{indexShards.shard_prefix(name, entry=entry)}.idx' for name, entry in sorted(shards.items())]
+        else:
+            paths = ['search_index.idx']
+
+    for path in paths:
+        index = IndexFile(path)
+        index.verify()
+        print(f"{path}: version {VERSION}, {index.n_rows} rows x {index.dim} dims, "
+              f"{len(index.files)} files, checksum ok")
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
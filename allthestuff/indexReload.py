@@ -0,0 +1,188 @@
+'''
+Picks up a new index without restarting the server.
+
+Restarting ai-guy after an ingest meant loading the model and the index all over again with
+the site down the whole time. Instead the app keeps the engine behind an IndexReloader:
+
+    - a watcher thread checks the index version on disk every few seconds (the shard
+      manifest, or the .idx header, no index data gets read)
+    - when it changes, a second engine is opened on the new files in the background,
+      reusing the already loaded model, while the old one keeps serving
+    - once it's ready it's swapped in with one assignment. Every request holds on to the
+      engine it started with, so in-flight requests finish on the old index, and the old
+      engine is closed when the last of them is done
+
+POST /api/reload (or SIGHUP) reloads right away without waiting for the watcher.
+
+Ingest writes every index file to a temp name and os.replace's it in, so the old engine's
+mmaps stay valid and nothing ever opens half a file. That's per file though, so when a new
+index counts as ready depends on the layout:
+
+    shards - a rebuilt shard goes in a new folder and shards.json gets pointed at it last,
+             so a changed manifest means everything it points at is complete
+    single - the files get replaced one after another with the BM25 index last, so it's
+             only ready once that's at least as new as the .idx
+'''
+import os
+import signal
+import threading
+import time
+
+from . import indexFile
+from . import indexShards
+
+
+def disk_version(engine):
+    """
+    Version of the index engine would open if it was started right now, same format as
+    engine.index_version. None if it can't be told without loading it (old .npy + .json
+    index) or an ingest is still writing it.
+    """
+    if engine.shard_dir and indexShards.exists(engine.shard_dir):
+        # the manifest only gets pointed at a shard build once it's complete
+        return indexShards.version(indexShards.load_manifest(engine.shard_dir))
+
+    index_file = engine.settings['index_file']
+    if not index_file or not os.path.exists(index_file):
+        return None
+    # ingest replaces the BM25 index last, if it's older than the .idx the rest isn't done yet
+    output_prefix = index_file[:-len('.idx')] if index_file.endswith('.idx') else index_file
+    lexical_file = f'{output_prefix}_lexical.npz'
+    if os.path.exists(lexical_file) and os.path.getmtime(lexical_file) < os.path.getmtime(index_file):
+        return None
+    try:
+        index = indexFile.IndexFile(index_file)
+    except (OSError, ValueError):
+        return None
+    try:
+        return index.version_tag
+    finally:
+        index.close()
+
+
+class IndexReloader:
+    def __init__(self, engine, watch_seconds=10.0):
+        """
+        Args:
+            engine: the SemanticSearchEngine to start with
+            watch_seconds: how often to check for a new index, None to only reload when asked
+        """
+        self.engine = engine
+        self.reloads = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_reload = None
+        self._failed_version = None  # don't keep retrying the same broken index every few seconds
+        self._in_use = {}  # engine -> requests still using it
+        self._retired = set()  # swapped out, closed once nothing's using them
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+        self._watcher = None
+        if watch_seconds:
+            self._watcher = threading.Thread(target=self._watch, args=(watch_seconds,), name='index-reload', daemon=True)
+            self._watcher.start()
+
+    def acquire(self):
+        """The active engine, which stays open until it's given back with release()"""
+        with self._lock:
+            engine = self.engine
+            self._in_use[engine] = self._in_use.get(engine, 0) + 1
+            return engine
+
+    def release(self, engine):
+        with self._lock:
+            self._in_use[engine] -= 1
+            if self._in_use[engine]:
+                return
+            del self._in_use[engine]
+            if engine not in self._retired:
+                return
+            self._retired.discard(engine)
+        self._close(engine)
+
+    def reload(self, force=False):
+        """
+        Open the index on disk and swap it in if it's a different version (or force)
+
+        Returns:
+            True if a new engine got swapped in
+        Raises:
+            whatever opening the new index raised, the old engine stays active
+        """
+        with self._reload_lock:
+            old = self.engine
+            version = disk_version(old)
+            if not force and version in (None, old.index_version, self._failed_version):
+                return False
+
+            print(f"Loading new index (active version {old.index_version})...")
+            start = time.perf_counter()
+            try:
+                new = old.reopen()
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                self._failed_version = version
+                raise
+            if not force and new.index_version == old.index_version:
+                self._close(new)
+                return False
+            old.metrics.observe('index_reload_seconds', time.perf_counter() - start)
+
+            with self._lock:
+                self.engine = new
+                # anything still running on the old one keeps it open until it's done
+                if old in self._in_use:
+                    self._retired.add(old)
+                    old = None
+            if old is not None:
+                self._close(old)
+
+            self.reloads += 1
+            self.last_error = None
+            self._failed_version = None
+            self.last_reload = time.time()
+            print(f"Swapped in index version {new.index_version}")
+            return True
+
+    def reload_on_signal(self, signum=getattr(signal, 'SIGHUP', None)):
+        """kill -HUP <pid> reloads, only works from the main thread (and not on windows)"""
+        if signum is None:
+            return False
+        try:
+            signal.signal(signum, lambda *_: threading.Thread(target=self._reload_logged, daemon=True).start())
+        except ValueError:
+            return False
+        return True
+
+    def stop(self):
+        self._stopped.set()
+
+    def stats(self):
+        with self._lock:
+            retiring = len(self._retired)
+        return {
+            'index_version': self.engine.index_version,
+            'reloads': self.reloads,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'last_reload': self.last_reload,
+            'retiring': retiring,
+            'watching': self._watcher is not None and not self._stopped.is_set(),
+        }
+
+    def _close(self, engine):
+        print(f"Closing index version {engine.index_version}")
+        engine.close()
+
+    def _reload_logged(self, force=False):
+        try:
+            self.reload(force)
+        except Exception as e:
+            print(f"Index reload failed, still serving {self.engine.index_version}: {e}")
+
+    def _watch(self, watch_seconds):
+        while not self._stopped.wait(watch_seconds):
+            self._reload_logged()
@@ -0,0 +1,240 @@
+'''
+One index per car.
+
+Everything under Data/KS9 is the KS9 car and most searches say which car they mean
+("ks9 rear wing"), but every search used to go through one index of every car, and adding
+a car's files meant rewriting all of it. Ingest now writes a complete index (embeddings,
+chunks, .idx, ANN, quantized codes, BM25) per top level KS folder:
+
+    index_shards/
+        shards.json       - every shard's current build, row count, index version, and which
+                            ks numbers / folders are in it, so the server can route a query to
+                            the right shards without opening any of them
+        ks9.<build>/search_index.idx, ks9.<build>/search_index_lexical.npz, ...
+        other.<build>/... - anything that isn't under a KS folder
+
+The server opens a shard the first time a query needs it ("ks9 ..." only ever opens ks9,
+unfiltered queries search every shard in parallel), and an incremental ingest only
+rebuilds the shards whose files changed. A rebuilt shard goes in a new <name>.<build>
+folder and shards.json gets pointed at it last, so the server never sees half a shard.
+
+A car is a few hundred to a few thousand chunks, way under annIndex.MIN_ANN_ROWS, so
+shards normally get no IVF / HNSW index and the server scans them exactly (which is both
+faster and exact at that size). A shard only gets one once its car grows past that.
+'''
+import json
+import os
+import re
+import shutil
+import time
+import zlib
+
+import numpy as np
+
+from . import chunkStore
+from . import indexFile
+from . import searchIndex
+
+shard_dir = 'index_shards'
+manifest_name = 'shards.json'
+other_shard = 'other'
+
+# "KS9", "ks 10", "KS-12" as a folder name
+_ks_folder = re.compile(r'^ks\s*-?\s*(\d+)$', re.IGNORECASE)
+
+
+def shard_name(file):
+    """Which shard a file's chunks go in: its top level KS folder ('ks9'), or 'other'"""
+    for folder in file.replace('\\', '/').split('/')[:-1]:
+        match = _ks_folder.match(folder.strip())
+        if match:
+            return f"ks{match.group(1)}"
+    return other_shard
+
+
+def shard_prefix(name, shard_dir=shard_dir, entry=None):
+    """
+    output_prefix of a shard's index files, same file names as the unsharded index. entry
+    is its manifest entry, which says which build of the shard is the current one.
+    """
+    return os.path.join(shard_dir, entry.get('dir', name) if entry else name, 'search_index')
+
+
+def manifest_file(shard_dir=shard_dir):
+    return os.path.join(shard_dir, manifest_name)
+
+
+def exists(shard_dir=shard_dir):
+    return os.path.exists(manifest_file(shard_dir))
+
+
+def load_manifest(shard_dir=shard_dir):
+    """{shard name: entry} (see describe), empty if there aren't any shards"""
+    try:
+        with open(manifest_file(shard_dir), 'r', encoding='utf-8') as f:
+            return json.load(f)['shards']
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def save_manifest(shards, shard_dir=shard_dir):
+    # temp file + replace, the server could be reading it at any moment
+    os.makedirs(shard_dir, exist_ok=True)
+    tmp_file = manifest_file(shard_dir) + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump({'version': 1, 'shards': shards}, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file(shard_dir))
+
+
+def version(shards):
+    """One version tag for the whole set of shards, changes whenever any one of them does"""
+    tags = ",".join(f"{name}:{entry['version']}" for name, entry in sorted(shards.items()))
+    rows = sum(entry['rows'] for entry in shards.values())
+    return f"{rows}-{zlib.crc32(tags.encode('utf-8')):08x}"
+
+
+def describe(folder, shard_dir=shard_dir):
+    """Manifest entry for a shard built into shard_dir/folder, read off its .idx header (no chunks get decoded)"""
+    prefix = shard_prefix(folder, shard_dir)
+    index = indexFile.IndexFile(f'{prefix}.idx')
+    try:
+        filters = searchIndex.FilterIndex.from_file_ids(index.files, index.file_ids)
+        return {
+            'dir': folder,
+            'rows': index.n_rows,
+            'dim': index.dim,
+            'version': index.version_tag,
+            'ks': sorted(filters.ks_rows),
+            'folders': filters.folders(),
+            'lexical': os.path.exists(f'{prefix}_lexical.npz'),
+        }
+    finally:
+        index.close()
+
+
+def _rows_per_file(output_prefix):
+    index = indexFile.IndexFile(f'{output_prefix}.idx')
+    try:
+        counts = np.bincount(index.file_ids, minlength=len(index.files))
+        return dict(zip(index.files, counts.tolist()))
+    finally:
+        index.close()
+
+
+def _new_folder(name, shard_dir=shard_dir):
+    """
+    A fresh folder for a new build of a shard. Shards never get rewritten in place: the
+    server opens them lazily and could catch one half way through, so a new build goes in
+    its own folder and only becomes current when the manifest points at it.
+    """
+    stamp = int(time.time() * 1000)
+    while os.path.exists(os.path.join(shard_dir, f'{name}.{stamp}')):
+        stamp += 1
+    folder = f'{name}.{stamp}'
+    os.makedirs(os.path.join(shard_dir, folder))
+    return folder
+
+
+def _prune(shards, previous, shard_dir=shard_dir):
+    """
+    Delete shard builds neither manifest points at. The previous manifest's builds are kept
+    until the next ingest, a server that hasn't reloaded yet can still open them.
+    """
+    keep = {entry.get('dir', name) for entries in (shards, previous) for name, entry in entries.items()}
+    for folder in os.listdir(shard_dir):
+        if folder in keep or folder.startswith('_') or not os.path.isdir(os.path.join(shard_dir, folder)):
+            continue
+        # ignore_errors: on windows a server that still has it open keeps it around till next time
+        shutil.rmtree(os.path.join(shard_dir, folder), ignore_errors=True)
+        print(f"Removed old index shard build {folder}")
+
+
+def build(store_file=chunkStore.chunk_store, embeddings_file='search_index_embeddings.npy',
+          shard_dir=shard_dir, read_batch=1024):
+    """
+    Split a freshly embedded store into shards and build every one from scratch
+
+    Args:
+        store_file: the chunk store
+        embeddings_file: one normalized row per chunk in store order (what build_Index merges)
+    """
+    from . import generateEmbeddings
+
+    embeddings = np.load(embeddings_file, mmap_mode='r')
+
+    # one pass over the store, each shard gets its own little chunk store + its row numbers
+    work_dir = os.path.join(shard_dir, '_split')
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    rows = {}
+    row = 0
+    for batch in chunkStore.iter_chunks(store_file, batch_size=read_batch):
+        by_shard = {}
+        for chunk in batch:
+            name = shard_name(chunk.get('file', ''))
+            by_shard.setdefault(name, []).append(chunk)
+            rows.setdefault(name, []).append(row)
+            row += 1
+        for name, chunks in by_shard.items():
+            chunkStore.append_chunks(os.path.join(work_dir, f'{name}.jsonl'), chunks)
+
+    previous = load_manifest(shard_dir)
+    shards = {}
+    for name, shard_rows in sorted(rows.items()):
+        print(f"\nBuilding index shard {name} ({len(shard_rows)} chunks)")
+        folder = _new_folder(name, shard_dir)
+        prefix = shard_prefix(folder, shard_dir)
+        np.save(f'{prefix}_embeddings.npy', np.asarray(embeddings[np.asarray(shard_rows, dtype=np.int64)]))
+        generateEmbeddings.finish_Index(os.path.join(work_dir, f'{name}.jsonl'), prefix, read_batch)
+        shards[name] = describe(folder, shard_dir)
+
+    # the new builds become current all at once, cars without any files anymore just aren't in it
+    save_manifest(shards, shard_dir)
+    _prune(shards, previous, shard_dir)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def update(new_chunks, new_embeddings, drop_files, shard_dir=shard_dir):
+    """
+    Rebuild only the shards that have new chunks or dropped files in them, every other shard
+    is left alone (same arguments as generateEmbeddings.update_Index). A shard with nothing
+    left in it is dropped.
+    """
+    from . import generateEmbeddings
+
+    previous = load_manifest(shard_dir)
+    shards = dict(previous)
+    new_rows = {}
+    for i, chunk in enumerate(new_chunks):
+        new_rows.setdefault(shard_name(chunk.get('file', '')), []).append(i)
+    drops = {}
+    for file in drop_files:
+        drops.setdefault(shard_name(file), []).append(file)
+
+    for name in sorted(set(new_rows) | set(drops)):
+        rows = new_rows.get(name, [])
+        chunks = [new_chunks[i] for i in rows]
+        embeddings = new_embeddings[rows] if rows else None
+
+        if name in shards:
+            old_prefix = shard_prefix(name, shard_dir, shards[name])
+            per_file = _rows_per_file(old_prefix)
+            dropped = sum(per_file.get(file, 0) for file in drops.get(name, []))
+            if shards[name]['rows'] - dropped + len(chunks) == 0:
+                print(f"\nIndex shard {name} is empty now, dropping it")
+                del shards[name]
+                continue
+            print(f"\nUpdating index shard {name}")
+            folder = _new_folder(name, shard_dir)
+            generateEmbeddings.update_Index(chunks, embeddings, drops.get(name, []),
+                                            shard_prefix(folder, shard_dir), input_prefix=old_prefix)
+        elif chunks:
+            print(f"\nNew index shard {name} ({len(chunks)} chunks)")
+            folder = _new_folder(name, shard_dir)
+            generateEmbeddings.save_Embeddings(chunks, embeddings, shard_prefix(folder, shard_dir))
+        else:
+            continue
+        shards[name] = describe(folder, shard_dir)
+
+    save_manifest(shards, shard_dir)
+    _prune(shards, previous, shard_dir)
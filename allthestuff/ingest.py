@@ -1,22 +1,67 @@
 '''
-paste directory of documentation into data_dir, 
+paste directory of documentation into data_dir,
 for best results things should be organsed in folders.
 currently the variable is set to the path on my laptop,
 you MUST change this before running this code.
+
+only new or changed files get ingested, run "uv run ingest --full" to redo everything.
 '''
+import sys
 
 def main():
-    from . import split    
+    # "--workers N" embedding processes for full rebuilds
+    args = sys.argv[1:]
+    workers = int(args[args.index("--workers") + 1]) if "--workers" in args else None
+
+    from . import split
     from . import generateEmbeddings
-    
+    from . import manifest
+    from . import chunkStore
+    from . import pipeline
+    from . import extractCache
+
     print("Beginnning Ingest...")
 
-    data_dir = '../Data' 
+    data_dir = '../Data'
+    full = "--full" in args
+
+    chunkStore.migrate_json()
+    old_manifest = manifest.load_manifest()
+
+    # no index yet (or asked for a rebuild), so pretend nothing has been ingested
+    if full or not generateEmbeddings.index_Exists():
+        old_manifest = {}
+        open(split.json_file, "w").close()
+
+    changed, deleted, new_manifest = manifest.diff_manifest(old_manifest, data_dir)
+    print(f"{len(changed)} new/changed file(s), {len(deleted)} deleted file(s)")
+
+    if not changed and not deleted:
+        print("Nothing to ingest :)")
+        return
+
+    # old chunks for anything that changed or got deleted come out of the store first
+    chunkStore.compact(split.json_file, changed + deleted)
+
+    hashes = {file: new_manifest[file]['sha256'] for file in changed}
+    if generateEmbeddings.index_Exists() and old_manifest:
+        # extract -> chunk -> embed as one streaming pass over every changed file
+        # (already extracted files come straight out of the extraction cache)
+        chunks, embeddings = pipeline.run(changed, store_file=split.json_file, hashes=hashes)
+        # only the index shards of the cars those files belong to get touched
+        generateEmbeddings.patch_Index(chunks, embeddings, changed + deleted)
+    else:
+        # full rebuild: extract + chunk everything, then embed in resumable shards across
+        # worker processes, so a crash part way through only loses the unfinished shards
+        pipeline.run(changed, store_file=split.json_file, hashes=hashes, embed=False)
+        generateEmbeddings.build_Index(split.json_file, workers=workers)
+
+    # only record the new state once the index actually has it
+    manifest.save_manifest(new_manifest)
 
-    split.main(data_dir)
-    generateEmbeddings.main()
+    extractCache.prune(max_age_days=extractCache.default_max_age_days, max_mb=extractCache.default_max_mb)
 
     print("Ingest Completed :)")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,192 @@
+'''
+BM25 inverted index over the chunk texts.
+
+Cosine similarity is great at "how do I tension the chain" and terrible at part numbers
+and acronyms ("AIR", "BSPD", "M8x1.25"), the embedding model has never seen most of them
+and they all end up looking alike. This keeps a plain lexical index next to the embedding
+index, built at ingest from the same chunks in the same row order:
+
+    vocab (sorted term list) -> term_offsets into (post_rows, post_tf), CSR style
+
+so a term's postings are one slice, and a query only ever touches the postings of its
+own terms. The engine uses it to pull a candidate set, dense scores just those
+candidates, and fuses the two rankings (see fuse()).
+
+Saved as search_index_lexical.npz.
+'''
+import os
+import re
+from array import array
+
+import numpy as np
+
+# words, plus dotted/dashed/slashed compounds kept whole so "m8x1.25" and "ks-12" are one term
+_token_pattern = re.compile(r'[a-z0-9]+(?:[.\-/][a-z0-9]+)*')
+# where compounds get split into their parts ("m8x1.25" -> "m8", "25", one character parts get dropped)
+_part_split = re.compile(r'[.\-/]|(?<=[0-9])x(?=[0-9])')
+
+
+def tokenize(text):
+    """Lowercased terms of text. Compound terms also get their parts, so "m8x1.25" matches "m8" too."""
+    terms = []
+    for token in _token_pattern.findall(text.lower()):
+        terms.append(token)
+        parts = _part_split.split(token)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if len(part) > 1)
+    return terms
+
+
+class LexicalIndex:
+    def __init__(self, vocab, term_offsets, post_rows, post_tf, doc_len, k1=1.2, b=0.75):
+        self.vocab = vocab
+        self.term_ids = {term: i for i, term in enumerate(vocab.tolist())}
+        self.term_offsets = term_offsets
+        self.post_rows = post_rows
+        self.post_tf = post_tf
+        self.doc_len = doc_len
+        self.n_rows = len(doc_len)
+        self.avg_len = float(doc_len.mean()) if self.n_rows else 0.0
+        self.k1 = k1
+        self.b = b
+
+    @classmethod
+    def build(cls, chunks):
+        """chunks can be any iterable of chunk dicts (e.g. streamed from the store), in index row order"""
+        term_ids = {}
+        post_terms = array('q')
+        post_rows = array('q')
+        post_tf = array('l')
+        doc_len = array('l')
+
+        for row, chunk in enumerate(chunks):
+            terms = tokenize(chunk['text'])
+            doc_len.append(len(terms))
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, tf in counts.items():
+                term_id = term_ids.setdefault(term, len(term_ids))
+                post_terms.append(term_id)
+                post_rows.append(row)
+                post_tf.append(tf)
+
+        # renumber terms alphabetically so the vocab is a plain sorted array
+        vocab = np.array(sorted(term_ids), dtype=np.str_)
+        remap = np.empty(len(term_ids), dtype=np.int64)
+        for new_id, term in enumerate(vocab.tolist()):
+            remap[term_ids[term]] = new_id
+
+        post_terms = remap[np.frombuffer(post_terms, dtype=np.int64)] if post_terms else np.zeros(0, dtype=np.int64)
+        order = np.argsort(post_terms, kind='stable')  # rows stay sorted inside each term
+        term_offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(post_terms, minlength=len(vocab)), out=term_offsets[1:])
+
+        return cls(
+            vocab,
+            term_offsets,
+            np.asarray(post_rows, dtype=np.int32)[order],
+            np.minimum(np.asarray(post_tf, dtype=np.int64), np.iinfo(np.uint16).max).astype(np.uint16)[order],
+            np.asarray(doc_len, dtype=np.int32),
+        )
+
+    def save(self, output_prefix):
+        np.savez(f'{output_prefix}_lexical.tmp.npz', vocab=self.vocab, term_offsets=self.term_offsets,
+                 post_rows=self.post_rows, post_tf=self.post_tf, doc_len=self.doc_len)
+        os.replace(f'{output_prefix}_lexical.tmp.npz', f'{output_prefix}_lexical.npz')
+        print(f"Saved lexical index to {output_prefix}_lexical.npz ({len(self.vocab)} terms)")
+
+    @classmethod
+    def load(cls, output_prefix, n_rows=None):
+        data = np.load(f'{output_prefix}_lexical.npz')
+        if n_rows is not None and data['doc_len'].shape[0] != n_rows:
+            raise ValueError("Lexical index doesn't match the embeddings (stale index?)")
+        return cls(data['vocab'], data['term_offsets'], data['post_rows'], data['post_tf'], data['doc_len'])
+
+    def search(self, query, top_k, rows=None):
+        """
+        BM25 top_k for query, optionally only among rows (sorted row indices from FilterIndex)
+
+        Returns:
+            (rows, scores), best first. Empty if none of the query terms are in the index.
+        """
+        terms = set(term for term in tokenize(query) if term in self.term_ids)
+        if not terms or self.n_rows == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        hit_rows = []
+        hit_scores = []
+        for term in terms:
+            term_id = self.term_ids[term]
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            postings = self.post_rows[start:end]
+            tf = self.post_tf[start:end].astype(np.float32)
+            df = end - start
+            idf = np.log(1.0 + (self.n_rows - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1.0 - self.b + self.b * self.doc_len[postings] / self.avg_len)
+            hit_rows.append(postings)
+            hit_scores.append(idf * tf * (self.k1 + 1.0) / (tf + norm))
+
+        hit_rows = np.concatenate(hit_rows)
+        unique_rows, inverse = np.unique(hit_rows, return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(hit_scores)).astype(np.float32)
+
+        if rows is not None:
+            allowed = np.isin(unique_rows, rows, assume_unique=True)
+            unique_rows, scores = unique_rows[allowed], scores[allowed]
+
+        top = np.argsort(-scores, kind='stable')[:top_k]
+        return unique_rows[top].astype(np.int64), scores[top]
+
+
+def build(chunks, output_prefix='search_index'):
+    index = LexicalIndex.build(chunks)
+    index.save(output_prefix)
+    return index
+
+
+def load(output_prefix='search_index', n_rows=None):
+    """Saved index, or None if there isn't one (or it's out of date), hybrid search then just goes dense"""
+    try:
+        return LexicalIndex.load(output_prefix, n_rows)
+    except FileNotFoundError:
+        print(f"No lexical index at {output_prefix}_lexical.npz, hybrid search disabled")
+    except ValueError as e:
+        print(f"{e}, hybrid search disabled")
+    return None
+
+
+def fuse(dense, lexical, method='rrf', rrf_k=60, alpha=0.5):
+    """
+    Combine a dense and a lexical ranking of the same candidates
+
+    Args:
+        dense: (rows, cosine scores) for every candidate
+        lexical: (rows, bm25 scores) for the candidates that matched any query term
+        method: 'rrf' reciprocal rank fusion (1 / (rrf_k + rank) summed over both lists),
+            'weighted' alpha * cosine + (1 - alpha) * bm25 / max bm25
+        alpha: dense weight for 'weighted'
+
+    Returns:
+        (rows, fused scores), best first
+    """
+    dense_rows, dense_scores = dense
+    lexical_rows, lexical_scores = lexical
+
+    if method == 'rrf':
+        fused = {}
+        for ranking in (dense_rows[np.argsort(-dense_scores, kind='stable')], lexical_rows):
+            for rank, row in enumerate(ranking.tolist()):
+                fused[row] = fused.get(row, 0.0) + 1.0 / (rrf_k + rank + 1)
+    elif method == 'weighted':
+        fused = {row: alpha * float(score) for row, score in zip(dense_rows.tolist(), dense_scores)}
+        top_lexical = float(lexical_scores[0]) if len(lexical_scores) else 0.0
+        for row, score in zip(lexical_rows.tolist(), lexical_scores):
+            fused[row] = fused.get(row, 0.0) + (1.0 - alpha) * float(score) / top_lexical
+    else:
+        raise ValueError(f"Unknown fusion method '{method}', use 'rrf' or 'weighted'")
+
+    rows = np.fromiter(fused.keys(), dtype=np.int64, count=len(fused))
+    scores = np.fromiter(fused.values(), dtype=np.float32, count=len(fused))
+    order = np.argsort(-scores, kind='stable')
+    return rows[order], scores[order]
@@ -0,0 +1,214 @@
+'''
+Scheduler for summary requests going to ollama.
+
+Every summary used to open its own chat() stream, so ten people searching at once meant
+ten generations fighting over one GPU: the big model thrashes and all ten stall. Now every
+request goes through here instead:
+
+    admit()  - picks a model with room in its queue (downgrading big -> medium -> small
+               if the one asked for is full, if allowed) or raises QueueFull straight away
+    stream() - waits for a free slot on that model, yielding queue position events while
+               it waits, then streams the chat through one shared ollama Client
+
+Each model has its own concurrency cap and its own bounded wait queue, served in order.
+The ollama host comes from OLLAMA_HOST like the ollama library itself, so pointing it at
+allthestuff.fakeOllama tests all of this without a GPU.
+'''
+import itertools
+import os
+import threading
+import time
+from collections import deque
+
+from . import metrics
+
+# how many generations each model runs at once, the big one barely fits on its own
+default_caps = {
+    'summaryModelBig:latest': 1,
+    'summaryModelMedium:latest': 2,
+    'summaryModelSmall:latest': 4,
+}
+
+# where a request goes when its model's queue is full, biggest to smallest
+downgrade_order = ['summaryModelBig:latest', 'summaryModelMedium:latest', 'summaryModelSmall:latest']
+
+
+class QueueFull(Exception):
+    """Raised by admit() when there's no room for the request anywhere it's allowed to go"""
+
+
+class Ticket:
+    """One admitted request, holds its place in a model's queue until released"""
+
+    def __init__(self, scheduler, model, requested_model, number):
+        self.scheduler = scheduler
+        self.model = model
+        self.requested_model = requested_model
+        self.number = number
+        self.running = False
+        self.released = False
+
+    @property
+    def downgraded(self):
+        return self.model != self.requested_model
+
+    def release(self):
+        self.scheduler._release(self)
+
+
+class LLMScheduler:
+    def __init__(self, host=None, caps=None, default_cap=2, max_queue=8, client=None, metrics_registry=None):
+        """
+        Args:
+            host: ollama url, None uses OLLAMA_HOST (or ollama's default localhost:11434)
+            caps: {model: max concurrent generations}, anything not listed gets default_cap
+            max_queue: max requests waiting per model, past that admit() downgrades or rejects
+            client: anything with ollama.Client's chat(), for tests
+            metrics_registry: where queue wait / first token / tokens per second go, None
+                uses the shared metrics.registry
+        """
+        if client is None:
+            from ollama import Client
+            client = Client(host=host or os.environ.get('OLLAMA_HOST'))
+        self.client = client
+        self.metrics = metrics_registry if metrics_registry is not None else metrics.registry
+        self.caps = dict(default_caps if caps is None else caps)
+        self.default_cap = default_cap
+        self.max_queue = max_queue
+        self._cond = threading.Condition()
+        self._waiting = {}  # model -> deque of tickets, in arrival order
+        self._active = {}   # model -> running generations
+        self._numbers = itertools.count(1)
+        self.completed = 0
+        self.rejected = 0
+        self.downgraded = 0
+
+    def cap(self, model):
+        return self.caps.get(model, self.default_cap)
+
+    def _has_room(self, model):
+        return len(self._waiting.get(model, ())) < self.max_queue
+
+    def admit(self, model, allow_downgrade=True):
+        """
+        Reserve a place in line for model, or a smaller one if its queue is full
+
+        Returns:
+            Ticket, ticket.model is the model that will actually run
+        Raises:
+            QueueFull if there's no room anywhere
+        """
+        candidates = [model]
+        if allow_downgrade and model in downgrade_order:
+            candidates += downgrade_order[downgrade_order.index(model) + 1:]
+
+        with self._cond:
+            for candidate in candidates:
+                if self._has_room(candidate):
+                    ticket = Ticket(self, candidate, model, next(self._numbers))
+                    self._waiting.setdefault(candidate, deque()).append(ticket)
+                    if ticket.downgraded:
+                        self.downgraded += 1
+                    return ticket
+            self.rejected += 1
+        raise QueueFull(f"'{model}' queue is full ({self.max_queue} waiting), try again in a bit")
+
+    def _position(self, ticket):
+        """1 = next in line, 0 = running"""
+        if ticket.running:
+            return 0
+        return self._waiting[ticket.model].index(ticket) + 1
+
+    def wait(self, ticket, poll=1.0):
+        """
+        Block until ticket gets a slot. Yields its queue position every time it changes
+        (nothing at all if a slot is free straight away).
+        """
+        last = None
+        with self._cond:
+            while True:
+                queue = self._waiting[ticket.model]
+                if queue[0] is ticket and self._active.get(ticket.model, 0) < self.cap(ticket.model):
+                    queue.popleft()
+                    self._active[ticket.model] = self._active.get(ticket.model, 0) + 1
+                    ticket.running = True
+                    # the next one in line might fit too if the cap is > 1
+                    self._cond.notify_all()
+                    return
+                position = self._position(ticket)
+                if position != last:
+                    last = position
+                    # let go of the lock while the caller sends the event
+                    self._cond.release()
+                    try:
+                        yield position
+                    finally:
+                        self._cond.acquire()
+                    continue
+                self._cond.wait(poll)
+
+    def _release(self, ticket):
+        with self._cond:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.running:
+                self._active[ticket.model] -= 1
+                self.completed += 1
+            else:
+                # gave up (closed the tab) while still waiting
+                try:
+                    self._waiting[ticket.model].remove(ticket)
+                except ValueError:
+                    pass
+            self._cond.notify_all()
+
+    def stream(self, ticket, messages, options=None):
+        """
+        Wait for a slot then stream the chat. Yields ('queue', position) while waiting and
+        ('content', text) pieces once generating. The slot is always given back, even if
+        the consumer stops reading part way (generator close).
+        """
+        model = ticket.model
+        try:
+            queued = time.perf_counter()
+            for position in self.wait(ticket):
+                yield 'queue', position
+            started = time.perf_counter()
+            self.metrics.observe('llm_queue_wait_seconds', started - queued, model=model)
+
+            first_token = None
+            tokens = 0
+            for chunk in self.client.chat(model=model, messages=messages, stream=True, options=options):
+                if first_token is None:
+                    first_token = time.perf_counter()
+                    self.metrics.observe('llm_first_token_seconds', first_token - started, model=model)
+                # ollama streams about a token per chunk, and its last chunk has the real count
+                tokens = chunk.get('eval_count') or tokens + 1
+                yield 'content', chunk['message']['content']
+
+            if first_token is not None:
+                finished = time.perf_counter()
+                self.metrics.observe('llm_generation_seconds', finished - started, model=model)
+                if finished > first_token:
+                    self.metrics.observe('llm_tokens_per_second', tokens / (finished - first_token), model=model)
+        finally:
+            ticket.release()
+
+    def stats(self):
+        with self._cond:
+            models = sorted(set(self._waiting) | set(self._active) | set(self.caps))
+            return {
+                'models': {
+                    model: {
+                        'cap': self.cap(model),
+                        'active': self._active.get(model, 0),
+                        'waiting': len(self._waiting.get(model, ())),
+                    }
+                    for model in models
+                },
+                'max_queue': self.max_queue,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'downgraded': self.downgraded,
+            }
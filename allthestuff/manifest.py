@@ -0,0 +1,82 @@
+'''
+Keeps track of what's already been ingested (path, size, mtime and a hash of the
+contents) so ingest only has to OCR and embed the files that actually changed.
+'''
+import glob
+import hashlib
+import json
+import os
+
+manifest_JSON = "ingest_manifest.json"
+
+
+def hash_file(file, block_size=1 << 20):
+    """sha256 of a file's contents, read in blocks so big pdfs don't eat all the RAM"""
+    h = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def list_files(data_dir):
+    """Every file under data_dir, same walk split.main used to do"""
+    entries = glob.glob(data_dir + '/**', recursive=True)
+    return sorted(entry for entry in entries if os.path.isfile(entry))
+
+
+def load_manifest(manifest_file=manifest_JSON):
+    if not os.path.exists(manifest_file) or os.path.getsize(manifest_file) == 0:
+        return {}
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_file=manifest_JSON):
+    # write to a temp file first so a crash mid-write doesn't leave us with half a manifest
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def diff_manifest(old_manifest, data_dir):
+    """
+    Compare what's on disk against the last manifest
+
+    Args:
+        old_manifest: dict of {path: {"size", "mtime", "sha256"}} from the last ingest
+        data_dir: folder to scan
+
+    Returns:
+        Tuple of (changed, deleted, new_manifest) where changed is every new or modified
+        file and deleted is every file in the old manifest that's gone now
+    """
+    new_manifest = {}
+    changed = []
+
+    for file in list_files(data_dir):
+        stat = os.stat(file)
+        old = old_manifest.get(file)
+
+        # size + mtime match, trust it and skip hashing
+        if old and old['size'] == stat.st_size and old['mtime'] == stat.st_mtime:
+            new_manifest[file] = old
+            continue
+
+        digest = hash_file(file)
+        new_manifest[file] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha256": digest,
+        }
+
+        # touched but not actually modified (copied over, git checkout, etc)
+        if old and old['sha256'] == digest:
+            continue
+
+        changed.append(file)
+
+    deleted = sorted(set(old_manifest) - set(new_manifest))
+
+    return changed, deleted, new_manifest
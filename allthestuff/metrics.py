@@ -0,0 +1,184 @@
+'''
+Timing histograms for the server's hot paths, served in Prometheus text format at /api/metrics.
+
+    with metrics.registry.timer('search_stage_seconds', stage='encode'):
+        ...
+    metrics.registry.observe('llm_tokens_per_second', rate, model=model)
+
+Histograms are declared up front in `histograms` below (name -> help, buckets, label names)
+so /api/metrics always lists the same series even before anything has been timed. Gauges
+(index size, cache stats, memory) aren't stored here, the app hands them to render() as
+they are right now.
+
+SEARCH_METRICS=0 turns it all off: timer() hands back one shared do-nothing context
+manager and observe() returns straight away, so a disabled timer costs one attribute check.
+'''
+import bisect
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+prefix = 'allthestuff_'
+
+# seconds, from sub-millisecond cache hits up to a big model taking its time
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+rate_buckets = (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200)
+
+histograms = {
+    'search_stage_seconds': (
+        "Time spent in each step of a search: parse (ks / folder: filters), encode (query "
+        "embedding, cache misses only), score (matrix products, ANN, BM25), topk (picking the "
+        "best rows, rank fusion for hybrid), build (result dicts + chunk lookup), serialize (JSON)",
+        latency_buckets, ('stage',)),
+    'search_seconds': ("Whole single query search, cache hits included", latency_buckets, ('mode',)),
+    'request_seconds': ("Time to build the response, streams only count up to the first byte",
+                        latency_buckets, ('endpoint',)),
+    'llm_queue_wait_seconds': ("Time a summary waited for a slot on its model", latency_buckets, ('model',)),
+    'llm_first_token_seconds': ("Slot granted to first token from ollama", latency_buckets, ('model',)),
+    'llm_generation_seconds': ("Slot granted to last token", latency_buckets, ('model',)),
+    'llm_tokens_per_second': ("Generation speed per summary", rate_buckets, ('model',)),
+    'index_reload_seconds': ("Time to open a new index in the background before it got swapped in",
+                             latency_buckets, ()),
+}
+
+
+class Histogram:
+    def __init__(self, name, help, buckets, label_names=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.label_names = tuple(label_names)
+        self._series = {}  # label values -> [bucket counts..., +Inf count], sum
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {labels: (list(counts), total) for labels, (counts, total) in self._series.items()}
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, self.labels)
+        return False
+
+
+_null_timer = nullcontext()
+
+
+class Metrics:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.histograms = {name: Histogram(name, help, buckets, label_names)
+                           for name, (help, buckets, label_names) in histograms.items()}
+
+    def _labels(self, histogram, labels):
+        return tuple(str(labels.get(name, '')) for name in histogram.label_names)
+
+    def timer(self, name, **labels):
+        """Context manager that observes how long its block took"""
+        if not self.enabled:
+            return _null_timer
+        histogram = self.histograms[name]
+        return _Timer(histogram, self._labels(histogram, labels))
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        histogram = self.histograms[name]
+        histogram.observe(value, self._labels(histogram, labels))
+
+    def render(self, gauges=None):
+        """
+        Everything in Prometheus text format (version 0.0.4)
+
+        Args:
+            gauges: {name: (help, value)} or {name: (help, value, 'counter')}, value is a number
+                or {((label, value), ...): number}. Names get the prefix added like histograms do
+
+        Returns:
+            str
+        """
+        lines = []
+        for name, (help, value, *kind) in (gauges or {}).items():
+            lines.append(f"# HELP {prefix}{name} {help}")
+            lines.append(f"# TYPE {prefix}{name} {kind[0] if kind else 'gauge'}")
+            series = value if isinstance(value, dict) else {(): value}
+            for labels, number in series.items():
+                if number is None:
+                    continue
+                lines.append(f"{prefix}{name}{_format_labels(labels)} {_format_number(number)}")
+
+        for histogram in self.histograms.values():
+            name = prefix + histogram.name
+            lines.append(f"# HELP {name} {histogram.help}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, (counts, total) in sorted(histogram.snapshot().items()):
+                labels = tuple(zip(histogram.label_names, labels))
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else _format_number(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_number(total)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+def _format_number(number):
+    if isinstance(number, bool):
+        return '1' if number else '0'
+    if isinstance(number, int):
+        return str(number)
+    return repr(float(number))
+
+
+def memory():
+    """(resident bytes right now, peak resident bytes), None for whichever this OS can't tell us"""
+    rss = None
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    peak = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # linux reports KB, macOS bytes
+        peak = peak if os.uname().sysname == 'Darwin' else peak * 1024
+    return rss, peak
+
+
+# shared by the search engine, the LLM scheduler and the app
+registry = Metrics(enabled=os.environ.get('SEARCH_METRICS', '1') != '0')
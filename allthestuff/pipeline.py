@@ -0,0 +1,281 @@
+'''
+Streaming ingest pipeline.
+
+split.main used to go one file at a time, and every pdf that needed OCR spun up and tore
+down its own Pool, so small pdfs left most cores idle and chunking/embedding sat around
+until every file was extracted. This runs the whole thing as one pipeline instead:
+
+    pages of every file -> one long lived Pool -> per-file assembly -> chunk + embed thread
+
+There's one page-level work queue across all the files. A semaphore caps how many pages
+are in flight, and finished documents go through a bounded queue to the chunk/embed
+thread, so if embedding falls behind the pool stops getting new pages (backpressure)
+instead of piling extracted text up in memory.
+'''
+import json
+import queue
+import threading
+import time
+from multiprocessing import Pool, cpu_count
+
+import filetype
+import numpy as np
+
+from . import chunkStore
+from . import extractCache
+from . import extractText
+from . import manifest
+from . import split
+
+report_JSON = "ingest_report.json"
+ROUTES = ("cached", "text", "ocr", "ocr_retry", "error")
+
+_DONE = object()
+
+
+def write_report(report, report_file, elapsed, chunk_stats=None, errors=None):
+    """Print + save how many pages of each file took each extraction path, how it chunked, and which pages failed"""
+    chunk_stats = chunk_stats or {}
+    errors = errors or {}
+    totals = {route: 0 for route in ROUTES}
+    print(f"\n{'file':60s} " + " ".join(f"{route:>9s}" for route in ROUTES))
+    for file in sorted(report):
+        routes = report[file]
+        for route in ROUTES:
+            totals[route] += routes.get(route, 0)
+        print(f"{file[-60:]:60s} " + " ".join(f"{routes.get(route, 0):9d}" for route in ROUTES))
+    print(f"{'total':60s} " + " ".join(f"{totals[route]:9d}" for route in ROUTES) + "\n")
+    for file in sorted(errors):
+        for page, error in sorted(errors[file].items()):
+            print(f"{file}: page {page} failed: {error}")
+
+    with open(report_file, "w", encoding="utf-8") as f:
+        json.dump({
+            'seconds': elapsed,
+            'totals': totals,
+            'files': {
+                file: {'pages': report.get(file, {}), 'chunking': chunk_stats.get(file, {}),
+                       'errors': errors.get(file, {})}
+                for file in sorted(set(report) | set(chunk_stats))
+            },
+        }, f, indent=2)
+
+
+def pdf_page_counts(files):
+    """Yields (file, page count) for every pdf in files, anything else gets skipped"""
+    for file in files:
+        kind = filetype.guess(file)
+        if kind is None or kind.extension != "pdf":
+            print(f"Skipping '{file}', not a pdf")
+            continue
+        yield file, extractText.page_count(file)
+
+
+def _embed_worker(docs, store_file, model, embed_batch, chunker, out):
+    """Chunks + embeds documents as they come off the queue (runs on its own thread)"""
+    from . import generateEmbeddings
+
+    pending = []
+
+    def flush():
+        if not pending:
+            return
+        if model is None:  # chunk only, embedding happens later (sharded)
+            pending.clear()
+            return
+        embeddings = generateEmbeddings.generate_Embeddings(pending, model=model)
+        out['chunks'].extend(pending)
+        out['embeddings'].append(np.asarray(embeddings, dtype=np.float32))
+        pending.clear()
+
+    while True:
+        doc = docs.get()
+        if doc is _DONE:
+            break
+        if out['error'] is not None:
+            continue  # keep draining so the pool doesn't block forever on a dead consumer
+        try:
+            file, text = doc
+            chunks = chunker(text, file)
+            out['chunk_stats'][file] = stats = split.chunk_stats(chunks)
+            if stats['chunks']:
+                print(f"'{file}': {stats['chunks']} chunks, tokens p50={stats['tokens_p50']} "
+                      f"p90={stats['tokens_p90']} max={stats['tokens_max']}")
+            chunkStore.append_chunks(store_file, chunks)
+            pending.extend(chunks)
+            if len(pending) >= embed_batch:
+                flush()
+        except Exception as e:
+            out['error'] = e
+
+    if out['error'] is None:
+        try:
+            flush()
+        except Exception as e:
+            out['error'] = e
+
+
+def run(files, store_file=chunkStore.chunk_store, workers=None, dpi=300, dpi_retry=600,
+        min_confidence=60, max_inflight=None, doc_queue_size=4, embed_batch=256, chunking='tokens',
+        max_tokens=512, overlap_tokens=64, chunk_size=50, overlap=10,
+        model_name='Qwen/Qwen3-Embedding-0.6B', report_file=report_JSON,
+        hashes=None, use_cache=True, embed=True, model=None):
+    """
+    Extract, chunk and embed files in one streaming pass
+
+    Args:
+        files: files to ingest
+        store_file: chunk store new chunks get appended to
+        workers: size of the shared extraction pool (defaults to cpu_count())
+        dpi: starting OCR dpi for pages without a usable text layer
+        dpi_retry: dpi a page gets re-OCR'd at if confidence is under min_confidence
+        max_inflight: max pages queued in the pool at once (defaults to 4 per worker)
+        doc_queue_size: max extracted documents waiting on the chunk/embed thread
+        embed_batch: chunks per embedding call
+        chunking: 'tokens' packs markdown into max_tokens chunks of the model's own tokenizer
+            (overlap_tokens only used when a paragraph has to be cut), 'words' is the old
+            fixed chunk_size words with overlap words
+        report_file: where the per-file extraction report gets written
+        hashes: {file: sha256} if the caller already hashed them (the manifest does)
+        use_cache: pull already extracted files out of the extraction cache, and save new ones
+        embed: False only extracts + chunks into the store (full rebuilds embed afterwards
+            with generateEmbeddings.build_Index, which is sharded and resumable)
+        model: already loaded embedding model, None loads model_name
+
+    Returns:
+        Tuple of (chunks, embeddings) for everything that was ingested, ([], None) if embed is False
+    """
+    from sentence_transformers import SentenceTransformer
+
+    workers = workers or max(1, cpu_count())
+    max_inflight = max_inflight or 4 * workers
+
+    docs = queue.Queue(maxsize=doc_queue_size)
+    out = {'chunks': [], 'embeddings': [], 'chunk_stats': {}, 'error': None}
+
+    inflight = threading.BoundedSemaphore(max_inflight)
+    lock = threading.Lock()
+    pages = {}      # file -> [text per page]
+    remaining = {}  # file -> pages left
+    keys = {}       # file -> extraction cache key
+    stats = {'pages': 0, 'files': 0, 'cached_files': 0, 'cached_pages': 0}
+    report = {}     # file -> {route: page count}
+    errors = {}     # file -> {page: error}, failed pages are left empty in the text
+
+    def finish_page(result):
+        file, page, text, route, error = result
+        with lock:
+            pages[file][page - 1] = text
+            routes = report.setdefault(file, {})
+            routes[route] = routes.get(route, 0) + 1
+            if error:
+                errors.setdefault(file, {})[page] = error
+            remaining[file] -= 1
+            done = remaining[file] == 0
+            stats['pages'] += 1
+            if done:
+                text = "\n".join(pages.pop(file))
+                del remaining[file]
+                stats['files'] += 1
+                routes = dict(routes)
+        if done:
+            if file in keys and routes.get("error", 0) == 0:
+                extractCache.put(keys[file], {'file': file, 'text': text, 'routes': routes})
+            # blocks the pool's result thread if the embedder is behind, which stops
+            # pages from being released below, which stops new pages going out
+            docs.put((file, text))
+        inflight.release()
+
+    def page_failed(e):
+        print(f"Page extraction failed: {repr(e)}")
+        inflight.release()
+
+    start = time.perf_counter()
+    print(f"Using {workers} worker(s) for extraction")
+    with Pool(workers) as pool:
+        # model gets loaded after the pool forks so the workers don't each inherit a copy
+        if embed:
+            if model is None:
+                print(f"Loading model: {model_name}")
+                model = SentenceTransformer(model_name)
+            tokenizer = model.tokenizer
+            # never bigger than what the model can actually see
+            max_tokens = min(max_tokens, model.max_seq_length or max_tokens)
+        else:
+            model = None
+            tokenizer = split.load_tokenizer(model_name) if chunking == 'tokens' else None
+
+        if chunking == 'tokens':
+            chunker = lambda text, file: split.make_token_chunks(text, file, tokenizer, max_tokens, overlap_tokens)
+        else:
+            chunker = lambda text, file: split.make_chunks(text, file, chunk_size, overlap)
+
+        embedder = threading.Thread(
+            target=_embed_worker,
+            args=(docs, store_file, model, embed_batch, chunker, out),
+            name='ingest-embedder',
+            daemon=True,
+        )
+        embedder.start()
+
+        for file, total_pages in pdf_page_counts(files):
+            if total_pages == 0:
+                print(f"'{file}' has zero pages or couldn't read page count.")
+                continue
+
+            if use_cache:
+                content_hash = (hashes or {}).get(file) or manifest.hash_file(file)
+                keys[file] = extractCache.cache_key(
+                    content_hash, "pages", version=extractText.EXTRACTOR_VERSION, dpi=dpi,
+                    dpi_retry=dpi_retry, min_confidence=min_confidence,
+                )
+                cached = extractCache.get(keys[file])
+                if cached is not None:
+                    with lock:
+                        report[file] = {"cached": total_pages}
+                        stats['files'] += 1
+                        stats['cached_files'] += 1
+                        stats['cached_pages'] += total_pages
+                    docs.put((file, cached['text']))
+                    continue
+
+            with lock:
+                pages[file] = [""] * total_pages
+                remaining[file] = total_pages
+
+            # every page of every file goes into the same pool, so small files don't
+            # leave workers idle waiting on the next file
+            for page in range(1, total_pages + 1):
+                inflight.acquire()
+                pool.apply_async(extractText.extract_page, ((file, page, dpi, dpi_retry, min_confidence),),
+                                 callback=finish_page, error_callback=page_failed)
+
+        pool.close()
+        pool.join()
+
+    # anything left here had a page error out, ingest what we did get
+    for file in list(remaining):
+        print(f"'{file}' is missing {remaining[file]} page(s), ingesting the rest")
+        docs.put((file, "\n".join(pages.pop(file))))
+
+    docs.put(_DONE)
+    embedder.join()
+
+    if out['error'] is not None:
+        raise out['error']
+
+    elapsed = time.perf_counter() - start
+    extracted_files = stats['files'] - stats['cached_files']
+    print(f"Pipeline: {stats['files']} file(s) in {elapsed:.1f}s, {extracted_files} extracted ({stats['pages']} pages, "
+          f"{stats['pages'] / elapsed if elapsed else 0:.2f} pages/s) and {stats['cached_files']} from the extraction "
+          f"cache ({stats['cached_pages']} pages), {len(out['chunks'])} chunks")
+
+    write_report(report, report_file, elapsed, out['chunk_stats'], errors)
+
+    if model is None:
+        return [], None
+    if out['embeddings']:
+        embeddings = np.concatenate(out['embeddings'])
+    else:
+        embeddings = np.zeros((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+    return out['chunks'], embeddings
@@ -0,0 +1,206 @@
+'''
+Quantized copies of the embeddings for a cheap first pass, with the shortlist rescored on
+the real float vectors.
+
+The float32 matrix is 4 bytes per dimension per chunk and the exact scan reads every byte
+of it on every unfiltered query. These keep a much smaller code per row instead:
+
+    binary - sign of every dimension, 8 per byte (32x smaller), first pass is hamming distance
+    int8   - every dimension scaled into -127..127 by its own scale (4x smaller), first pass is
+             a dot product of the float query against the codes
+
+The best rescore * top_k rows of the first pass then get their exact cosine from the float
+vectors. When the server runs off the mmap'd .idx only those rows ever get read in, so the
+floats stop needing to live in memory at all.
+
+Both behave like annIndex backends (ann_backend='binary' / 'int8'), saved as
+search_index_binary.npz and search_index_int8.npz (int8 keeps its scales in there too).
+"uv run ann-report" shows their recall@k against the exact scan and what the codes cost in
+memory next to the floats.
+'''
+import os
+
+import numpy as np
+
+from . import searchIndex
+
+if hasattr(np, 'bitwise_count'):
+    _popcount = np.bitwise_count
+else:
+    # numpy < 2.0, count a byte at a time
+    _bits_per_byte = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def _popcount(words):
+        return _bits_per_byte[words.view(np.uint8)].reshape(*words.shape, -1).sum(axis=-1, dtype=np.uint16)
+
+
+def pack_signs(embeddings):
+    """Sign bits of every row packed into uint64 words (dimensions padded up to a multiple of 64)"""
+    embeddings = np.atleast_2d(embeddings)
+    bits = np.packbits(embeddings > 0, axis=1)
+    padding = -bits.shape[1] % 8
+    if padding:
+        bits = np.pad(bits, ((0, 0), (0, padding)))
+    return np.ascontiguousarray(bits).view(np.uint64)
+
+
+def int8_scales(embeddings, sample_size=20_000, clip_quantile=0.999, seed=0):
+    """
+    Per dimension scale so that scale * 127 covers all but the most extreme values. Clipping
+    the odd outlier keeps the other 99.9% of values from getting squashed into a few codes.
+    """
+    n = embeddings.shape[0]
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(n, min(n, sample_size), replace=False))
+    sample = np.abs(np.asarray(embeddings[rows], dtype=np.float32))
+    scales = np.quantile(sample, clip_quantile, axis=0).astype(np.float32) / 127.0
+    scales[scales == 0] = 1.0
+    return scales
+
+
+def quantize_int8(embeddings, scales):
+    return np.clip(np.rint(np.asarray(embeddings, dtype=np.float32) / scales), -127, 127).astype(np.int8)
+
+
+class _QuantizedIndex:
+    """
+    Shared first pass + rescore. Subclasses say how to encode rows (build), how to get the
+    query ready (_prepare) and how to score a block of codes (_block_scores).
+    """
+    name = None
+    block_rows = 65536
+    default_rescore = 4
+
+    def __init__(self, embeddings, codes, rescore=None):
+        self.embeddings = embeddings
+        self.codes = codes
+        self.rescore = rescore or self.default_rescore
+
+    @classmethod
+    def _encode_all(cls, embeddings, encode, width, dtype):
+        n = embeddings.shape[0]
+        codes = np.empty((n, width), dtype=dtype)
+        for start in range(0, n, cls.block_rows):
+            codes[start:start + cls.block_rows] = encode(np.asarray(embeddings[start:start + cls.block_rows], dtype=np.float32))
+        return codes
+
+    def memory_bytes(self):
+        """What the in-memory part of this index costs (the floats are only read for rescoring)"""
+        return self.codes.nbytes
+
+    def search(self, query_embedding, top_k, **kwargs):
+        return self.search_many(np.atleast_2d(query_embedding), top_k, **kwargs)[0]
+
+    def search_many(self, query_embeddings, top_k, rescore=None, **kwargs):
+        """First pass over every code block for all the queries at once, then rescore each shortlist"""
+        query_embeddings = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        n = self.codes.shape[0]
+        shortlist = min(n, max(top_k, top_k * (rescore or self.rescore)))
+        prepared = self._prepare(query_embeddings)
+
+        # only the running best `shortlist` rows per query are kept, never an (m, n) score matrix
+        best_rows = [np.empty(0, dtype=np.int64)] * len(query_embeddings)
+        best_scores = [np.empty(0, dtype=np.float32)] * len(query_embeddings)
+        for start in range(0, n, self.block_rows):
+            block_scores = self._block_scores(prepared, start, min(n, start + self.block_rows))
+            for i, scores in enumerate(block_scores):
+                top = searchIndex.top_k_indices(scores, shortlist)
+                rows = np.concatenate([best_rows[i], top + start])
+                scores = np.concatenate([best_scores[i], scores[top].astype(np.float32)])
+                keep = searchIndex.top_k_indices(scores, shortlist)
+                best_rows[i], best_scores[i] = rows[keep], scores[keep]
+
+        hits = []
+        for query, rows in zip(query_embeddings, best_rows):
+            # sorted so the float rows come off the mmap in file order
+            rows = np.sort(rows)
+            similarities = np.asarray(self.embeddings[rows], dtype=np.float32) @ query
+            top = searchIndex.top_k_indices(similarities, top_k)
+            hits.append((rows[top], similarities[top]))
+        return hits
+
+    def _check(self, embeddings, path):
+        if self.codes.shape[0] != embeddings.shape[0]:
+            raise ValueError(f"{path} doesn't match the embeddings (stale index?)")
+
+
+class BinaryIndex(_QuantizedIndex):
+    """One bit per dimension, ranked by hamming distance to the query's sign bits"""
+    name = 'binary'
+    # hamming throws away a lot, so it needs a longer shortlist than int8 to get the same recall
+    default_rescore = 10
+
+    @classmethod
+    def build(cls, embeddings, rescore=None, **kwargs):
+        width = -(-embeddings.shape[1] // 64)
+        return cls(embeddings, cls._encode_all(embeddings, pack_signs, width, np.uint64), rescore)
+
+    def save(self, output_prefix):
+        np.savez(f'{output_prefix}_binary.tmp.npz', codes=self.codes)
+        os.replace(f'{output_prefix}_binary.tmp.npz', f'{output_prefix}_binary.npz')
+        print(f"Saved binary codes to {output_prefix}_binary.npz ({self.codes.nbytes / 1024 / 1024:.1f} MB)")
+
+    @classmethod
+    def load(cls, output_prefix, embeddings, rescore=None, **kwargs):
+        index = cls(embeddings, np.load(f'{output_prefix}_binary.npz')['codes'], rescore)
+        index._check(embeddings, f'{output_prefix}_binary.npz')
+        return index
+
+    def _prepare(self, query_embeddings):
+        return pack_signs(query_embeddings)
+
+    def _block_scores(self, query_codes, start, stop):
+        block = self.codes[start:stop]
+        # fewer differing bits = closer, so negate to keep "higher is better"
+        return np.stack([-_popcount(block ^ code).sum(axis=1, dtype=np.int32) for code in query_codes])
+
+
+class Int8Index(_QuantizedIndex):
+    """
+    One signed byte per dimension, ranked by (query * scales) . codes. numpy has no int8
+    matrix product, so codes get converted to float a cache sized piece at a time into one
+    reused buffer, which keeps this about as fast as the float scan while holding a quarter
+    of the memory.
+    """
+    name = 'int8'
+    convert_rows = 1024
+
+    def __init__(self, embeddings, codes, scales, rescore=None):
+        super().__init__(embeddings, codes, rescore)
+        self.scales = scales
+
+    @classmethod
+    def build(cls, embeddings, rescore=None, **kwargs):
+        scales = int8_scales(embeddings)
+        codes = cls._encode_all(embeddings, lambda block: quantize_int8(block, scales), embeddings.shape[1], np.int8)
+        return cls(embeddings, codes, scales, rescore)
+
+    def save(self, output_prefix):
+        np.savez(f'{output_prefix}_int8.tmp.npz', codes=self.codes, scales=self.scales)
+        os.replace(f'{output_prefix}_int8.tmp.npz', f'{output_prefix}_int8.npz')
+        print(f"Saved int8 codes to {output_prefix}_int8.npz ({self.codes.nbytes / 1024 / 1024:.1f} MB)")
+
+    @classmethod
+    def load(cls, output_prefix, embeddings, rescore=None, **kwargs):
+        data = np.load(f'{output_prefix}_int8.npz')
+        index = cls(embeddings, data['codes'], data['scales'], rescore)
+        index._check(embeddings, f'{output_prefix}_int8.npz')
+        return index
+
+    def memory_bytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def _prepare(self, query_embeddings):
+        # fold the scales into the query once instead of dequantizing every code
+        buffer = np.empty((self.convert_rows, self.codes.shape[1]), dtype=np.float32)
+        return query_embeddings * self.scales, buffer
+
+    def _block_scores(self, prepared, start, stop):
+        scaled_queries, buffer = prepared
+        scores = np.empty((len(scaled_queries), stop - start), dtype=np.float32)
+        for offset in range(start, stop, self.convert_rows):
+            codes = self.codes[offset:min(stop, offset + self.convert_rows)]
+            block = buffer[:len(codes)]
+            np.copyto(block, codes, casting='unsafe')
+            np.matmul(scaled_queries, block.T, out=scores[:, offset - start:offset - start + len(codes)])
+        return scores
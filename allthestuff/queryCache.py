@@ -0,0 +1,91 @@
+'''
+Small LRU caches for the search server.
+
+People search the same handful of things all day ("ks9 rear wing", "accumulator status")
+and every one of those used to cost a full transformer forward pass. These cache the
+query embedding and the final result list. Both are tagged with the index version they
+were filled under and get cleared as soon as the engine reports a different one, so a
+new ingest never serves stale results.
+'''
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+def normalize_query(query):
+    """Collapse whitespace so 'ks9  rear wing ' and 'ks9 rear wing' share a cache entry"""
+    return ' '.join(query.split())
+
+
+class QueryCaches:
+    """
+    The query embedding cache and the result cache, invalidated together on index version.
+
+    embeddings: normalized cleaned query -> unit length query vector
+    results:    (cleaned query, ks filter, folder filter, top_k, threshold) -> result list
+    """
+
+    def __init__(self, embedding_size=1024, result_size=512):
+        self.embeddings = LRUCache(embedding_size)
+        self.results = LRUCache(result_size)
+        self.version = None
+        self._lock = threading.Lock()
+
+    def sync_version(self, version):
+        """Drop everything if the index changed since these entries were cached"""
+        if version == self.version:
+            return
+        with self._lock:
+            if version != self.version:
+                if self.version is not None:
+                    print(f"Index version changed ({self.version} -> {version}), clearing caches")
+                self.embeddings.clear()
+                self.results.clear()
+                self.version = version
+
+    def stats(self):
+        return {
+            'index_version': self.version,
+            'query_embeddings': self.embeddings.stats(),
+            'results': self.results.stats(),
+        }
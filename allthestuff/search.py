@@ -30,6 +30,12 @@ class SemanticSearchEngine:
         with open(chunks_file, 'r', encoding='utf-8') as f:
             self.chunks = json.load(f)
         
+        # normalize once at load (contiguous float32) so every query is one matrix-vector product
+        self.embeddings = np.ascontiguousarray(self.embeddings, dtype=np.float32)
+        norms = np.linalg.norm(self.embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self.embeddings /= norms
+        
         print(f"Loaded {len(self.chunks)} chunks with {self.embeddings.shape[1]}-dimensional embeddings")
     
     def extract_ks_filter(self, query: str) -> tuple[str, str]:
@@ -74,15 +80,16 @@ class SemanticSearchEngine:
             print(f"Filtering results for: {ks_filter}")
         
         # Generate query embedding using cleaned query
-        query_embedding = self.model.encode([cleaned_query])[0]
+        query_embedding = self.model.encode([cleaned_query])[0].astype(np.float32)
+        query_embedding /= max(np.linalg.norm(query_embedding), 1e-12)
         
-        # Compute cosine similarity
-        similarities = np.dot(self.embeddings, query_embedding) / (
-            np.linalg.norm(self.embeddings, axis=1) * np.linalg.norm(query_embedding)
-        )
+        # Compute cosine similarity (embeddings are already unit length)
+        similarities = self.embeddings @ query_embedding
         
-        # Get top K indices
-        top_indices = np.argsort(similarities)[-top_k:][::-1]
+        # Get top K indices, partial selection instead of sorting everything
+        top_k = min(top_k, len(similarities))
+        top_indices = np.argpartition(-similarities, top_k - 1)[:top_k] if top_k > 0 else np.empty(0, dtype=int)
+        top_indices = top_indices[np.argsort(-similarities[top_indices])]
         
         # Build results
         results = []
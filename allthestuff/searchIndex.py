@@ -0,0 +1,127 @@
+'''
+Shared bits for scoring the embedding index.
+
+The index is L2 normalized once (when it's saved and again when it's loaded, in case
+it's an old file) so cosine similarity is just one matrix-vector product per query,
+and we only partially sort the scores since we only ever want the top few.
+'''
+import re
+
+import numpy as np
+
+
+def normalize_embeddings(embeddings):
+    """Return a C-contiguous float32 copy of embeddings with every row scaled to unit length"""
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if embeddings.ndim == 1:
+        norm = np.linalg.norm(embeddings)
+        return embeddings / norm if norm > 0 else embeddings
+
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    # all-zero rows (empty chunks) would turn into NaNs otherwise
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(embeddings / norms, dtype=np.float32)
+
+
+def top_k_indices(scores, top_k):
+    """
+    Indices of the top_k highest scores, best first
+
+    argpartition pulls the top_k out in O(n) and then only those get sorted,
+    instead of argsorting every score in the corpus.
+    """
+    n = scores.shape[0]
+    if top_k <= 0 or n == 0:
+        return np.empty(0, dtype=np.int64)
+    if top_k >= n:
+        return np.argsort(-scores, kind='stable')
+
+    top = np.argpartition(-scores, top_k - 1)[:top_k]
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+class FilterIndex:
+    """
+    Maps KS numbers and path folders to the rows of the index that came from them, so a
+    filtered query only has to score the matching slice of the embedding matrix instead
+    of ranking everything and throwing most of the top_k away afterwards.
+    """
+
+    def __init__(self, chunks):
+        file_rows = {}
+        for row, chunk in enumerate(chunks):
+            # non-dict chunks have no file, so they never match a filter (same as before)
+            if isinstance(chunk, dict):
+                file_rows.setdefault(chunk.get('file', ''), []).append(row)
+
+        self._build({file: np.asarray(rows, dtype=np.int64) for file, rows in file_rows.items()})
+
+    @classmethod
+    def from_file_ids(cls, files, file_ids):
+        """Build straight from a per-row file id array (the .idx file) without decoding any chunks"""
+        self = cls.__new__(cls)
+        order = np.argsort(file_ids, kind='stable')
+        bounds = np.searchsorted(file_ids[order], np.arange(len(files) + 1))
+        self._build({
+            file: order[bounds[i]:bounds[i + 1]].astype(np.int64)
+            for i, file in enumerate(files) if bounds[i] < bounds[i + 1]
+        })
+        return self
+
+    def _build(self, file_rows):
+        self.file_rows = file_rows
+
+        ks_rows = {}
+        folder_rows = {}
+        self.folder_names = {}
+        for file, rows in self.file_rows.items():
+            for ks_number in set(re.findall(r'ks\s*(\d+)', file.lower())):
+                ks_rows.setdefault(f"ks{ks_number}", []).append(rows)
+
+            parts = file.replace('\\', '/').split('/')
+            for folder in set(parts[:-1]):
+                if folder and folder not in ('.', '..'):
+                    folder_rows.setdefault(folder.lower(), []).append(rows)
+                    self.folder_names.setdefault(folder.lower(), folder)
+
+        self.ks_rows = {key: np.sort(np.concatenate(rows)) for key, rows in ks_rows.items()}
+        self.folder_rows = {key: np.sort(np.concatenate(rows)) for key, rows in folder_rows.items()}
+        self._substring_cache = {}
+
+    def folders(self):
+        """Every folder name that shows up in a chunk's path, original casing"""
+        return sorted(self.folder_names.values())
+
+    def _substring_rows(self, text):
+        # "folder:Aero" has always matched anywhere in the path (Data/KS9/Aero.pdf is a
+        # file, not a folder), so anything that isn't an exact folder falls back to that
+        if text not in self._substring_cache:
+            if len(self._substring_cache) > 256:
+                self._substring_cache.clear()
+            matches = [rows for file, rows in self.file_rows.items() if text in file.lower()]
+            if matches:
+                self._substring_cache[text] = np.sort(np.concatenate(matches))
+            else:
+                self._substring_cache[text] = np.empty(0, dtype=np.int64)
+        return self._substring_cache[text]
+
+    def rows(self, ks_filter=None, subfolder_filter=None):
+        """
+        Rows matching the filters
+
+        Returns:
+            Sorted int64 array of row indices, or None if there are no filters at all
+        """
+        result = None
+
+        if ks_filter:
+            result = self.ks_rows.get(ks_filter.lower(), np.empty(0, dtype=np.int64))
+
+        if subfolder_filter:
+            key = subfolder_filter.lower()
+            folder = self.folder_rows.get(key)
+            if folder is None:
+                folder = self._substring_rows(key)
+            result = folder if result is None else np.intersect1d(result, folder, assume_unique=True)
+
+        return result
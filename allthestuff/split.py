@@ -1,11 +1,19 @@
 import glob
 import os
+import re
+from functools import lru_cache
+import numpy as np
 from . import extractText
-import json
+from . import chunkStore
 
 #path = "/home/nick/Desktop/Projects/Formula-AI/Data/**"
+json_file = chunkStore.chunk_store
 
 def split_to_json(text, file, json_file, path, chunk_size=50, overlap=10):
+    chunks = make_chunks(text, file, chunk_size, overlap)
+    append_to_json(json_file, chunks, path)
+
+def make_chunks(text, file, chunk_size=50, overlap=10):
     words = text.split()
     step = chunk_size - overlap
     chunks = []
@@ -28,29 +36,153 @@ def split_to_json(text, file, json_file, path, chunk_size=50, overlap=10):
         if i + chunk_size >= len(words):
             break
 
-    append_to_json(json_file, chunks, path)
+    return chunks
 
-def append_to_json(json_file, chunks, path):
-    if not os.path.exists(json_file) or os.path.getsize(json_file) == 0:
-        with open(json_file, "w", encoding="utf-8") as f:
-            json.dump([], f)
+# -----------------------------
+# Token-aware chunking
+# -----------------------------
+heading_pattern = re.compile(r'^\s*#{1,6}\s')
+
+@lru_cache(maxsize=4)
+def load_tokenizer(model_name='Qwen/Qwen3-Embedding-0.6B'):
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(model_name)
+
+def count_tokens(tokenizer, texts):
+    if not texts:
+        return []
+    return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)['input_ids']]
+
+def markdown_blocks(text):
+    """
+    Split pymupdf4llm markdown into headings and paragraphs
 
-    with open(json_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    Returns:
+        List of (start_word, words, is_heading). start_word is the offset into text.split(),
+        so chunks keep the same start_word/end_word meaning the word chunker always had.
+    """
+    blocks = []
+    offset = 0
+    paragraph = []
+    paragraph_start = 0
 
-    data.extend(chunks)
+    def flush():
+        nonlocal paragraph
+        if paragraph:
+            blocks.append((paragraph_start, paragraph, False))
+            paragraph = []
+
+    for line in text.splitlines():
+        words = line.split()
+        if not words:
+            flush()
+            continue
+        if heading_pattern.match(line):
+            flush()
+            blocks.append((offset, words, True))
+        else:
+            if not paragraph:
+                paragraph_start = offset
+            paragraph.extend(words)
+        offset += len(words)
+    flush()
+
+    return blocks
+
+def _split_block(tokenizer, start, words, n_tokens, max_tokens, overlap_tokens):
+    """Word windows over a paragraph that's too big for one chunk, each one under max_tokens"""
+    window = max(1, int(len(words) * max_tokens / n_tokens))
+    while True:
+        overlap = min(window - 1, int(len(words) * overlap_tokens / n_tokens))
+        step = max(1, window - overlap)
+        starts = list(range(0, len(words), step))
+        # the last window already reaching the end makes any after it redundant
+        starts = [i for i in starts if i == 0 or i + window - step < len(words)]
+        pieces = [words[i:i + window] for i in starts]
+        counts = count_tokens(tokenizer, [" ".join(piece) for piece in pieces])
+        if window == 1 or max(counts) <= max_tokens:
+            return [(start + i, piece, n) for i, piece, n in zip(starts, pieces, counts)]
+        window = max(1, int(window * 0.9))
+
+def make_token_chunks(text, file, tokenizer, max_tokens=512, overlap_tokens=64):
+    """
+    Pack markdown into chunks of up to max_tokens tokens of the embedding model's own tokenizer
+
+    Headings always start a new chunk and paragraphs are never split unless a single one
+    is bigger than max_tokens, in which case it's cut into overlapping word windows.
+    """
+    blocks = markdown_blocks(text)
+    counts = count_tokens(tokenizer, [" ".join(words) for _, words, _ in blocks])
+    chunks = []
+    current = []
+    current_tokens = 0
 
-    with open(json_file, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=4)
+    def emit(start, words, n_tokens):
+        chunks.append({
+            "chunk_id": len(chunks),
+            "start_word": start,
+            "end_word": start + len(words) - 1,
+            "text": " ".join(words),
+            "file": file,
+            "tokens": n_tokens,
+        })
+
+    def flush():
+        nonlocal current, current_tokens
+        if current:
+            words = [word for _, block_words in current for word in block_words]
+            emit(current[0][0], words, current_tokens)
+        current = []
+        current_tokens = 0
+
+    for (start, words, is_heading), n_tokens in zip(blocks, counts):
+        if is_heading:
+            flush()
+
+        if n_tokens > max_tokens:
+            flush()
+            for piece_start, piece, piece_tokens in _split_block(tokenizer, start, words, n_tokens, max_tokens, overlap_tokens):
+                emit(piece_start, piece, piece_tokens)
+            continue
+
+        if current_tokens + n_tokens > max_tokens:
+            flush()
+        current.append((start, words))
+        current_tokens += n_tokens
+
+    flush()
+    return chunks
+
+def chunk_stats(chunks):
+    """Chunk count + token length distribution for the ingest report"""
+    tokens = np.array([chunk.get("tokens", 0) for chunk in chunks])
+    if len(tokens) == 0:
+        return {"chunks": 0}
+    return {
+        "chunks": len(chunks),
+        "tokens_total": int(tokens.sum()),
+        "tokens_min": int(tokens.min()),
+        "tokens_p50": int(np.percentile(tokens, 50)),
+        "tokens_p90": int(np.percentile(tokens, 90)),
+        "tokens_max": int(tokens.max()),
+    }
+
+def append_to_json(json_file, chunks, path):
+    # old name kept around, the store is jsonl now so this is just an append
+    chunkStore.append_chunks(json_file, chunks)
 
-def main(path):
+def main(path, files=None):
+    """
+    path: data folder to chunk
+    files: only chunk these files (incremental ingest), None means everything under path
+    """
     path = path + '/**'
-    files_and_directories = glob.glob(path, recursive=True)
-    files = []
-    json_file = "documents.json"
-    for entry in files_and_directories:
-        if os.path.isfile(entry):
-            files.append(entry)
+    if files is None:
+        files = []
+        files_and_directories = glob.glob(path, recursive=True)
+        for entry in files_and_directories:
+            if os.path.isfile(entry):
+                files.append(entry)
 
     for file in files:
         text = str(extractText.main(file, "markdown"))
@@ -0,0 +1,121 @@
+'''
+On-disk cache of finished summaries.
+
+The ollama call is the slowest thing the server does and everyone shares the one GPU, so
+the same question over the same results shouldn't get generated twice. Entries are keyed
+on the model, the query and the ordered ids of the chunks that went into the prompt, and
+saved as gzipped json with the same two-level layout as the extraction cache.
+
+Everything in here was generated from one version of the index, so every index_version
+gets its own folder under cache_dir. When the version changes (a re-ingest, or a hot
+reload) the cache switches to the new folder and the old ones get moved aside and deleted,
+so requests still running against the old folder just miss instead of tripping over a
+half deleted tree.
+'''
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+
+from . import extractCache
+from . import queryCache
+
+cache_dir = "summary_cache"
+default_max_mb = 200
+
+
+def summary_key(model, query, results):
+    """model + normalized query + (file, chunk_id) of every result, in order"""
+    chunk_ids = [[result['chunk'].get('file'), result['chunk'].get('chunk_id')] for result in results]
+    payload = json.dumps({'model': model, 'query': queryCache.normalize_query(query), 'chunks': chunk_ids})
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class SummaryCache:
+    def __init__(self, cache_dir=cache_dir, max_mb=default_max_mb):
+        self.cache_dir = cache_dir
+        self.max_mb = max_mb
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._version_dir = None  # cache_dir/<version>, set by sync_version
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self._version_dir or self.cache_dir, key[:2], key + '.json.gz')
+
+    def sync_version(self, version):
+        """Switch to the folder for this index version, and get rid of every other version's"""
+        with self._lock:
+            if version == self.version:
+                return
+            name = 'v' + hashlib.sha256(str(version).encode('utf-8')).hexdigest()[:16]
+            version_dir = os.path.join(self.cache_dir, name)
+            os.makedirs(version_dir, exist_ok=True)
+            if self.version is not None:
+                print(f"Index changed ({self.version} -> {version}), switching summary cache")
+            # one assignment, a get / put that already picked the old folder just misses
+            self._version_dir = version_dir
+            self.version = version
+
+            # renamed while holding the lock so nothing new lands in them, deleted after
+            stale = []
+            for other in os.listdir(self.cache_dir):
+                if other == name:
+                    continue
+                trash = os.path.join(self.cache_dir, f"{other}.{uuid.uuid4().hex[:8]}.old")
+                try:
+                    os.replace(os.path.join(self.cache_dir, other), trash)
+                    stale.append(trash)
+                except OSError:
+                    pass
+
+        for trash in stale:
+            shutil.rmtree(trash, ignore_errors=True)
+
+    def get(self, key):
+        try:
+            with gzip.open(self._path(key), 'rt', encoding='utf-8') as f:
+                value = json.load(f)
+        except (OSError, EOFError, ValueError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(self._path(key))  # keeps it from getting pruned
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+                json.dump(value, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # its version's folder got swapped out mid write, it'd be stale anyway
+            print(f"Couldn't cache summary: {e}")
+
+    def prune(self):
+        return extractCache.prune(self.cache_dir, max_mb=self.max_mb)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'version': self.version,
+        }
+
+
+def replay(text, piece_size=200):
+    """Cached summary cut into pieces, sent as content events like a live stream would be"""
+    for start in range(0, len(text), piece_size):
+        yield text[start:start + piece_size]
@@ -0,0 +1,177 @@
+'''
+Builds the prompt for the summary models out of search results.
+
+The summary endpoint used to send f"Query: {query}, Document: {results}", the python repr
+of every result dict (scores, chunk ids, the whole file path, all of it), and neighbouring
+hits from the same file sent their shared overlap words twice. All of that is prompt
+tokens the model has to chew through before the first word of the answer comes out.
+
+Instead, hits from the same file whose word ranges touch or overlap get merged back into
+one passage (start_word/end_word are offsets into the file's text.split(), so the
+overlap is just sliced off), every passage gets a short [n] citation with its source, and
+passages go in best score first until the model's token budget is used up.
+'''
+import os
+
+# how many tokens of passages each summary model gets, bigger models can actually use more
+model_budgets = {
+    'summaryModelBig:latest': 12000,
+    'summaryModelMedium:latest': 6000,
+    'summaryModelSmall:latest': 3000,
+}
+default_budget = 6000
+
+# room left in the context window for the query, instructions and the answer itself
+answer_tokens = 1024
+
+# don't bother squeezing in the tail of a passage if less than this is left
+min_passage_tokens = 40
+
+
+def estimate_tokens(text):
+    """
+    Rough token count. We don't have the gemma tokenizer on the server, and ~4 characters
+    per token is close enough for English docs to budget with.
+    """
+    return (len(text) + 3) // 4
+
+
+def budget_for(model):
+    return model_budgets.get(model, default_budget)
+
+
+def context_window(model):
+    """num_ctx to ask ollama for so the whole prompt + answer actually fits (its default is tiny)"""
+    needed = budget_for(model) + answer_tokens
+    window = 2048
+    while window < needed:
+        window *= 2
+    return window
+
+
+def source_name(file):
+    """Path relative to the Data folder, which is all the model (and the user) needs to see"""
+    parts = os.path.normpath(file).split(os.sep)
+    if 'Data' in parts:
+        parts = parts[len(parts) - parts[::-1].index('Data'):]
+    return "/".join(parts)
+
+
+def merge_passages(results):
+    """
+    Merge hits from the same file that touch or overlap into single passages
+
+    Args:
+        results: search results, [{'score': ..., 'chunk': {...}}, ...]
+
+    Returns:
+        List of {'file', 'start_word', 'end_word', 'words', 'score'}, best score first
+    """
+    by_file = {}
+    loose = []
+    for result in results:
+        chunk = result['chunk']
+        words = chunk['text'].split()
+        passage = {
+            'file': chunk.get('file', ''),
+            'start_word': chunk.get('start_word'),
+            'end_word': chunk.get('end_word'),
+            'words': words,
+            'score': float(result.get('score', 0.0)),
+        }
+        if passage['start_word'] is None or passage['end_word'] is None:
+            loose.append(passage)
+        else:
+            by_file.setdefault(passage['file'], []).append(passage)
+
+    passages = []
+    for file_passages in by_file.values():
+        file_passages.sort(key=lambda p: p['start_word'])
+        current = None
+        for passage in file_passages:
+            if current is not None and passage['start_word'] <= current['end_word'] + 1:
+                # contiguous or overlapping, only add the words current doesn't already have
+                new_from = current['end_word'] + 1 - passage['start_word']
+                if new_from < len(passage['words']):
+                    current['words'] = current['words'] + passage['words'][new_from:]
+                    current['end_word'] = passage['end_word']
+                current['score'] = max(current['score'], passage['score'])
+            else:
+                current = dict(passage)
+                passages.append(current)
+
+    passages.extend(loose)
+    passages.sort(key=lambda p: p['score'], reverse=True)
+    return passages
+
+
+def _trim_words(words, max_tokens):
+    """Leading words of a passage that fit in max_tokens"""
+    budget = max_tokens * 4
+    used = 0
+    for i, word in enumerate(words):
+        used += len(word) + 1
+        if used > budget:
+            return words[:i]
+    return words
+
+
+def build_context(results, model=None, budget=None):
+    """
+    Compact, cited context for the summary model
+
+    Args:
+        results: search results as returned by /api/search
+        model: summary model name, picks the budget from model_budgets
+        budget: override the token budget
+
+    Returns:
+        Tuple of (context text, sources). sources[i] is what citation [i + 1] points at.
+    """
+    budget = budget if budget is not None else budget_for(model)
+    blocks = []
+    sources = []
+    used = 0
+
+    for passage in merge_passages(results):
+        n = len(sources) + 1
+        header = f"[{n}] {source_name(passage['file'])}"
+        header_tokens = estimate_tokens(header) + 1
+        words = passage['words']
+        text = " ".join(words)
+        tokens = header_tokens + estimate_tokens(text)
+
+        if used + tokens > budget:
+            left = budget - used - header_tokens
+            if left < min_passage_tokens:
+                break
+            # best passage that doesn't fit whole still gets its first part in
+            words = _trim_words(words, left)
+            text = " ".join(words) + " ..."
+            tokens = header_tokens + estimate_tokens(text)
+
+        blocks.append(f"{header}\n{text}")
+        sources.append({
+            'id': n,
+            'file': passage['file'],
+            'start_word': passage['start_word'],
+            'end_word': passage['end_word'] if len(words) == len(passage['words']) or passage['start_word'] is None
+                        else passage['start_word'] + len(words) - 1,
+            'score': passage['score'],
+        })
+        used += tokens
+        if used >= budget:
+            break
+
+    return "\n\n".join(blocks), sources
+
+
+def build_prompt(query, results, model=None, budget=None):
+    """Full user message for the summary model, returns (prompt, sources)"""
+    context, sources = build_context(results, model, budget)
+    prompt = (
+        f"Query: {query}\n\n"
+        f"Documents:\n{context}\n\n"
+        f"Cite the documents you use by their number, like [1]."
+    )
+    return prompt, sources